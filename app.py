@@ -2,7 +2,7 @@
 wFirma API - Web Service dla Render
 Flask web app z OAuth 2.0 i endpointami API
 """
-from flask import Flask, request, redirect, jsonify, Response
+from flask import Flask, request, redirect, jsonify, Response, send_file, g, stream_with_context
 import requests
 import json
 import os
@@ -10,11 +10,35 @@ import time
 import re
 import datetime
 import base64
+import hashlib
+import hmac
+import logging
+import threading
+import atexit
 import uuid
-import xml.etree.ElementTree as ET
-from urllib.parse import quote
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from urllib.parse import quote, urlsplit
 from functools import wraps
 
+from gus_bir import (
+    BIR_HOST_PROD, BIR_HOST_TEST, BIR_MAX_NIPS_PER_SEARCH, BIR_TEST_API_KEY,
+    BirResponseError, GusLoginError, GusResultCache, GusSessionManager, build_search_nips_envelope,
+    bir_url, iter_bir_records, soap_action,
+)
+from wfirma_cache import SeriesIndex, TTLCache
+from wfirma_contractor_index import ContractorIndex
+from wfirma_http import SessionRegistry
+from wfirma_idempotency import IdempotencyStore
+from wfirma_jobs import JobStore
+from wfirma_log import SAMPLED, configure_logging, get_logger, lazy, lazy_json
+from wfirma_metrics import Metrics, bind_request_timings, current_request_timings, end_request_timings, start_request_timings
+from wfirma_pdf_cache import PdfCache
+from wfirma_tokens import TokenStore
+from wfirma_token_backends import EnvTokenBackend, JsonFileTokenBackend, MemoryTokenBackend, SqliteTokenBackend
+from wfirma_render_env import RenderEnvWriter
+from wfirma_taskgraph import Speculative, TaskGraph
+
 app = Flask(__name__)
 
 # Konfiguracja z zmiennych środowiskowych (wFirma OAuth)
@@ -62,6 +86,11 @@ def get_company_config(company: str = None) -> dict:
 # Konfiguracja Render API (do trwałego zapisu tokenów)
 RENDER_API_KEY = os.environ.get('RENDER_API_KEY')
 RENDER_SERVICE_ID = os.environ.get('RENDER_SERVICE_ID')
+RENDER_ENV_RETRY_INTERVAL = float(os.environ.get('RENDER_ENV_RETRY_INTERVAL', '5'))
+
+# Zmiany ENV trafiają do Render w tle - jeden GET+PUT na paczkę zmienionych kluczy
+render_env = RenderEnvWriter(RENDER_API_KEY, RENDER_SERVICE_ID, retry_interval=RENDER_ENV_RETRY_INTERVAL)
+atexit.register(render_env.flush, 10)
 
 # Bezpieczeństwo API - wymagany klucz dla Make.com (lub innych klientów)
 MAKE_RENDER_API_KEY = os.environ.get('MAKE_RENDER_API_KEY')  # Ustaw w Render ENV!
@@ -71,6 +100,121 @@ MAKE_RENDER_API_KEY = os.environ.get('MAKE_RENDER_API_KEY')  # Ustaw w Render EN
 # jeśli brak – użyjemy ewentualnej BIR1_medidesk (z GCP).
 GUS_API_KEY = os.environ.get('GUS_API_KEY') or os.environ.get('BIR1_medidesk')
 GUS_USE_TEST = (os.environ.get('GUS_USE_TEST', 'false') or '').lower() == 'true'
+# Adres usługi BIR zamiast https://<host>/wsBIR/UslugaBIRzewnPubl.svc (np. lokalny benchmarks/fake_gus.py)
+GUS_BIR_URL = (os.environ.get('GUS_BIR_URL') or '').strip()
+
+# Sesje BIR (SID) współdzielone między zapytaniami - Zaloguj tylko gdy sesja wygaśnie
+GUS_SESSION_CHECK_INTERVAL = int(os.environ.get('GUS_SESSION_CHECK_INTERVAL', '300'))
+GUS_SESSION_MAX_AGE = int(os.environ.get('GUS_SESSION_MAX_AGE', str(55 * 60)))
+GUS_SOAP_TIMEOUT = float(os.environ.get('GUS_SOAP_TIMEOUT', '10'))
+
+# Hurtowe wyszukiwanie NIP (paczki po 20 w parametrze Nipy, kilka paczek równolegle).
+# BIR limituje 3-4 zapytania/s na użytkownika - nie zwiększaj współbieżności bez potrzeby.
+GUS_BATCH_CONCURRENCY = int(os.environ.get('GUS_BATCH_CONCURRENCY', '2'))
+GUS_BATCH_MAX_NIPS = int(os.environ.get('GUS_BATCH_MAX_NIPS', '1000'))
+
+# Adres API wFirma (można podmienić np. na lokalny serwer testowy)
+WFIRMA_API_URL = os.environ.get('WFIRMA_API_URL', 'https://api2.wfirma.pl').rstrip('/')
+
+# Pula połączeń keep-alive do wFirma (wspólna dla wszystkich helperów wfirma_*)
+WFIRMA_HTTP_POOL_CONNECTIONS = int(os.environ.get('WFIRMA_HTTP_POOL_CONNECTIONS', '4'))
+WFIRMA_HTTP_POOL_MAXSIZE = int(os.environ.get('WFIRMA_HTTP_POOL_MAXSIZE', '10'))
+WFIRMA_HTTP_CONNECT_TIMEOUT = float(os.environ.get('WFIRMA_HTTP_CONNECT_TIMEOUT', '5'))
+WFIRMA_HTTP_READ_TIMEOUT = float(os.environ.get('WFIRMA_HTTP_READ_TIMEOUT', '60'))
+WFIRMA_HTTP_KEEPALIVE = (os.environ.get('WFIRMA_HTTP_KEEPALIVE', 'true') or '').lower() == 'true'
+
+# Workflow faktury jako graf kroków - niezależne wywołania wFirma (kontrahent/seria, PDF/email) równolegle.
+# Pula wspólna dla wszystkich requestów workera; WORKFLOW_PARALLEL=false = kroki po kolei jak dawniej.
+WORKFLOW_PARALLEL = (os.environ.get('WORKFLOW_PARALLEL', 'true') or '').lower() == 'true'
+WORKFLOW_MAX_WORKERS = int(os.environ.get('WORKFLOW_MAX_WORKERS', '8'))
+workflow_executor = (ThreadPoolExecutor(max_workers=WORKFLOW_MAX_WORKERS, thread_name_prefix='workflow')
+                     if WORKFLOW_PARALLEL else None)
+
+# Spekulatywny GUS: dla NIP spoza indeksu kontrahentów i cache GUS zapytanie do BIR startuje razem
+# z contractors/find (zamiast po pustym wyniku) - nowy klient nie czeka na oba wywołania po kolei.
+# Gdy kontrahent istnieje, wynik jest porzucany (metryka wfirma_api_speculative_total{outcome="wasted"}).
+WORKFLOW_SPECULATIVE_GUS = (os.environ.get('WORKFLOW_SPECULATIVE_GUS', 'false') or '').lower() == 'true'
+WORKFLOW_SPECULATIVE_GUS_WORKERS = int(os.environ.get('WORKFLOW_SPECULATIVE_GUS_WORKERS', '4'))
+gus_speculative_executor = (ThreadPoolExecutor(max_workers=WORKFLOW_SPECULATIVE_GUS_WORKERS, thread_name_prefix='gus-spec')
+                            if WORKFLOW_SPECULATIVE_GUS else None)
+
+# Rozmiar bloku przy strumieniowym przekazywaniu PDF z wFirma do klienta
+PDF_STREAM_CHUNK_SIZE = int(os.environ.get('PDF_STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+# Dyskowy cache PDF faktur (wystawiona faktura się nie zmienia) - limit rozmiaru katalogu, 0 = bez limitu
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR', 'invoices')
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', str(200 * 1024 * 1024)))
+pdf_cache = PdfCache(PDF_CACHE_DIR, max_bytes=PDF_CACHE_MAX_BYTES)
+
+# Tryby zwrotu PDF w /api/workflow/create-invoice-from-nip (pole "pdf")
+PDF_RESPONSE_MODES = ['inline', 'url', 'none', 'multipart']
+
+wfirma_sessions = SessionRegistry(
+    pool_connections=WFIRMA_HTTP_POOL_CONNECTIONS,
+    pool_maxsize=WFIRMA_HTTP_POOL_MAXSIZE,
+    timeout=(WFIRMA_HTTP_CONNECT_TIMEOUT, WFIRMA_HTTP_READ_TIMEOUT),
+    enabled=WFIRMA_HTTP_KEEPALIVE,
+)
+
+# Cache company_id (companies/find) - wartość nie zmienia się dla danego grantu OAuth
+WFIRMA_COMPANY_ID_TTL = int(os.environ.get('WFIRMA_COMPANY_ID_TTL', str(24 * 60 * 60)))
+company_id_cache = TTLCache(ttl=WFIRMA_COMPANY_ID_TTL, name='company_id')
+
+# Indeks serii faktur (nazwa -> ID) - odświeżany w tle po TTL, na żądanie przy braku nazwy
+WFIRMA_SERIES_TTL = int(os.environ.get('WFIRMA_SERIES_TTL', '3600'))
+WFIRMA_SERIES_MISS_REFRESH_INTERVAL = int(os.environ.get('WFIRMA_SERIES_MISS_REFRESH_INTERVAL', '60'))
+
+# Katalog na lokalne dane (indeksy, cache) - na Render warto podpiąć pod persistent disk
+WFIRMA_DATA_DIR = os.environ.get('WFIRMA_DATA_DIR', 'data')
+
+# Lokalny indeks NIP -> kontrahent (stali klienci bez wywołania contractors/find)
+WFIRMA_CONTRACTOR_INDEX = (os.environ.get('WFIRMA_CONTRACTOR_INDEX', 'true') or '').lower() == 'true'
+WFIRMA_CONTRACTOR_INDEX_MAX_AGE = int(os.environ.get('WFIRMA_CONTRACTOR_INDEX_MAX_AGE', str(7 * 24 * 60 * 60)))
+contractor_index = ContractorIndex(
+    os.path.join(WFIRMA_DATA_DIR, 'contractors.sqlite3'),
+    max_age=WFIRMA_CONTRACTOR_INDEX_MAX_AGE,
+) if WFIRMA_CONTRACTOR_INDEX else None
+
+# Cache wyników GUS po NIP (trwały, osobne TTL dla "znaleziono" i "nie znaleziono")
+GUS_CACHE = (os.environ.get('GUS_CACHE', 'true') or '').lower() == 'true'
+GUS_CACHE_TTL = int(os.environ.get('GUS_CACHE_TTL', str(7 * 24 * 60 * 60)))
+GUS_CACHE_NEGATIVE_TTL = int(os.environ.get('GUS_CACHE_NEGATIVE_TTL', str(6 * 60 * 60)))
+gus_cache = GusResultCache(
+    os.path.join(WFIRMA_DATA_DIR, 'gus_cache.sqlite3'),
+    ttl=GUS_CACHE_TTL,
+    negative_ttl=GUS_CACHE_NEGATIVE_TTL,
+) if GUS_CACHE else None
+
+# Zadania asynchroniczne (workflow z ?async=1): 202 + ID zadania od razu, łańcuch wywołań w puli wątków,
+# postęp i wynik w SQLite (GET /api/jobs/<id>), opcjonalny webhook po zakończeniu.
+JOBS_MAX_WORKERS = int(os.environ.get('JOBS_MAX_WORKERS', '4'))
+JOBS_TTL = int(os.environ.get('JOBS_TTL', str(7 * 24 * 60 * 60)))
+JOBS_STALE_AFTER = int(os.environ.get('JOBS_STALE_AFTER', '600'))
+JOBS_WEBHOOK_SECRET = os.environ.get('JOBS_WEBHOOK_SECRET') or ''
+JOBS_WEBHOOK_TIMEOUT = float(os.environ.get('JOBS_WEBHOOK_TIMEOUT', '10'))
+JOBS_WEBHOOK_RETRIES = int(os.environ.get('JOBS_WEBHOOK_RETRIES', '3'))
+job_store = JobStore(os.path.join(WFIRMA_DATA_DIR, 'jobs.sqlite3'), ttl=JOBS_TTL, stale_after=JOBS_STALE_AFTER)
+job_executor = ThreadPoolExecutor(max_workers=JOBS_MAX_WORKERS, thread_name_prefix='job')
+
+# Idempotencja endpointów tworzących dokumenty: ponowienie z tym samym Idempotency-Key dostaje zapisaną
+# odpowiedź (albo czeka na trwające wykonanie) zamiast tworzyć drugą fakturę.
+# IDEMPOTENCY_BODY_HASH=true - bez nagłówka kluczem jest hash body (identyczne żądania w oknie TTL = jedna faktura).
+IDEMPOTENCY_ENABLED = (os.environ.get('IDEMPOTENCY_ENABLED', 'true') or '').lower() == 'true'
+IDEMPOTENCY_BODY_HASH = (os.environ.get('IDEMPOTENCY_BODY_HASH', 'false') or '').lower() == 'true'
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', str(24 * 60 * 60)))
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.environ.get('IDEMPOTENCY_WAIT_TIMEOUT', '120'))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', '600'))
+# Paczki faktur (/api/workflow/batch-create-invoices): wspólne dane i kontrahenci raz na paczkę,
+# faktury tworzone z ograniczoną współbieżnością (pole "concurrency" w body, najwyżej MAX)
+WORKFLOW_BATCH_MAX_ITEMS = int(os.environ.get('WORKFLOW_BATCH_MAX_ITEMS', '500'))
+WORKFLOW_BATCH_CONCURRENCY = int(os.environ.get('WORKFLOW_BATCH_CONCURRENCY', '4'))
+WORKFLOW_BATCH_MAX_CONCURRENCY = int(os.environ.get('WORKFLOW_BATCH_MAX_CONCURRENCY', '16'))
+
+idempotency_store = IdempotencyStore(
+    os.path.join(WFIRMA_DATA_DIR, 'idempotency.sqlite3'),
+    ttl=IDEMPOTENCY_TTL,
+    lock_timeout=IDEMPOTENCY_LOCK_TIMEOUT,
+) if IDEMPOTENCY_ENABLED else None
 
 # GitHub token do uploadu zdjęć stopki email
 GITHUB_STOPKA_TOKEN = os.environ.get('ADMINZOHO_GITHUB_STOPKA_TOKEN')
@@ -81,10 +225,40 @@ HTML_GENERATOR_API_KEY_TOKEN = os.environ.get('HTML_GENERATOR_API_KEY_TOKEN')
 # Token dla endpointów GUS/REGON (osobny od MAKE_RENDER_API_KEY)
 REGON_API_KEY_TOKEN = os.environ.get('REGON_API_KEY_TOKEN')
 
+# Tokeny w pamięci procesu - odświeżane w tle, gdy do wygaśnięcia zostało mniej niż margines
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_REFRESH_CHECK_INTERVAL = int(os.environ.get('TOKEN_REFRESH_CHECK_INTERVAL', '30'))
+# Gdzie trzymać tokeny: sqlite (WFIRMA_DATA_DIR/tokens.sqlite3, wspólne dla workerów) lub memory
+TOKEN_BACKEND = os.environ.get('TOKEN_BACKEND', 'sqlite').lower()
+
 # Powiadomienia o wygasającym refresh tokenie
 EMAIL_REFRESH_TOKEN_EXPIRE = os.environ.get('EMAIL_REFRESH_TOKEN_EXPIRE')  # Email do powiadomień
 WEBHOOK_TOKEN_EXPIRE_NOTIFY = os.environ.get('WEBHOOK_TOKEN_EXPIRE_NOTIFY')  # URL webhooka (np. Make.com)
 
+# Logowanie: poziom domyślny, progi per kategoria (np. "WFIRMA=DEBUG,STOPKA=OFF"),
+# odsetek logowanych zdarzeń ze ścieżki sukcesu (0-1)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_CATEGORIES = os.environ.get('LOG_CATEGORIES', '')
+LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.1'))
+configure_logging(
+    LOG_LEVEL, LOG_CATEGORIES, LOG_SAMPLE_RATE,
+    # Sekrety z ENV maskowane w logach (klucze API, client secret, tokeny z ENV)
+    secrets=[value for name, value in os.environ.items() if name.endswith(('SECRET', '_API_KEY', '_TOKEN'))],
+)
+log_wfirma = get_logger('WFIRMA')
+log_workflow = get_logger('WORKFLOW')
+log_gus = get_logger('GUS')
+log_token = get_logger('TOKEN')
+log_auth = get_logger('AUTH')
+log_cache = get_logger('CACHE')
+log_stopka = get_logger('STOPKA')
+
+# Metryki: histogramy czasu endpointów i wywołań wFirma/GUS (GET /metrics, format Prometheus)
+# oraz nagłówek Server-Timing z czasami kroków w każdej odpowiedzi
+METRICS_ENABLED = (os.environ.get('METRICS_ENABLED', 'true') or '').lower() == 'true'
+METRICS_SERVER_TIMING = (os.environ.get('METRICS_SERVER_TIMING', 'true') or '').lower() == 'true'
+metrics = Metrics(enabled=METRICS_ENABLED)
+
 # SCOPES per firma - muszą odpowiadać konfiguracji w wFirma!
 SCOPES_MD = [
     # Zgodne z konfiguracją w wFirma dla Medidesk (API_RENDER_ADMIN_ZOHO)
@@ -130,74 +304,33 @@ def get_scopes_for_company(company: str = None) -> list:
 # ==================== FUNKCJE POMOCNICZE ====================
 
 def update_render_env_var(key, value):
+    """Aktualizuje JEDNĄ zmienną środowiskową (patrz update_render_env_vars)."""
+    return update_render_env_vars({key: value})
+
+
+def update_render_env_vars(values: dict):
     """
-    Bezpiecznie aktualizuje JEDNĄ zmienną środowiskową w usłudze Render.
-    Pobiera najpierw wszystkie zmienne, modyfikuje jedną, zapisuje całość.
-    WAŻNE: Również aktualizuje os.environ żeby zmiany były widoczne natychmiast!
+    Aktualizuje zmienne środowiskowe w usłudze Render.
+    WAŻNE: os.environ jest aktualizowane od razu (zmiany widoczne natychmiast),
+    a zapis do Render API odbywa się w tle - wszystkie klucze jednym GET+PUT,
+    z ponawianiem przy błędzie (RenderEnvWriter).
     """
     # ZAWSZE aktualizuj pamięć procesu - nawet jeśli Render API nie jest skonfigurowane
-    os.environ[key] = value
-    print(f"[LOG] update_render_env_var: zaktualizowano os.environ[{key}]")
+    os.environ.update(values)
+    log_token.debug("update_render_env_vars: zaktualizowano os.environ[%s]", ', '.join(values))
     
-    if not RENDER_API_KEY or not RENDER_SERVICE_ID:
-        print(f"[LOG] update_render_env_var: brak RENDER_API_KEY lub RENDER_SERVICE_ID - tylko pamięć lokalna")
+    if not render_env.enabled:
+        log_token.debug("update_render_env_vars: brak RENDER_API_KEY lub RENDER_SERVICE_ID - tylko pamięć lokalna")
         return True  # Zwracamy True bo os.environ zostało zaktualizowane
     
-    url = f"https://api.render.com/v1/services/{RENDER_SERVICE_ID}/env-vars"
-    headers = {
-        "Authorization": f"Bearer {RENDER_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    try:
-        # 1) POBIERZ wszystkie aktualne zmienne
-        get_resp = requests.get(url, headers=headers)
-        if get_resp.status_code != 200:
-            print(f"[LOG] update_render_env_var: błąd GET {get_resp.status_code} {get_resp.text[:200]}")
-            return False
-        
-        current_vars = get_resp.json()  # Lista obiektów [{"envVar": {"key": "X", "value": "Y"}}, ...]
-        print(f"[LOG] update_render_env_var: pobrano {len(current_vars)} zmiennych")
-        
-        # 2) Przekształć na prostą listę do PUT
-        env_list = []
-        key_found = False
-        for item in current_vars:
-            env_var = item.get('envVar', {})
-            existing_key = env_var.get('key')
-            existing_value = env_var.get('value')
-            
-            if existing_key == key:
-                # Aktualizuj tę zmienną
-                env_list.append({"key": key, "value": value})
-                key_found = True
-                print(f"[LOG] update_render_env_var: aktualizuję {key} w Render")
-            else:
-                # Zachowaj bez zmian
-                env_list.append({"key": existing_key, "value": existing_value})
-        
-        # 3) Jeśli zmienna nie istniała - dodaj ją
-        if not key_found:
-            env_list.append({"key": key, "value": value})
-            print(f"[LOG] update_render_env_var: dodaję nową zmienną {key} w Render")
-        
-        # 4) ZAPISZ całą listę (PUT)
-        put_resp = requests.put(url, headers=headers, json=env_list)
-        if put_resp.status_code == 200:
-            print(f"[LOG] update_render_env_var: sukces - zaktualizowano {key} w Render")
-            return True
-        else:
-            print(f"[LOG] update_render_env_var: błąd PUT {put_resp.status_code} {put_resp.text[:200]}")
-            return False
-            
-    except Exception as e:
-        print(f"[LOG] update_render_env_var: wyjątek {e}")
-        return False
+    render_env.submit(values)
+    return True
 
 def save_token(access_token, expires_in, refresh_token=None, company=None):
     """
-    Zapisz token do ENV (główne źródło) i pliku (backup).
-    ENV jest JEDYNYM trwałym storage po redeployu!
+    Zapisz token do TokenStore (pamięć + backend główny, np. SQLite współdzielony przez workery),
+    a w tle do ENV/Render i pliku (backup).
+    ENV jest JEDYNYM trwałym storage po redeployu (bez persistent disk)!
     
     Args:
         access_token: Token dostępu
@@ -210,132 +343,52 @@ def save_token(access_token, expires_in, refresh_token=None, company=None):
     
     expires_at = int(time.time() + expires_in - 60)  # 60 sek margines, jako int
     
-    # Pobierz istniejący refresh_token jeśli nowy nie podany
-    final_refresh_token = refresh_token
-    if not final_refresh_token:
-        # Priorytet: plik > ENV (tylko dla domyślnej firmy)
-        if company is None and os.path.exists(TOKEN_FILE):
-            try:
-                with open(TOKEN_FILE, 'r') as f:
-                    old_data = json.load(f)
-                    final_refresh_token = old_data.get('refresh_token')
-            except:
-                pass
-        if not final_refresh_token:
-            final_refresh_token = config['refresh_token']
+    # Pobierz istniejący refresh_token jeśli nowy nie podany (z pamięci procesu)
+    final_refresh_token = refresh_token or token_store.snapshot(prefix)['refresh_token']
+    # Nowy refresh token (z /auth lub rotacji) = nowe 30 dni ważności
+    refresh_expires_at = int(time.time() + 30 * 24 * 60 * 60) if refresh_token else None
     
-    print(f"[LOG] [{config['company'].upper()}] save_token: access={access_token[:20]}..., refresh={bool(final_refresh_token)}, expires_at={expires_at}")
-    
-    # 1. Zapisz do PLIKU (lokalny cache - tylko dla domyślnej firmy, backward compatibility)
-    if company is None:
-        token_data = {
-            'access_token': access_token,
-            'expires_at': expires_at,
-            'refresh_token': final_refresh_token
-        }
-        try:
-            with open(TOKEN_FILE, 'w') as f:
-                json.dump(token_data, f)
-            print(f"[LOG] Token zapisany do pliku")
-        except Exception as e:
-            print(f"[ERROR] Nie można zapisać tokenu do pliku: {e}")
+    log_token.info("[%s] save_token: refresh=%s, expires_at=%s", config['company'].upper(), bool(final_refresh_token), expires_at)
     
-    # 2. Zapisz do ENV (trwałe po redeployu) - z odpowiednim prefixem dla firmy!
-    if final_refresh_token:
-        update_render_env_var(f"{prefix}REFRESH_TOKEN", final_refresh_token)
-    update_render_env_var(f"{prefix}ACCESS_TOKEN", access_token)
-    update_render_env_var(f"{prefix}TOKEN_EXPIRES", str(expires_at))
+    # Pamięć procesu + backend główny (od tej chwili requesty używają nowego tokenu),
+    # ENV/Render i plik wfirma_token.json są aktualizowane w tle (TokenStore)
+    token_store.update(prefix, access_token, expires_at, final_refresh_token, refresh_expires_at)
     
-    # 3. Jeśli to NOWY refresh_token (z /auth), zapisz też jego termin ważności (30 dni)
-    if refresh_token:  # Nowy refresh token = nowe 30 dni
-        refresh_expires_at = int(time.time() + 30 * 24 * 60 * 60)  # 30 dni od teraz
-        update_render_env_var(f"{prefix}REFRESH_TOKEN_EXPIRES", str(refresh_expires_at))
-        print(f"[LOG] [{config['company'].upper()}] Nowy refresh_token ważny do: {datetime.datetime.fromtimestamp(refresh_expires_at).strftime('%Y-%m-%d %H:%M')}")
+    if refresh_expires_at:
+        log_token.info("[%s] Nowy refresh_token ważny do: %s", config['company'].upper(), datetime.datetime.fromtimestamp(refresh_expires_at).strftime('%Y-%m-%d %H:%M'))
 
 def refresh_access_token(forced_refresh_token=None, company=None):
     """
-    Odśwież token używając refresh_token (z pliku lub argumentu).
+    Odśwież token używając refresh_token (z pamięci procesu lub argumentu).
     
-    WAŻNE: Zawiera blokadę na równoczesne odświeżanie - zapobiega race condition
-    gdy wiele requestów próbuje odświeżyć token jednocześnie.
+    WAŻNE: Odświeżanie jest single-flight (blokada w procesie + blokada pliku między
+    workerami) - przy wielu równoczesnych requestach z wygasłym tokenem tylko jeden
+    wywołuje oauth2/token, pozostałe czekają i używają jego wyniku.
     
     Args:
         forced_refresh_token: Wymuszony refresh token
         company: Firma/zestaw danych ('md' lub 'test')
     """
+    return token_store.refresh_single_flight(
+        token_key(company),
+        lambda: refresh_access_token_now(forced_refresh_token, company),
+    )
+
+
+def refresh_access_token_now(forced_refresh_token=None, company=None):
+    """Wywołanie oauth2/token (bez blokady - używać przez refresh_access_token)."""
     config = get_company_config(company)
     prefix = config['prefix']
     
-    # BLOKADA: Sprawdź czy ktoś inny właśnie odświeża token
-    # Jeśli ostatni refresh był < 30 sekund temu, poczekaj i sprawdź czy token jest już ważny
-    last_refresh_key = f"{prefix}LAST_REFRESH"
-    last_refresh_str = os.environ.get(last_refresh_key, '0')
-    try:
-        last_refresh_time = int(last_refresh_str)
-    except:
-        last_refresh_time = 0
-    
-    current_time = int(time.time())
-    time_since_refresh = current_time - last_refresh_time
-    
-    if time_since_refresh < 30:
-        # Ktoś inny mógł właśnie odświeżyć - poczekaj i sprawdź
-        print(f"[LOG] [{config['company'].upper()}] Ostatni refresh był {time_since_refresh}s temu - czekam na zakończenie...")
-        import time as time_module
-        time_module.sleep(3)  # Poczekaj 3 sekundy
-        
-        # Odśwież ENV z Render (pobierz najnowsze wartości)
-        if RENDER_API_KEY and RENDER_SERVICE_ID:
-            try:
-                url = f"https://api.render.com/v1/services/{RENDER_SERVICE_ID}/env-vars"
-                headers = {"Authorization": f"Bearer {RENDER_API_KEY}"}
-                resp = requests.get(url, headers=headers)
-                if resp.status_code == 200:
-                    for item in resp.json():
-                        env_var = item.get('envVar', {})
-                        key = env_var.get('key')
-                        value = env_var.get('value')
-                        if key and key.startswith(prefix):
-                            os.environ[key] = value
-                    print(f"[LOG] [{config['company'].upper()}] Odświeżono ENV z Render")
-            except Exception as e:
-                print(f"[LOG] [{config['company'].upper()}] Błąd pobierania ENV z Render: {e}")
-        
-        # Sprawdź czy token jest już ważny (odświeżony przez inny proces)
-        token_expires_str = os.environ.get(f"{prefix}TOKEN_EXPIRES", '0')
-        try:
-            token_expires = int(token_expires_str)
-            if token_expires > current_time + 60:  # Ważny jeszcze co najmniej 60s
-                access_token = os.environ.get(f"{prefix}ACCESS_TOKEN")
-                if access_token:
-                    print(f"[LOG] [{config['company'].upper()}] Token został odświeżony przez inny proces - używam go")
-                    return access_token
-        except:
-            pass
-    
-    # Oznacz że zaczynamy refresh (blokada dla innych procesów)
-    os.environ[last_refresh_key] = str(current_time)
-    update_render_env_var(last_refresh_key, str(current_time))
-    
-    refresh_token = forced_refresh_token
-    if not refresh_token and company is None and os.path.exists(TOKEN_FILE):
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                data = json.load(f)
-                refresh_token = data.get('refresh_token')
-        except:
-            pass
-            
-    # Fallback: sprawdź zmienną środowiskową dla danej firmy
-    if not refresh_token:
-        refresh_token = config['refresh_token']
+    # Refresh token: wymuszony albo aktualny z pamięci procesu (seed: ENV / plik)
+    refresh_token = forced_refresh_token or token_store.snapshot(prefix)['refresh_token']
         
     if not refresh_token:
-        print(f"[LOG] [{config['company'].upper()}] Brak refresh tokena, nie można odświeżyć sesji")
+        log_token.info("[%s] Brak refresh tokena, nie można odświeżyć sesji", config['company'].upper())
         return None
         
-    print(f"[LOG] [{config['company'].upper()}] Próba odświeżenia tokenu...")
-    token_url = "https://api2.wfirma.pl/oauth2/token"
+    log_token.info("[%s] Próba odświeżenia tokenu...", config['company'].upper())
+    token_url = f"{WFIRMA_API_URL}/oauth2/token"
     payload = {
         'grant_type': 'refresh_token',
         'client_id': config['client_id'],
@@ -344,9 +397,9 @@ def refresh_access_token(forced_refresh_token=None, company=None):
     }
     
     try:
-        print(f"[LOG] [{config['company'].upper()}] Refresh payload keys: {list(payload.keys())}")
-        response = requests.post(token_url, data=payload)
-        print(f"[LOG] [{config['company'].upper()}] Refresh response status: {response.status_code}")
+        log_token.debug("[%s] Refresh payload keys: %s", config['company'].upper(), list(payload.keys()))
+        response = wfirma_http('POST', token_url, company, data=payload)
+        log_token.debug("[%s] Refresh response status: %s", config['company'].upper(), response.status_code)
         
         if response.status_code == 200:
             new_tokens = response.json()
@@ -355,19 +408,19 @@ def refresh_access_token(forced_refresh_token=None, company=None):
             expires_in = int(new_tokens.get('expires_in', 3600))
             
             # LOG: sprawdź czy wFirma zwraca nowy refresh_token
-            print(f"[LOG] [{config['company'].upper()}] Refresh response: access={bool(new_access)}, refresh={bool(new_refresh)}, expires={expires_in}")
+            log_token.debug("[%s] Refresh response: access=%s, refresh=%s, expires=%s", config['company'].upper(), bool(new_access), bool(new_refresh), expires_in)
             
             if new_access:
                 # WAŻNE: Zapisujemy nowe tokeny NATYCHMIAST (przed jakimkolwiek returnem)
                 save_token(new_access, expires_in, new_refresh, company=company)
-                print(f"[LOG] [{config['company'].upper()}] Token odświeżony pomyślnie i zapisany do ENV")
+                log_token.info("[%s] Token odświeżony pomyślnie i zapisany do ENV", config['company'].upper())
                 return new_access
             else:
-                print(f"[LOG] [{config['company'].upper()}] Brak access_token w odpowiedzi: {new_tokens}")
+                log_token.warning("[%s] Brak access_token w odpowiedzi: %s", config['company'].upper(), new_tokens)
         else:
-            print(f"[LOG] [{config['company'].upper()}] Błąd API refresh token: {response.status_code} {response.text}")
+            log_token.warning("[%s] Błąd API refresh token: %s %s", config['company'].upper(), response.status_code, response.text)
     except Exception as e:
-        print(f"[LOG] [{config['company'].upper()}] Błąd podczas odświeżania tokenu: {e}")
+        log_token.warning("[%s] Błąd podczas odświeżania tokenu: %s", config['company'].upper(), e)
         
     return None
 
@@ -377,28 +430,8 @@ def is_token_valid():
 
 
 def is_token_valid_for_company(company=None):
-    """Sprawdź czy zapisany token jest ważny dla danej firmy (ENV > plik)"""
-    config = get_company_config(company)
-    
-    # 1. Sprawdź ENV dla danej firmy (priorytet - trwałe po redeployu)
-    env_expires = config['token_expires']
-    env_access = config['access_token']
-    if env_expires and env_access:
-        try:
-            return time.time() < float(env_expires)
-        except:
-            pass
-    
-    # 2. Fallback: sprawdź plik (tylko dla domyślnej firmy - backward compatibility)
-    if company is None and os.path.exists(TOKEN_FILE):
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                token_data = json.load(f)
-            return time.time() < token_data.get('expires_at', 0)
-        except:
-            pass
-    
-    return False
+    """Sprawdź czy token danej firmy jest ważny (stan w pamięci procesu, bez czytania ENV/pliku)"""
+    return token_store.is_valid(token_key(company))
 
 
 def check_refresh_token_expiry():
@@ -415,12 +448,8 @@ def check_refresh_token_expiry_for_company(company=None):
     Zwraca (days_remaining, warning_message) lub (None, None) jeśli brak danych.
     """
     config = get_company_config(company)
-    prefix = config['prefix']
     
-    refresh_expires = os.environ.get(f'{prefix}REFRESH_TOKEN_EXPIRES')
-    if not refresh_expires:
-        # Fallback na starą zmienną (backward compatibility)
-        refresh_expires = os.environ.get('WFIRMA_REFRESH_TOKEN_EXPIRES')
+    refresh_expires = token_store.snapshot(config['prefix'])['refresh_expires_at']
     if not refresh_expires:
         return None, None
     
@@ -454,29 +483,25 @@ def get_token_status():
 def get_token_status_for_company(company=None):
     """Zwraca pełny status tokenów dla danej firmy (do endpointu /api/token/status)"""
     config = get_company_config(company)
-    prefix = config['prefix']
+    tokens = token_store.snapshot(config['prefix'])
     
     status = {
         'company': config['company'],
         'access_token_valid': is_token_valid_for_company(company),
-        'refresh_token_exists': bool(config['refresh_token']),
+        'refresh_token_exists': bool(tokens['refresh_token']),
     }
     
     # Access token
-    env_expires = config['token_expires']
-    if env_expires:
-        try:
-            expires_at = float(env_expires)
-            status['access_token_expires_at'] = expires_at
-            status['access_token_remaining_seconds'] = max(0, int(expires_at - time.time()))
-        except:
-            pass
+    if tokens['expires_at']:
+        expires_at = tokens['expires_at']
+        status['access_token_expires_at'] = expires_at
+        status['access_token_remaining_seconds'] = max(0, int(expires_at - time.time()))
     
     # Refresh token
     days_remaining, warning = check_refresh_token_expiry_for_company(company)
     if days_remaining is not None:
         status['refresh_token_days_remaining'] = round(days_remaining, 1)
-        status['refresh_token_expires_at'] = os.environ.get(f'{prefix}REFRESH_TOKEN_EXPIRES')
+        status['refresh_token_expires_at'] = tokens['refresh_expires_at']
     if warning:
         status['warning'] = warning
     
@@ -502,7 +527,7 @@ def send_token_expiry_notification(days_remaining, warning_message):
     webhook_url = WEBHOOK_TOKEN_EXPIRE_NOTIFY
     
     if not email and not webhook_url:
-        print("[LOG] Brak konfiguracji powiadomień (EMAIL_REFRESH_TOKEN_EXPIRE lub WEBHOOK_TOKEN_EXPIRE_NOTIFY)")
+        log_token.info("Brak konfiguracji powiadomień (EMAIL_REFRESH_TOKEN_EXPIRE lub WEBHOOK_TOKEN_EXPIRE_NOTIFY)")
         return False
     
     notification_data = {
@@ -520,19 +545,19 @@ def send_token_expiry_notification(days_remaining, warning_message):
         try:
             resp = requests.post(webhook_url, json=notification_data, timeout=10)
             if resp.status_code in [200, 201, 202]:
-                print(f"[LOG] Powiadomienie wysłane przez webhook: {warning_message}")
+                log_token.info("Powiadomienie wysłane przez webhook: %s", warning_message)
                 _notification_sent_for_days = threshold
                 return True
             else:
-                print(f"[LOG] Błąd webhooka: {resp.status_code} {resp.text[:200]}")
+                log_token.warning("Błąd webhooka: %s %s", resp.status_code, resp.text[:200])
         except Exception as e:
-            print(f"[LOG] Błąd wysyłania webhooka: {e}")
+            log_token.warning("Błąd wysyłania webhooka: %s", e)
     
     # Opcja 2: Email przez prosty POST do serwisu (np. formspree, emailjs)
     # Na razie tylko logujemy - user może skonfigurować webhook do Make.com
     if email and not webhook_url:
-        print(f"[LOG] Powiadomienie email do {email}: {warning_message}")
-        print(f"[LOG] Skonfiguruj WEBHOOK_TOKEN_EXPIRE_NOTIFY żeby automatycznie wysyłać emaile przez Make.com")
+        log_token.info("Powiadomienie email do %s: %s", email, warning_message)
+        log_token.info("Skonfiguruj WEBHOOK_TOKEN_EXPIRE_NOTIFY żeby automatycznie wysyłać emaile przez Make.com")
         _notification_sent_for_days = threshold
         return True
     
@@ -540,77 +565,86 @@ def send_token_expiry_notification(days_remaining, warning_message):
 
 def load_token(silent=False, company=None):
     """
-    Wczytaj token (ENV > plik) - automatycznie odświeża jeśli wygasł.
-    Po redeployu plik nie istnieje, więc ENV jest GŁÓWNYM źródłem!
+    Zwróć ważny access token z pamięci procesu (TokenStore).
+    ENV / plik są czytane przy pierwszym użyciu, a token odświeża się w tle
+    przed wygaśnięciem. Przy braku tokenu w pamięci TokenStore sprawdza backend główny
+    (token mógł zapisać inny worker, np. po /callback). Synchroniczne odświeżenie tylko gdy token już wygasł
+    (np. instancja była uśpiona dłużej niż ważność tokenu).
     
     Args:
         silent: Czy ukrywać logi
         company: Firma/zestaw danych ('md' lub 'test'). Jeśli None - używa domyślnego.
     """
     config = get_company_config(company)
-    prefix = config['prefix']
-    
-    access_token = None
-    expires_at = 0
-    refresh_token = None
-    
-    # 1. NAJPIERW sprawdź ENV dla danej firmy (trwałe po redeployu!)
-    env_access = config['access_token']
-    env_expires = config['token_expires']
-    env_refresh = config['refresh_token']
-    
-    if env_access and env_expires:
-        try:
-            access_token = env_access
-            expires_at = float(env_expires)
-            refresh_token = env_refresh
-            if not silent:
-                print(f"[LOG] [{config['company'].upper()}] Tokeny wczytane z ENV ({prefix}*)")
-        except:
-            pass
-    
-    # 2. Jeśli brak w ENV, sprawdź plik (tylko dla domyślnej firmy - backward compatibility)
-    if not access_token and company is None and os.path.exists(TOKEN_FILE):
-        try:
-            with open(TOKEN_FILE, 'r') as f:
-                token_data = json.load(f)
-            access_token = token_data.get('access_token')
-            expires_at = token_data.get('expires_at', 0)
-            refresh_token = token_data.get('refresh_token') or env_refresh
-            if not silent:
-                print(f"[LOG] Tokeny wczytane z pliku")
-        except Exception as e:
-            if not silent:
-                print(f"[LOG] Błąd wczytywania z pliku: {e}")
+    key = config['prefix']
     
-    # 3. Jeśli token ważny - zwróć
-    if access_token and time.time() < expires_at:
-        remaining = int(expires_at - time.time())
-        if not silent:
-            print(f"[LOG] [{config['company'].upper()}] ✓ Token ważny jeszcze {remaining} sekund")
+    access_token = token_store.access_token(key)
+    if access_token:
         return access_token
     
-    # 4. Token wygasł lub brak - spróbuj odświeżyć
-    if not refresh_token:
-        refresh_token = env_refresh  # Ostatnia szansa - ENV
-    
+    # Token wygasł lub brak - spróbuj odświeżyć
+    refresh_token = token_store.snapshot(key)['refresh_token']
     if refresh_token:
         if not silent:
-            print(f"[LOG] [{config['company'].upper()}] Token wygasł/brak, próba odświeżenia...")
-        new_token = refresh_access_token(forced_refresh_token=refresh_token, company=company)
+            log_token.info("[%s] Token wygasł/brak, próba odświeżenia...", config['company'].upper())
+        new_token = refresh_access_token(company=company)
         if new_token:
             return new_token
     
     if not silent:
-        print(f"[LOG] [{config['company'].upper()}] Brak tokenu i refresh_token - wymagana autoryzacja /auth")
+        log_token.info("[%s] Brak tokenu i refresh_token - wymagana autoryzacja /auth", config['company'].upper())
     return None
 
+
+def token_key(company: str = None) -> str:
+    """Klucz w TokenStore = prefix ENV (md i md_test współdzielą tokeny)."""
+    return get_company_config(company)['prefix']
+
+
+def company_for_token_key(key: str) -> str:
+    """Pierwsza firma używająca danego prefixu ENV."""
+    for company in SUPPORTED_COMPANIES:
+        if get_company_config(company)['prefix'] == key:
+            return company
+    return DEFAULT_COMPANY
+
+
+def refresh_token_for_key(key: str) -> str | None:
+    """Odświeżenie w tle (wywoływane przez TokenStore)."""
+    return refresh_access_token(company=company_for_token_key(key))
+
+
+def build_token_backend(kind: str):
+    """Backend główny tokenów: 'sqlite' (domyślny, współdzielony przez workery) lub 'memory'."""
+    if kind == 'memory':
+        return MemoryTokenBackend()
+    if kind != 'sqlite':
+        log_token.warning("Nieznany TOKEN_BACKEND=%r - używam sqlite", kind)
+    return SqliteTokenBackend(os.path.join(WFIRMA_DATA_DIR, 'tokens.sqlite3'))
+
+
+token_store = TokenStore(
+    refresh=refresh_token_for_key,
+    primary=build_token_backend(TOKEN_BACKEND),
+    secondary=[
+        # ENV - jedyny trwały storage po redeployu na Render (zapis do Render API w tle)
+        EnvTokenBackend(update_render_env_vars),
+        # Plik wfirma_token.json - backward compatibility (tylko domyślna firma)
+        JsonFileTokenBackend(TOKEN_FILE, token_key(DEFAULT_COMPANY)),
+    ],
+    refresh_margin=TOKEN_REFRESH_MARGIN,
+    check_interval=TOKEN_REFRESH_CHECK_INTERVAL,
+    lock_dir=WFIRMA_DATA_DIR,
+)
+atexit.register(token_store.flush, 10)  # atexit: LIFO - przed render_env.flush
+
+
 def require_token(f):
     """Decorator wymagający ważnego tokenu"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         token = load_token(silent=True)
-        if not token or not is_token_valid():
+        if not token:
             return jsonify({
                 'error': 'Brak autoryzacji',
                 'message': 'Przejdź do /auth aby się zalogować'
@@ -625,7 +659,7 @@ def require_api_key(f):
     def decorated_function(*args, **kwargs):
         # Jeśli MAKE_RENDER_API_KEY nie jest ustawiony w ENV - pomijamy weryfikację (dev mode)
         if not MAKE_RENDER_API_KEY:
-            print("[WARNING] MAKE_RENDER_API_KEY nie jest ustawiony - brak ochrony API!")
+            log_auth.warning("MAKE_RENDER_API_KEY nie jest ustawiony - brak ochrony API!")
             return f(*args, **kwargs)
         
         # Sprawdź header X-API-Key
@@ -647,6 +681,97 @@ def require_api_key(f):
     return decorated_function
 
 
+# Nagłówki odpowiedzi zapisywane razem z treścią i odtwarzane dla powtórzonego klucza
+IDEMPOTENCY_STORED_HEADERS = ('Content-Type', 'Content-Disposition', 'Location')
+# Błędy walidacji żądania - powtórka z tym samym body dałaby ten sam wynik, więc zapisujemy
+IDEMPOTENCY_STORED_ERRORS = (400, 413, 415, 422)
+
+
+def idempotency_should_store(response: Response) -> bool:
+    """
+    Czy zapisać odpowiedź pod kluczem idempotencji. Tak - gdy dokument powstał (2xx albo błąd
+    po utworzeniu faktury: mail, PDF) lub dla deterministycznego błędu walidacji. Nie - dla błędów
+    przed utworzeniem faktury (401, 5xx, błąd kontrahenta, GUS 404, odpowiedź wFirma z błędem),
+    żeby ponowienie z tym samym kluczem wykonało żądanie od nowa.
+    """
+    payload = response.get_json(silent=True) if response.is_json else None
+    if not isinstance(payload, dict):
+        return 200 <= response.status_code < 300
+    if payload.get('invoice') or payload.get('invoice_id') or payload.get('correction_invoice'):
+        return True
+    if payload.get('error'):
+        # Błąd z odpowiedzią wFirma (details/status) zależy od stanu po stronie wFirma, nie od body
+        return (response.status_code in IDEMPOTENCY_STORED_ERRORS
+                and 'details' not in payload and 'status' not in payload)
+    return 200 <= response.status_code < 300
+
+
+def idempotent(f):
+    """
+    Decorator idempotencji (po autoryzacji): klucz z nagłówka Idempotency-Key (albo hash body przy
+    IDEMPOTENCY_BODY_HASH=true), zakres = ścieżka endpointu. Zakończone wykonanie -> zapisana odpowiedź
+    z nagłówkiem Idempotent-Replayed: true (tylko gdy faktura powstała albo błąd walidacji - patrz
+    idempotency_should_store); trwające -> czekamy do IDEMPOTENCY_WAIT_TIMEOUT (potem 409);
+    ten sam klucz z innym żądaniem -> 422.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        # Zadanie ?async=1 zostało już zdeduplikowane przy przyjęciu (odtwarza request wewnętrznie)
+        if idempotency_store is None or request.environ.get('wfirma.job_id'):
+            return f(*args, **kwargs)
+
+        body = request.get_data(cache=True)
+        fingerprint = hashlib.sha256(
+            request.method.encode('ascii') + b' ' + request.full_path.encode('utf-8') + b'\n' + body
+        ).hexdigest()
+        key = (request.headers.get('Idempotency-Key') or '').strip()
+        if not key:
+            if not IDEMPOTENCY_BODY_HASH:
+                return f(*args, **kwargs)
+            key = f'body:{fingerprint}'
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key może mieć najwyżej 255 znaków'}), 400
+
+        scope = request.path
+        state, stored = idempotency_store.acquire(scope, key, fingerprint, wait=IDEMPOTENCY_WAIT_TIMEOUT)
+        if state == 'mismatch':
+            return jsonify({
+                'error': 'Idempotency-Key użyty wcześniej z innym żądaniem',
+                'idempotency_key': key
+            }), 422
+        if state == 'pending':
+            response = jsonify({
+                'error': 'Żądanie z tym Idempotency-Key jest nadal przetwarzane',
+                'idempotency_key': key
+            })
+            response.headers['Retry-After'] = '5'
+            return response, 409
+        if state == 'done':
+            log_workflow.info("Idempotency-Key %s: odtworzona odpowiedź (HTTP %s)", key, stored['status'], extra=SAMPLED)
+            response = Response(stored['body'], status=stored['status'], headers=stored['headers'])
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = app.make_response(f(*args, **kwargs))
+            if response.is_streamed:
+                # Odpowiedź strumieniowa (np. multipart z PDF) - zapisujemy całość, żeby ją odtworzyć
+                response.direct_passthrough = False
+            data = response.get_data()
+        except BaseException:
+            idempotency_store.release(scope, key)
+            raise
+        if not idempotency_should_store(response):
+            log_workflow.info("Idempotency-Key %s: odpowiedź HTTP %s bez zapisu (ponowienie wykona żądanie)",
+                              key, response.status_code, extra=SAMPLED)
+            idempotency_store.release(scope, key)
+            return response
+        headers = {name: response.headers[name] for name in IDEMPOTENCY_STORED_HEADERS if name in response.headers}
+        idempotency_store.complete(scope, key, response.status_code, headers, data)
+        return response
+    return decorated_function
+
+
 # ==================== POMOCNICZE: WFIRMA (kontrahenci, faktury, PDF, mail) ====================
 
 
@@ -662,13 +787,46 @@ def get_wfirma_headers(token: str, accept: str = "application/json", with_conten
     return headers
 
 
-def wfirma_find_contractor_by_nip(token: str, nip: str, company_id: str = None) -> tuple[dict | None, requests.Response | None]:
+def wfirma_http(method: str, url: str, company: str = None, **kwargs) -> requests.Response:
+    """
+    Wywołanie API wFirma przez współdzieloną sesję keep-alive danej firmy.
+    Domyślny timeout ustawia rejestr sesji (WFIRMA_HTTP_*_TIMEOUT).
+    """
+    company = (company or DEFAULT_COMPANY).lower().strip()
+    if company not in SUPPORTED_COMPANIES:
+        company = DEFAULT_COMPANY
+    with metrics.timed('wfirma', wfirma_step(url)) as call:
+        resp = wfirma_sessions.request(company, method, url, **kwargs)
+        record_http_call(call, resp, stream=kwargs.get('stream', False))
+    return resp
+
+
+def wfirma_step(url: str) -> str:
+    """Nazwa kroku do metryk: moduł/akcja wFirma z URL, bez ID i parametrów (np. invoices/download)."""
+    path = url[len(WFIRMA_API_URL):] if url.startswith(WFIRMA_API_URL) else urlsplit(url).path
+    return '/'.join(path.split('?', 1)[0].strip('/').split('/')[:2]) or '/'
+
+
+def record_http_call(call, resp: requests.Response, stream: bool = False) -> None:
+    """Uzupełnij pomiar wywołania: bajty wysłane/odebrane i błąd HTTP (status >= 400)."""
+    body = resp.request.body if resp.request is not None else None
+    call.sent = len(body) if body else 0
+    if stream:
+        # Treść strumienia nie jest jeszcze pobrana - liczymy z Content-Length
+        call.received = int(resp.headers.get('Content-Length') or 0)
+    else:
+        call.received = len(resp.content or b'')
+    if resp.status_code >= 400:
+        call.error = f'http_{resp.status_code}'
+
+
+def wfirma_find_contractor_by_nip(token: str, nip: str, company_id: str = None, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """Znajdź kontrahenta po NIP; zwraca (contractor_dict|None, response)."""
     clean_nip = nip.replace("-", "").replace(" ", "")
-    api_url = "https://api2.wfirma.pl/contractors/find?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/contractors/find?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
-    print(f"[WFIRMA DEBUG] find_contractor URL: {api_url}")
+    log_wfirma.debug("find_contractor URL: %s", api_url)
     headers = get_wfirma_headers(token)
     search_data = {
         "contractors": {
@@ -685,31 +843,34 @@ def wfirma_find_contractor_by_nip(token: str, nip: str, company_id: str = None)
     }
     resp = None
     try:
-        resp = requests.post(api_url, headers=headers, json=search_data)
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=search_data)
         if resp.status_code == 200:
             data = resp.json()
             contractors = data.get('contractors', {})
             if contractors and isinstance(contractors, dict):
                 for key in contractors:
                     if key.isdigit():
-                        return contractors[key].get('contractor'), resp
+                        contractor = contractors[key].get('contractor')
+                        contractor_index_store(company, contractor, clean_nip)
+                        return contractor, resp
                 if 'contractor' in contractors:
+                    contractor_index_store(company, contractors['contractor'], clean_nip)
                     return contractors['contractor'], resp
         return None, resp
     except Exception:
         return None, resp
 
 
-def wfirma_add_contractor(token: str, contractor_payload: dict, company_id: str = None) -> tuple[dict | None, requests.Response | None]:
+def wfirma_add_contractor(token: str, contractor_payload: dict, company_id: str = None, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """Dodaj kontrahenta; zwraca (contractor_dict|None, response)."""
-    api_url = "https://api2.wfirma.pl/contractors/add?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/contractors/add?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     headers = get_wfirma_headers(token)
     resp = None
     try:
         # KLUCZOWE: Wrapper "contractors"!
-        resp = requests.post(api_url, headers=headers, json={"contractors": {"contractor": contractor_payload}})
+        resp = wfirma_http('POST', api_url, company, headers=headers, json={"contractors": {"contractor": contractor_payload}})
         if resp.status_code == 200:
             result = resp.json()
             # Odpowiedź: contractors.0.contractor
@@ -721,6 +882,7 @@ def wfirma_add_contractor(token: str, contractor_payload: dict, company_id: str
                         if not contractor:
                             contractor = contractors[key]
                         if contractor:
+                            contractor_index_store(company, contractor, contractor_payload.get('nip'))
                             return contractor, resp
             return None, resp
         return None, resp
@@ -728,12 +890,117 @@ def wfirma_add_contractor(token: str, contractor_payload: dict, company_id: str
         return None, resp
 
 
+def contractor_payload_from_gus(gus_record: dict, clean_nip: str) -> dict:
+    """Payload contractors/add z rekordu GUS (adres w formacie wFirma: "ulica nr/lokal")."""
+    street_base = gus_record.get('ulica') or ""
+    nr_domu = gus_record.get('nrNieruchomosci') or ""
+    nr_lokalu = gus_record.get('nrLokalu') or ""
+
+    if street_base and nr_domu and nr_lokalu:
+        street_full = f"{street_base} {nr_domu}/{nr_lokalu}"
+    elif street_base and nr_domu:
+        street_full = f"{street_base} {nr_domu}"
+    else:
+        street_full = street_base
+
+    return {
+        "name": gus_record.get('nazwa') or clean_nip,
+        "altname": gus_record.get('nazwa') or clean_nip,
+        "nip": clean_nip,
+        "tax_id_type": "nip",
+        "street": street_full,
+        "zip": gus_record.get('kodPocztowy') or "",
+        "city": gus_record.get('miejscowosc') or "",
+        "country": "PL",
+    }
+
+
+def contractor_payload_from_purchaser(name: str, address: str, zip_code: str, city: str,
+                                      clean_nip: str | None = None) -> dict:
+    """Payload contractors/add z danych purchaser z wywołania (bez NIP - osoba fizyczna)."""
+    payload = {"name": name, "altname": name}
+    if clean_nip:
+        payload.update({"nip": clean_nip, "tax_id_type": "nip"})  # Zachowaj NIP nawet jeśli GUS go nie zna
+    else:
+        payload["tax_id_type"] = "none"  # Osoba fizyczna bez NIP
+    payload.update({
+        "street": address or "-",
+        "zip": zip_code or "00-000",
+        "city": city or "-",
+        "country": "PL",
+    })
+    return payload
+
+
+def contractor_index_store(company: str, contractor: dict | None, nip: str = None) -> None:
+    """Zapisz kontrahenta do lokalnego indeksu NIP (błędy indeksu nie psują wywołań API)."""
+    if contractor_index is None or not contractor:
+        return
+    try:
+        contractor_index.put((company or DEFAULT_COMPANY).lower().strip(), contractor, nip)
+    except Exception as e:
+        log_cache.warning("Nie udało się zapisać kontrahenta do indeksu: %s", e)
+
+
+def wfirma_list_contractors_page(token: str, page: int = 1, limit: int = 100, company_id: str = None, company: str = None) -> tuple[list[dict] | None, int | None]:
+    """
+    Pobierz jedną stronę kontrahentów (contractors/find bez warunków).
+    Zwraca (lista kontrahentów | None przy błędzie, łączna liczba kontrahentów | None).
+    """
+    api_url = f"{WFIRMA_API_URL}/contractors/find?inputFormat=json&outputFormat=json&oauth_version=2"
+    if company_id:
+        api_url += f"&company_id={company_id}"
+    headers = get_wfirma_headers(token)
+    search_data = {"contractors": {"parameters": {"page": page, "limit": limit}}}
+    try:
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=search_data)
+        if resp.status_code != 200:
+            log_wfirma.debug("list_contractors page=%s HTTP %s: %.300s", page, resp.status_code, lazy(lambda: resp.text))
+            return None, None
+        data = resp.json()
+        result = []
+        contractors = data.get('contractors', {})
+        if isinstance(contractors, dict):
+            for key in contractors:
+                if key.isdigit():
+                    contractor = contractors[key].get('contractor')
+                    if contractor:
+                        result.append(contractor)
+        total = None
+        try:
+            total = int(contractors.get('parameters', {}).get('total'))
+        except (AttributeError, TypeError, ValueError):
+            pass
+        return result, total
+    except Exception as e:
+        log_wfirma.warning("list_contractors exception: %s", e)
+        return None, None
+
+
+def warm_up_contractor_index(token: str, company: str = None, company_id: str = None, limit: int = 100, max_pages: int = 1000) -> int:
+    """
+    Hurtowo wypełnij indeks NIP -> kontrahent, stronicując contractors/find.
+    Zwraca liczbę zapisanych kontrahentów (pomija tych bez NIP).
+    """
+    company = (company or DEFAULT_COMPANY).lower().strip()
+    saved = 0
+    for page in range(1, max_pages + 1):
+        contractors, total = wfirma_list_contractors_page(token, page, limit, company_id, company)
+        if not contractors:
+            break
+        saved += contractor_index.put_many(company, contractors)
+        log_cache.info("Warm-up indeksu kontrahentów (%s): strona %s, zapisano łącznie %s", company, page, saved)
+        if len(contractors) < limit or (total is not None and page * limit >= total):
+            break
+    return saved
+
+
 # ==================== POMOCNICZE: PRODUKTY (GOODS) ====================
 
 
-def wfirma_find_good_by_name(token: str, name: str) -> tuple[dict | None, requests.Response | None]:
+def wfirma_find_good_by_name(token: str, name: str, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """Znajdź produkt po nazwie; zwraca (good_dict|None, response)."""
-    api_url = "https://api2.wfirma.pl/goods/find?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/goods/find?inputFormat=json&outputFormat=json&oauth_version=2"
     headers = get_wfirma_headers(token)
     
     search_data = {
@@ -752,7 +1019,7 @@ def wfirma_find_good_by_name(token: str, name: str) -> tuple[dict | None, reques
     
     resp = None
     try:
-        resp = requests.post(api_url, headers=headers, json=search_data)
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=search_data)
         if resp.status_code == 200:
             data = resp.json()
             goods = data.get('goods', {})
@@ -767,12 +1034,12 @@ def wfirma_find_good_by_name(token: str, name: str) -> tuple[dict | None, reques
         return None, resp
 
 
-def wfirma_add_good(token: str, name: str, price: float, unit: str = "szt.", vat_code_id: int = 222) -> tuple[dict | None, requests.Response | None]:
+def wfirma_add_good(token: str, name: str, price: float, unit: str = "szt.", vat_code_id: int = 222, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """
     Dodaj produkt do katalogu wFirma.
     vat_code_id: 222 = 23%, 223 = 8%, 224 = 5%, 225 = 0%, 226 = zw
     """
-    api_url = "https://api2.wfirma.pl/goods/add?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/goods/add?inputFormat=json&outputFormat=json&oauth_version=2"
     headers = get_wfirma_headers(token)
     
     good_payload = {
@@ -792,30 +1059,30 @@ def wfirma_add_good(token: str, name: str, price: float, unit: str = "szt.", vat
     
     resp = None
     try:
-        print(f"[WFIRMA DEBUG] Adding good: {name}, price: {price}, unit: {unit}")
-        resp = requests.post(api_url, headers=headers, json=good_payload)
-        print(f"[WFIRMA DEBUG] add_good status: {resp.status_code}")
+        log_wfirma.debug("Adding good: %s, price: %s, unit: %s", name, price, unit)
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=good_payload)
+        log_wfirma.debug("add_good status: %s", resp.status_code)
         
         if resp.status_code == 200:
             result = resp.json()
-            print(f"[WFIRMA DEBUG] add_good response: {resp.text[:500]}")
+            log_wfirma.debug("add_good response: %.500s", lazy(lambda: resp.text))
             goods = result.get('goods', {})
             if isinstance(goods, dict):
                 for key in goods:
                     if key.isdigit():
                         good = goods[key].get('good', {})
                         if good and good.get('id'):
-                            print(f"[WFIRMA DEBUG] Created good with ID: {good.get('id')}")
+                            log_wfirma.debug("Created good with ID: %s", good.get('id'))
                             return good, resp
         else:
-            print(f"[WFIRMA DEBUG] add_good error: {resp.text[:500]}")
+            log_wfirma.warning("add_good error: %s", resp.text[:500])
         return None, resp
     except Exception as e:
-        print(f"[WFIRMA DEBUG] add_good exception: {e}")
+        log_wfirma.warning("add_good exception: %s", e)
         return None, resp
 
 
-def wfirma_get_or_create_good(token: str, name: str, price: float, unit: str = "szt.", vat_rate: str = "23") -> dict | None:
+def wfirma_get_or_create_good(token: str, name: str, price: float, unit: str = "szt.", vat_rate: str = "23", company: str = None) -> dict | None:
     """
     Pobierz produkt po nazwie lub utwórz nowy.
     Zwraca dict z 'id' produktu lub None.
@@ -832,23 +1099,23 @@ def wfirma_get_or_create_good(token: str, name: str, price: float, unit: str = "
     vat_code_id = vat_code_map.get(str(vat_rate), 222)
     
     # 1. Szukaj istniejącego produktu
-    existing_good, _ = wfirma_find_good_by_name(token, name)
+    existing_good, _ = wfirma_find_good_by_name(token, name, company)
     if existing_good and existing_good.get('id'):
-        print(f"[WFIRMA DEBUG] Found existing good: {name} -> ID {existing_good.get('id')}")
+        log_wfirma.debug("Found existing good: %s -> ID %s", name, existing_good.get('id'))
         return existing_good
     
     # 2. Nie znaleziono - utwórz nowy
-    print(f"[WFIRMA DEBUG] Good not found, creating: {name}")
-    new_good, _ = wfirma_add_good(token, name, price, unit, vat_code_id)
+    log_wfirma.debug("Good not found, creating: %s", name)
+    new_good, _ = wfirma_add_good(token, name, price, unit, vat_code_id, company)
     if new_good and new_good.get('id'):
         return new_good
     
     return None
 
 
-def wfirma_create_invoice(token: str, invoice_payload: dict, company_id: str = None) -> tuple[dict | None, requests.Response | None]:
+def wfirma_create_invoice(token: str, invoice_payload: dict, company_id: str = None, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """Utwórz fakturę; zwraca (invoice_dict|None, response)."""
-    api_url = "https://api2.wfirma.pl/invoices/add?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/invoices/add?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     headers = get_wfirma_headers(token)
@@ -856,14 +1123,10 @@ def wfirma_create_invoice(token: str, invoice_payload: dict, company_id: str = N
     try:
         # KLUCZOWE: Wrapper "invoices"!
         request_body = {"invoices": {"invoice": invoice_payload}}
-        # LOG: pełny request body
-        try:
-            import json as json_lib
-            print("[WFIRMA DEBUG] FULL invoice request body:", json_lib.dumps(request_body, ensure_ascii=False, indent=2))
-        except Exception:
-            pass
+        # LOG: pełny request body (serializowany tylko przy poziomie DEBUG)
+        log_wfirma.debug("FULL invoice request body: %s", lazy_json(request_body, indent=2))
         
-        resp = requests.post(api_url, headers=headers, json=request_body)
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=request_body)
         if resp.status_code == 200:
             result = resp.json()
             # Odpowiedź: invoices.0.invoice
@@ -880,12 +1143,12 @@ def wfirma_create_invoice(token: str, invoice_payload: dict, company_id: str = N
         return None, resp
 
 
-def wfirma_list_series(token: str, company_id: str = None) -> list:
+def wfirma_list_series(token: str, company_id: str = None, company: str = None) -> list:
     """
     Pobierz listę wszystkich serii faktur.
     Zwraca listę dict z 'id', 'name', 'template' itp.
     """
-    api_url = "https://api2.wfirma.pl/series/find?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/series/find?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     headers = get_wfirma_headers(token)
@@ -900,9 +1163,9 @@ def wfirma_list_series(token: str, company_id: str = None) -> list:
     }
     
     try:
-        print(f"[WFIRMA DEBUG] Pobieram listę serii...")
-        resp = requests.post(api_url, headers=headers, json=search_data)
-        print(f"[WFIRMA DEBUG] list_series status: {resp.status_code}")
+        log_wfirma.debug("Pobieram listę serii...")
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=search_data)
+        log_wfirma.debug("list_series status: %s", resp.status_code)
         
         result = []
         if resp.status_code == 200:
@@ -919,66 +1182,108 @@ def wfirma_list_series(token: str, company_id: str = None) -> list:
                                 'template': series.get('template'),
                                 'module': series.get('module')
                             })
-            print(f"[WFIRMA DEBUG] Znaleziono {len(result)} serii")
+            log_wfirma.debug("Znaleziono %s serii", len(result))
             for s in result:
-                print(f"[WFIRMA DEBUG]   - ID: {s['id']}, Nazwa: {s['name']}, Szablon: {s['template']}")
+                log_wfirma.debug("  - ID: %s, Nazwa: %s, Szablon: %s", s['id'], s['name'], s['template'])
         else:
-            print(f"[WFIRMA DEBUG] list_series error: {resp.text[:300]}")
+            log_wfirma.warning("list_series error: %s", resp.text[:300])
         return result
     except Exception as e:
-        print(f"[WFIRMA DEBUG] list_series exception: {e}")
+        log_wfirma.warning("list_series exception: %s", e)
         return []
 
 
-def wfirma_find_series_by_name(token: str, series_name: str, company_id: str = None) -> dict | None:
+series_index = SeriesIndex(
+    loader=wfirma_list_series,
+    ttl=WFIRMA_SERIES_TTL,
+    miss_refresh_interval=WFIRMA_SERIES_MISS_REFRESH_INTERVAL,
+)
+
+
+def wfirma_find_series_by_name(token: str, series_name: str, company_id: str = None, company: str = None) -> dict | None:
     """
     Znajdź serię faktur po nazwie (case insensitive).
-    Pobiera wszystkie serie i szuka pasującej nazwy.
+    Korzysta z indeksu serii w pamięci (series_index) - series/find jest wołane tylko
+    przy pierwszym użyciu, po TTL (w tle) albo gdy nazwy brak w indeksie.
     Zwraca dict z 'id' serii lub None.
     """
+    company_key = (company or DEFAULT_COMPANY).lower().strip()
     try:
-        print(f"[WFIRMA DEBUG] Szukam serii: {series_name} (case insensitive)")
+        series = series_index.lookup(company_key, series_name, token, company_id)
+        if series:
+            log_wfirma.debug("Znaleziono serię: %s -> ID %s", series.get('name'), series.get('id'))
+            return series
         
-        # Pobierz wszystkie serie
-        all_series = wfirma_list_series(token, company_id)
-        
-        if not all_series:
-            print(f"[WFIRMA DEBUG] Brak serii w systemie")
-            return None
-        
-        # Szukaj case insensitive
-        series_name_lower = series_name.lower().strip()
-        for series in all_series:
-            if series.get('name', '').lower().strip() == series_name_lower:
-                print(f"[WFIRMA DEBUG] Znaleziono serię: {series.get('name')} -> ID {series.get('id')}")
-                return series
-        
-        # Nie znaleziono - loguj dostępne serie
-        print(f"[WFIRMA DEBUG] Nie znaleziono serii '{series_name}'. Dostępne serie:")
-        for s in all_series:
-            print(f"[WFIRMA DEBUG]   - '{s.get('name')}'")
+        # Nie znaleziono - loguj dostępne serie (z indeksu, bez dodatkowego wywołania API)
+        log_wfirma.debug("Nie znaleziono serii '%s'. Dostępne serie:", series_name)
+        for s in series_index.all(company_key):
+            log_wfirma.debug("  - '%s'", s.get('name'))
         
         return None
     except Exception as e:
-        print(f"[WFIRMA DEBUG] find_series exception: {e}")
+        log_wfirma.warning("find_series exception: %s", e)
         return None
 
 
-def wfirma_get_company_id(token: str) -> str | None:
-    """Pobierz ID pierwszej firmy użytkownika"""
-    api_url = "https://api2.wfirma.pl/companies/find?inputFormat=json&outputFormat=json&oauth_version=2"
+def wfirma_token_subject(token: str, company: str = None) -> str:
+    """
+    Identyfikator grantu OAuth, do którego należy token (klucz cache).
+    Jeśli token jest JWT - bierzemy claim 'sub', w przeciwnym razie client_id firmy
+    (po ponownej autoryzacji /callback cache i tak jest czyszczony).
+    """
+    parts = (token or '').split('.')
+    if len(parts) == 3:
+        try:
+            payload = parts[1] + '=' * (-len(parts[1]) % 4)
+            claims = json.loads(base64.urlsafe_b64decode(payload))
+            if claims.get('sub'):
+                return f"sub:{claims['sub']}"
+        except Exception:
+            pass
+    return f"client:{get_company_config(company)['client_id'] or ''}"
+
+
+def invalidate_company_caches(company: str = None) -> None:
+    """
+    Wyczyść cache zależne od grantu OAuth (np. po ponownej autoryzacji /callback).
+    md i md_test współdzielą tokeny, więc czyścimy wszystkie firmy z tym samym prefixem.
+    """
+    prefix = get_company_config(company)['prefix']
+    companies = {c for c in SUPPORTED_COMPANIES if get_company_config(c)['prefix'] == prefix}
+    removed = company_id_cache.invalidate(lambda key: key[0] in companies)
+    removed_series = sum(series_index.invalidate(c) for c in companies)
+    log_cache.info("Wyczyszczono cache dla firm %s (company_id: %s, serie: %s)", sorted(companies), removed, removed_series)
+
+
+def wfirma_cached_company_id(token: str, company: str = None) -> tuple[str, str | None]:
+    """(znormalizowana firma, company_id z cache lub None) - bez wywołania API."""
+    company_key = (company or DEFAULT_COMPANY).lower().strip()
+    return company_key, company_id_cache.get((company_key, wfirma_token_subject(token, company)))
+
+
+def wfirma_get_company_id(token: str, company: str = None) -> str | None:
+    """
+    Pobierz ID pierwszej firmy użytkownika.
+    Wynik jest cache'owany per (firma, grant OAuth) przez WFIRMA_COMPANY_ID_TTL sekund.
+    """
+    company_key, cached = wfirma_cached_company_id(token, company)
+    if cached:
+        return cached
+    cache_key = (company_key, wfirma_token_subject(token, company))
+
+    api_url = f"{WFIRMA_API_URL}/companies/find?inputFormat=json&outputFormat=json&oauth_version=2"
     headers = get_wfirma_headers(token)
     body = {"companies": {"parameters": {"limit": "1"}}}
     
     try:
-        resp = requests.post(api_url, headers=headers, json=body)
-        print(f"[WFIRMA DEBUG] get_company_id status: {resp.status_code}")
-        print(f"[WFIRMA DEBUG] get_company_id response: {resp.text[:500]}")
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=body)
+        log_wfirma.debug("get_company_id status: %s", resp.status_code)
+        log_wfirma.debug("get_company_id response: %.500s", lazy(lambda: resp.text))
         
         if resp.status_code == 200:
             data = resp.json()
             companies = data.get('companies', {})
-            print(f"[WFIRMA DEBUG] companies keys: {list(companies.keys()) if companies else None}")
+            log_wfirma.debug("companies keys: %s", list(companies.keys()) if companies else None)
             
             if isinstance(companies, dict):
                 for key in companies:
@@ -986,22 +1291,23 @@ def wfirma_get_company_id(token: str) -> str | None:
                         comp = companies[key].get('company', {})
                         company_id = comp.get('id')
                         if company_id:
-                            print(f"[WFIRMA DEBUG] Found company_id: {company_id}")
+                            log_wfirma.debug("Found company_id: %s", company_id)
+                            company_id_cache.set(cache_key, str(company_id))
                             return str(company_id)
         return None
     except Exception as e:
-        print(f"[WFIRMA DEBUG] get_company_id exception: {e}")
+        log_wfirma.warning("get_company_id exception: %s", e)
         return None
 
 
-def wfirma_get_invoice_pdf(token: str, invoice_id: str, company_id: str | None = None) -> requests.Response:
+def wfirma_get_invoice_pdf(token: str, invoice_id: str, company_id: str | None = None, company: str = None) -> requests.Response:
     """
     Pobierz PDF faktury z wFirma.
     Używamy endpointu invoices/download (zgodnie z diagnostyką).
     company_id jest opcjonalny - jeśli brak, API użyje domyślnej firmy.
     """
     # Poprawny endpoint z Postmana
-    api_url = f"https://api2.wfirma.pl/invoices/download/{invoice_id}"
+    api_url = f"{WFIRMA_API_URL}/invoices/download/{invoice_id}"
     params = {
         "inputFormat": "json",
         "outputFormat": "json",
@@ -1030,10 +1336,10 @@ def wfirma_get_invoice_pdf(token: str, invoice_id: str, company_id: str | None =
         }
     }
     
-    return requests.post(api_url, headers=headers, params=params, json=body, stream=True)
+    return wfirma_http('POST', api_url, company, headers=headers, params=params, json=body, stream=True)
 
 
-def wfirma_add_payment(token: str, invoice_id: str, amount: float, payment_date: str = None, company_id: str | None = None, payment_cashbox_id: str | int | None = None) -> tuple[dict | None, requests.Response | None]:
+def wfirma_add_payment(token: str, invoice_id: str, amount: float, payment_date: str = None, company_id: str | None = None, payment_cashbox_id: str | int | None = None, company: str = None) -> tuple[dict | None, requests.Response | None]:
     """
     Dodaj płatność do faktury (oznacz jako opłaconą).
     
@@ -1048,7 +1354,7 @@ def wfirma_add_payment(token: str, invoice_id: str, amount: float, payment_date:
     if not payment_date:
         payment_date = datetime.date.today().isoformat()
     
-    api_url = "https://api2.wfirma.pl/payments/add?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/payments/add?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     
@@ -1075,37 +1381,37 @@ def wfirma_add_payment(token: str, invoice_id: str, amount: float, payment_date:
     
     resp = None
     try:
-        print(f"[WFIRMA DEBUG] Dodaję płatność: invoice_id={invoice_id}, amount={amount}, date={payment_date}")
-        print(f"[WFIRMA DEBUG] Payment request body: {json.dumps(payment_data, indent=2)}")
-        resp = requests.post(api_url, headers=headers, json=payment_data)
-        print(f"[WFIRMA DEBUG] add_payment status: {resp.status_code}")
-        print(f"[WFIRMA DEBUG] add_payment response: {resp.text[:1000]}")
+        log_wfirma.debug("Dodaję płatność: invoice_id=%s, amount=%s, date=%s", invoice_id, amount, payment_date)
+        log_wfirma.debug("Payment request body: %s", lazy_json(payment_data, indent=2))
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=payment_data)
+        log_wfirma.debug("add_payment status: %s", resp.status_code)
+        log_wfirma.debug("add_payment response: %.1000s", lazy(lambda: resp.text))
         
         if resp.status_code == 200:
             result = resp.json()
             status = result.get('status', {}).get('code')
             if status == 'OK':
-                print(f"[WFIRMA DEBUG] Płatność dodana pomyślnie")
+                log_wfirma.debug("Płatność dodana pomyślnie")
                 payments = result.get('payments', {})
                 if isinstance(payments, dict):
                     for key in payments:
                         if key.isdigit():
                             payment = payments[key].get('payment', {})
                             if payment:
-                                print(f"[WFIRMA DEBUG] Utworzona płatność: id={payment.get('id')}, value={payment.get('value')}")
+                                log_wfirma.debug("Utworzona płatność: id=%s, value=%s", payment.get('id'), payment.get('value'))
                                 return payment, resp
                 return {}, resp
             else:
-                print(f"[WFIRMA DEBUG] add_payment error: {result.get('status', {}).get('message')}")
+                log_wfirma.warning("add_payment error: %s", result.get('status', {}).get('message'))
         else:
-            print(f"[WFIRMA DEBUG] add_payment HTTP error: {resp.text[:500]}")
+            log_wfirma.warning("add_payment HTTP error: %s", resp.text[:500])
         return None, resp
     except Exception as e:
-        print(f"[WFIRMA DEBUG] add_payment exception: {e}")
+        log_wfirma.warning("add_payment exception: %s", e)
         return None, resp
 
 
-def wfirma_mark_invoice_paid(token: str, invoice_id: str, amount: float, company_id: str | None = None) -> tuple[bool, requests.Response | None]:
+def wfirma_mark_invoice_paid(token: str, invoice_id: str, amount: float, company_id: str | None = None, company: str = None) -> tuple[bool, requests.Response | None]:
     """
     Oznacz fakturę jako opłaconą przez edycję pola alreadypaid_initial.
     
@@ -1119,7 +1425,7 @@ def wfirma_mark_invoice_paid(token: str, invoice_id: str, amount: float, company
     Returns:
         (success: bool, response: Response)
     """
-    api_url = f"https://api2.wfirma.pl/invoices/edit/{invoice_id}?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/invoices/edit/{invoice_id}?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     
@@ -1136,11 +1442,11 @@ def wfirma_mark_invoice_paid(token: str, invoice_id: str, amount: float, company
     
     resp = None
     try:
-        print(f"[WFIRMA DEBUG] Oznaczam fakturę jako opłaconą (edit): invoice_id={invoice_id}, amount={amount}")
-        print(f"[WFIRMA DEBUG] Invoice edit request body: {json.dumps(edit_data, indent=2)}")
-        resp = requests.post(api_url, headers=headers, json=edit_data)
-        print(f"[WFIRMA DEBUG] invoice_edit status: {resp.status_code}")
-        print(f"[WFIRMA DEBUG] invoice_edit response: {resp.text[:1000]}")
+        log_wfirma.debug("Oznaczam fakturę jako opłaconą (edit): invoice_id=%s, amount=%s", invoice_id, amount)
+        log_wfirma.debug("Invoice edit request body: %s", lazy_json(edit_data, indent=2))
+        resp = wfirma_http('POST', api_url, company, headers=headers, json=edit_data)
+        log_wfirma.debug("invoice_edit status: %s", resp.status_code)
+        log_wfirma.debug("invoice_edit response: %.1000s", lazy(lambda: resp.text))
         
         if resp.status_code == 200:
             result = resp.json()
@@ -1155,27 +1461,27 @@ def wfirma_mark_invoice_paid(token: str, invoice_id: str, amount: float, company
                             if invoice:
                                 new_state = invoice.get('paymentstate')
                                 new_alreadypaid = invoice.get('alreadypaid')
-                                print(f"[WFIRMA DEBUG] Po edycji: paymentstate={new_state}, alreadypaid={new_alreadypaid}")
+                                log_wfirma.debug("Po edycji: paymentstate=%s, alreadypaid=%s", new_state, new_alreadypaid)
                                 return True, resp
                 return True, resp
             else:
-                print(f"[WFIRMA DEBUG] invoice_edit error: {result.get('status', {}).get('message')}")
+                log_wfirma.warning("invoice_edit error: %s", result.get('status', {}).get('message'))
         else:
-            print(f"[WFIRMA DEBUG] invoice_edit HTTP error: {resp.text[:500]}")
+            log_wfirma.warning("invoice_edit HTTP error: %s", resp.text[:500])
         return False, resp
     except Exception as e:
-        print(f"[WFIRMA DEBUG] invoice_edit exception: {e}")
+        log_wfirma.warning("invoice_edit exception: %s", e)
         return False, resp
 
 
-def wfirma_send_invoice_email(token: str, invoice_id: str, email: str, company_id: str | None = None) -> requests.Response:
+def wfirma_send_invoice_email(token: str, invoice_id: str, email: str, company_id: str | None = None, company: str = None) -> requests.Response:
     """
     Wyślij fakturę e-mailem przez wFirma.
     Używamy endpointu invoices/send (zgodnie z diagnostyką).
     company_id jest opcjonalny - jeśli brak, API użyje domyślnej firmy.
     """
     # Poprawny endpoint z Postmana
-    api_url = f"https://api2.wfirma.pl/invoices/send/{invoice_id}"
+    api_url = f"{WFIRMA_API_URL}/invoices/send/{invoice_id}"
     params = {
         "inputFormat": "json",
         "outputFormat": "json",
@@ -1200,175 +1506,164 @@ def wfirma_send_invoice_email(token: str, invoice_id: str, email: str, company_i
         }
     }
     
-    return requests.post(api_url, headers=headers, params=params, json=payload)
+    return wfirma_http('POST', api_url, company, headers=headers, params=params, json=payload)
 
 
 # ==================== POMOCNICZE: GUS LOOKUP (do ponownego użycia w workflow) ====================
 
 
-def gus_lookup_nip(clean_nip: str) -> tuple[list[dict] | None, str | None]:
+def gus_cache_bypass_requested() -> bool:
+    """Nagłówek 'Cache-Control: no-cache' wymusza świeże zapytanie do GUS (wynik trafia do cache)."""
+    return 'no-cache' in (request.headers.get('Cache-Control') or '').lower()
+
+
+def gus_cached_nip(clean_nip: str, api_key: str = None) -> list[dict] | None:
+    """Rekordy GUS dla NIP z cache (lista, także pusta = "nie znaleziono") albo None, gdy brak wpisu."""
+    api_key = api_key or GUS_API_KEY or ''
+    if not api_key or gus_cache is None:
+        return None
+    return gus_cache.get(gus_bir_host(api_key), clean_nip)
+
+
+def gus_lookup_nip(clean_nip: str, api_key: str = None, use_cache: bool = True) -> tuple[list[dict] | None, str | None]:
     """
     Minimalny helper do ponownego użycia w workflow (bez HTTP round-trip do własnego endpointu).
     Zwraca (lista rekordów lub None, komunikat błędu lub None).
+    Wyniki (także "nie znaleziono") są cache'owane per NIP i środowisko BIR;
+    use_cache=False pomija odczyt z cache.
     """
-    print(f"[GUS-LOOKUP] === START dla NIP={clean_nip} ===")
-    from_header_key = ''
-    api_key = GUS_API_KEY or ''
+    log_gus.debug("=== START dla NIP=%s ===", clean_nip)
+    api_key = api_key or GUS_API_KEY or ''
 
     if not api_key:
-        print(f"[GUS-LOOKUP] BŁĄD: Brak klucza GUS_API_KEY")
+        log_gus.warning("BŁĄD: Brak klucza GUS_API_KEY")
         return None, 'Brak klucza GUS_API_KEY'
 
-    use_test_env = api_key == 'abcde12345abcde12345' or GUS_USE_TEST
-    bir_host = 'wyszukiwarkaregontest.stat.gov.pl' if use_test_env else 'wyszukiwarkaregon.stat.gov.pl'
-    bir_url = f'https://{bir_host}/wsBIR/UslugaBIRzewnPubl.svc'
-    print(f"[GUS-LOOKUP] Środowisko: {'TEST' if use_test_env else 'PROD'}, host={bir_host}")
-
-    safe_api_key = escape_xml(api_key)
-    login_envelope = (
-        '<?xml version="1.0" encoding="utf-8"?>'
-        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" xmlns:ns="http://CIS/BIR/PUBL/2014/07">'
-        '<soap:Header xmlns:wsa="http://www.w3.org/2005/08/addressing">'
-        f'<wsa:To>{bir_url}</wsa:To>'
-        '<wsa:Action>http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/Zaloguj</wsa:Action>'
-        '</soap:Header>'
-        '<soap:Body>'
-        '<ns:Zaloguj>'
-        f'<ns:pKluczUzytkownika>{safe_api_key}</ns:pKluczUzytkownika>'
-        '</ns:Zaloguj>'
-        '</soap:Body>'
-        '</soap:Envelope>'
-    )
+    bir_host = gus_bir_host(api_key)
+    log_gus.debug("Środowisko: %s, host=%s", 'TEST' if bir_host == BIR_HOST_TEST else 'PROD', bir_host)
 
-    print(f"[GUS-LOOKUP] Wysyłam Zaloguj request...")
-    try:
-        login_resp = post_soap_gus(bir_host, login_envelope, sid=None, timeout=10)
-        print(f"[GUS-LOOKUP] Zaloguj response status={login_resp.status_code}")
-    except Exception as e:
-        print(f"[GUS-LOOKUP] BŁĄD logowania: {e}")
-        return None, f'Błąd komunikacji z GUS podczas logowania: {e}'
-
-    sid_match = re.search(r'<ZalogujResult>([^<]*)</ZalogujResult>', login_resp.text or '')
-    sid = sid_match.group(1).strip() if sid_match else ''
-    print(f"[GUS-LOOKUP] SID={'[JEST]' if sid else '[BRAK]'} (długość={len(sid) if sid else 0})")
-    if not sid:
-        print(f"[GUS-LOOKUP] BŁĄD: Brak SID, response body={login_resp.text[:500] if login_resp.text else 'EMPTY'}")
-        return None, 'Logowanie do GUS nie powiodło się (brak SID)'
-
-    safe_nip = escape_xml(clean_nip)
-    search_envelope = (
-        '<?xml version="1.0" encoding="utf-8"?>'
-        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
-        'xmlns:ns="http://CIS/BIR/PUBL/2014/07" '
-        'xmlns:q1="http://CIS/BIR/PUBL/2014/07/DataContract" '
-        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
-        '<soap:Header xmlns:wsa="http://www.w3.org/2005/08/addressing">'
-        f'<wsa:To>{bir_url}</wsa:To>'
-        '<wsa:Action>http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/DaneSzukajPodmioty</wsa:Action>'
-        '</soap:Header>'
-        '<soap:Body>'
-        '<ns:DaneSzukajPodmioty>'
-        '<ns:pParametryWyszukiwania>'
-        '<q1:Krs xsi:nil="true"/>'
-        '<q1:Krsy xsi:nil="true"/>'
-        f'<q1:Nip>{safe_nip}</q1:Nip>'
-        '<q1:Nipy xsi:nil="true"/>'
-        '<q1:Regon xsi:nil="true"/>'
-        '<q1:Regony14zn xsi:nil="true"/>'
-        '<q1:Regony9zn xsi:nil="true"/>'
-        '</ns:pParametryWyszukiwania>'
-        '</ns:DaneSzukajPodmioty>'
-        '</soap:Body>'
-        '</soap:Envelope>'
-    )
+    if use_cache:
+        cached = gus_cached_nip(clean_nip, api_key)
+        if cached is not None:
+            log_gus.debug("CACHE HIT NIP=%s rekordów=%s", clean_nip, len(cached))
+            return cached, None
 
-    print(f"[GUS-LOOKUP] Wysyłam DaneSzukajPodmioty dla NIP={clean_nip}...")
+    data_list, error = gus_search_nips(api_key, bir_host, [clean_nip])
+    if error is None and gus_cache is not None:
+        gus_cache.put(bir_host, clean_nip, data_list)
+    return data_list, error
+
+
+def gus_lookup_nips(nips: list[str], api_key: str = None, use_cache: bool = True) -> dict[str, tuple[list[dict] | None, str | None]]:
+    """
+    Hurtowa wersja gus_lookup_nip: NIP -> (lista rekordów lub None, komunikat błędu lub None).
+    NIP-y spoza cache są wysyłane paczkami po 20 (parametr Nipy) na wspólnej sesji BIR,
+    kilka paczek równolegle (GUS_BATCH_CONCURRENCY).
+    """
+    api_key = api_key or GUS_API_KEY or ''
+    unique_nips = list(dict.fromkeys(nips))
+    if not api_key:
+        return {nip: (None, 'Brak klucza GUS_API_KEY') for nip in unique_nips}
+
+    bir_host = gus_bir_host(api_key)
+    results: dict[str, tuple[list[dict] | None, str | None]] = {}
+    pending = []
+    for nip in unique_nips:
+        cached = gus_cache.get(bir_host, nip) if use_cache and gus_cache is not None else None
+        if cached is not None:
+            results[nip] = (cached, None)
+        else:
+            pending.append(nip)
+
+    chunks = [pending[i:i + BIR_MAX_NIPS_PER_SEARCH] for i in range(0, len(pending), BIR_MAX_NIPS_PER_SEARCH)]
+    log_gus.debug("Batch: %s NIP, z cache %s, do GUS %s w %s paczkach", len(unique_nips), len(results), len(pending), len(chunks))
+    if not chunks:
+        return results
+
+    with ThreadPoolExecutor(max_workers=max(1, min(GUS_BATCH_CONCURRENCY, len(chunks)))) as executor:
+        chunk_results = executor.map(bind_request_timings(lambda chunk: gus_search_nips(api_key, bir_host, chunk)), chunks)
+        for chunk, (records, error) in zip(chunks, chunk_results):
+            if error:
+                for nip in chunk:
+                    results[nip] = (None, error)
+                continue
+            by_nip: dict[str, list[dict]] = {nip: [] for nip in chunk}
+            for record in records:
+                record_nip = re.sub(r'[^0-9]', '', record.get('nip') or '')
+                if record_nip in by_nip:
+                    by_nip[record_nip].append(record)
+            for nip, nip_records in by_nip.items():
+                results[nip] = (nip_records, None)
+                if gus_cache is not None:
+                    gus_cache.put(bir_host, nip, nip_records)
+    return results
+
+
+def gus_search_nips(api_key: str, bir_host: str, nips: list[str]) -> tuple[list[dict] | None, str | None]:
+    """
+    Wyszukanie 1-20 NIP w BIR jednym wywołaniem DaneSzukajPodmioty - zawsze zapytanie do GUS, bez cache.
+    Zwraca rekordy wszystkich znalezionych podmiotów (pole 'nip' wskazuje którego NIP dotyczą).
+    """
+    label = ','.join(nips)
+    # Sesja (SID) z puli - Zaloguj tylko przy pierwszym użyciu / po wygaśnięciu sesji
+    log_gus.debug("Wysyłam DaneSzukajPodmioty dla NIP=%s...", label)
     try:
-        search_resp = post_soap_gus(bir_host, search_envelope, sid=sid, timeout=10)
-        print(f"[GUS-LOOKUP] Search response status={search_resp.status_code}")
+        search_resp = gus_sessions.call(api_key, bir_host, build_search_nips_envelope(bir_host, nips))
+        log_gus.debug("Search response status=%s", search_resp.status_code)
+    except GusLoginError as e:
+        log_gus.warning("BŁĄD logowania: %s %s", e, e.debug)
+        return None, str(e)
     except Exception as e:
-        print(f"[GUS-LOOKUP] BŁĄD wyszukiwania: {e}")
+        log_gus.warning("BŁĄD wyszukiwania: %s", e)
         return None, f'Błąd komunikacji z GUS podczas wyszukiwania: {e}'
 
-    soap_part = search_resp.text or ''
-    print(f"[GUS-LOOKUP] Raw response length={len(soap_part)}")
-    
-    if 'Content-Type: application/xop+xml' in soap_part:
-        match = re.search(
-            r'Content-Type: application/xop\+xml[^\r\n]*\r?\n\r?\n([\s\S]*?)\r?\n--uuid:',
-            soap_part,
-            re.MULTILINE | re.DOTALL,
-        )
-        if match:
-            soap_part = match.group(1)
-            print(f"[GUS-LOOKUP] Extracted SOAP part length={len(soap_part)}")
-
-    if re.search(r'<DaneSzukajResult\s*/>', soap_part):
-        print(f"[GUS-LOOKUP] WYNIK: Pusty <DaneSzukajResult/> - NIP nie znaleziony")
-        return [], None
-
-    result_match = re.search(
-        r'<DaneSzukajPodmiotyResult>([\s\S]*?)</DaneSzukajPodmiotyResult>',
-        soap_part,
-        re.MULTILINE | re.DOTALL,
-    )
-    inner_xml = result_match.group(1) if result_match else ''
-    print(f"[GUS-LOOKUP] inner_xml length={len(inner_xml)}, preview={inner_xml[:200] if inner_xml else 'EMPTY'}...")
-    if not inner_xml:
-        print(f"[GUS-LOOKUP] BŁĄD: Brak DaneSzukajPodmiotyResult, soap_part={soap_part[:500]}")
-        return None, 'Brak danych w odpowiedzi GUS (DaneSzukajPodmiotyResult pusty)'
-
-    decoded_xml = decode_bir_inner_xml(inner_xml)
-    print(f"[GUS-LOOKUP] decoded_xml length={len(decoded_xml) if decoded_xml else 0}")
-    if not decoded_xml:
-        print(f"[GUS-LOOKUP] BŁĄD: decode_bir_inner_xml zwrócił None/pusty")
-        return None, 'Brak danych po dekodowaniu odpowiedzi GUS'
+    log_gus.debug("Raw response length=%s", len(search_resp.content or b''))
 
+    # Jeden przebieg po surowych bajtach: część MTOM -> envelope -> wewnętrzny XML -> rekordy <dane>
+    data_list: list[dict] = []
     try:
-        root = ET.fromstring(decoded_xml)
-    except ET.ParseError as e:
-        return None, f'Nie udało się sparsować danych GUS: {e}'
+        for dane in iter_bir_records(search_resp.content):
+            # Sprawdź czy to błąd GUS (ErrorCode) zamiast danych podmiotu
+            error_code = dane.get('ErrorCode')
+            if error_code:
+                error_msg = dane.get('ErrorMessagePl') or dane.get('ErrorMessageEn') or ''
+                log_gus.warning("GUS zwrócił ErrorCode=%s: %s", error_code, error_msg)
+                if error_code != '4':
+                    # Inny błąd niż "nie znaleziono" - nie może trafić do cache jako wynik negatywny
+                    return None, f'GUS zwrócił błąd (ErrorCode={error_code}): {error_msg}'
+                continue  # Pomiń ten "rekord" - to błąd, nie dane
+
+            mapped = {
+                'regon': dane.get('Regon'),
+                'nip': dane.get('Nip'),
+                'nazwa': dane.get('Nazwa'),
+                'wojewodztwo': dane.get('Wojewodztwo'),
+                'powiat': dane.get('Powiat'),
+                'gmina': dane.get('Gmina'),
+                'miejscowosc': dane.get('Miejscowosc'),
+                'kodPocztowy': dane.get('KodPocztowy'),
+                'ulica': dane.get('Ulica'),
+                'nrNieruchomosci': dane.get('NrNieruchomosci'),
+                'nrLokalu': dane.get('NrLokalu'),
+                'typ': dane.get('Typ'),
+                'silosId': dane.get('SilosID'),
+                'miejscowoscPoczty': dane.get('MiejscowoscPoczty'),
+                'krs': dane.get('Krs'),
+            }
 
-    data_list: list[dict] = []
-    for dane in root.findall('.//dane'):
-        def get_text(tag: str) -> str | None:
-            el = dane.find(tag)
-            return el.text if el is not None else None
-
-        # Sprawdź czy to błąd GUS (ErrorCode) zamiast danych podmiotu
-        error_code = get_text('ErrorCode')
-        if error_code:
-            error_msg = get_text('ErrorMessagePl') or get_text('ErrorMessageEn') or ''
-            print(f"[GUS-LOOKUP] GUS zwrócił ErrorCode={error_code}: {error_msg}")
-            continue  # Pomiń ten "rekord" - to błąd, nie dane
-
-        mapped = {
-            'regon': get_text('Regon'),
-            'nip': get_text('Nip'),
-            'nazwa': get_text('Nazwa'),
-            'wojewodztwo': get_text('Wojewodztwo'),
-            'powiat': get_text('Powiat'),
-            'gmina': get_text('Gmina'),
-            'miejscowosc': get_text('Miejscowosc'),
-            'kodPocztowy': get_text('KodPocztowy'),
-            'ulica': get_text('Ulica'),
-            'nrNieruchomosci': get_text('NrNieruchomosci'),
-            'nrLokalu': get_text('NrLokalu'),
-            'typ': get_text('Typ'),
-            'silosId': get_text('SilosID'),
-            'miejscowoscPoczty': get_text('MiejscowoscPoczty'),
-            'krs': get_text('Krs'),
-        }
-        
-        # Dodaj tylko jeśli jest nazwa (prawdziwy podmiot)
-        if mapped.get('nazwa'):
-            data_list.append(mapped)
-        else:
-            print(f"[GUS-LOOKUP] Pominięto rekord bez nazwy: {mapped}")
+            # Dodaj tylko jeśli jest nazwa (prawdziwy podmiot)
+            if mapped.get('nazwa'):
+                data_list.append(mapped)
+            else:
+                log_gus.debug("Pominięto rekord bez nazwy: %s", mapped)
+    except BirResponseError as e:
+        log_gus.warning("BŁĄD: %s, status=%s, odpowiedź=%s", e, search_resp.status_code,
+                        lazy(lambda: search_resp.content[:500].decode('utf-8', errors='replace')))
+        return None, str(e)
 
-    print(f"[GUS-LOOKUP] === KONIEC NIP={clean_nip} znaleziono {len(data_list)} rekordów ===")
+    log_gus.debug("=== KONIEC NIP=%s znaleziono %s rekordów ===", label, len(data_list))
     if data_list:
-        print(f"[GUS-LOOKUP] Pierwszy rekord: nazwa={data_list[0].get('nazwa')}, regon={data_list[0].get('regon')}")
+        log_gus.debug("Pierwszy rekord: nazwa=%s, regon=%s", data_list[0].get('nazwa'), data_list[0].get('regon'))
     return data_list, None
 
 
@@ -1390,50 +1685,12 @@ def validate_nip_checksum(nip: str) -> bool:
     return checksum == int(nip[9])
 
 
-def escape_xml(unsafe: str) -> str:
-    """
-    Bezpieczne wstawianie wartości do SOAP XML (ochrona przed SOAP injection).
-    Port funkcji escapeXml z backendu Googie_GUS (Node).
-    """
-    if not isinstance(unsafe, str):
-        return ""
-    return (
-        unsafe.replace("&", "&amp;")
-        .replace("<", "&lt;")
-        .replace(">", "&gt;")
-        .replace('"', "&quot;")
-        .replace("'", "&apos;")
-    )
-
-
-def decode_bir_inner_xml(encoded: str) -> str:
-    """
-    Dekodowanie wewnętrznego XML zwracanego przez GUS (DaneSzukajPodmiotyResult).
-    Port funkcji decodeBirInnerXml z backendu Googie_GUS.
-    """
-    if not isinstance(encoded, str):
-        return ""
-
-    return (
-        encoded.lstrip("\ufeff")
-        .replace("&amp;amp;", "&amp;")
-        .replace("&#xD;", "\r")
-        .replace("&#xA;", "\n")
-        .replace("&lt;", "<")
-        .replace("&gt;", ">")
-        .replace("&quot;", '"')
-        .replace("&apos;", "'")
-        .replace("&amp;", "&")
-        .strip()
-    )
-
-
 def post_soap_gus(bir_host: str, envelope: str, sid: str | None, timeout: int = 10) -> requests.Response:
     """
     Minimalna wersja postSoap z Googie_GUS – wysyła envelope SOAP do GUS/BIR.
-    Używa requests, timeout domyślnie 10s. Nagłówek 'sid' ustawiany jeśli podano.
+    Używa sesji keep-alive per host, timeout domyślnie 10s. Nagłówek 'sid' ustawiany jeśli podano.
     """
-    url = f"https://{bir_host}/wsBIR/UslugaBIRzewnPubl.svc"
+    url = GUS_BIR_URL or bir_url(bir_host)
     headers = {
         "Content-Type": "application/soap+xml; charset=utf-8",
         "Accept": "application/soap+xml",
@@ -1443,10 +1700,65 @@ def post_soap_gus(bir_host: str, envelope: str, sid: str | None, timeout: int =
         headers["sid"] = str(sid)
 
     # Wysyłamy surowy envelope jako dane POST
-    response = requests.post(url, data=envelope.encode("utf-8"), headers=headers, timeout=timeout)
+    with metrics.timed('gus', soap_action(envelope)) as call:
+        response = gus_http.request(bir_host, 'POST', url, data=envelope.encode("utf-8"), headers=headers, timeout=timeout)
+        record_http_call(call, response)
+    return response
+
+
+gus_http = SessionRegistry(
+    pool_connections=2,
+    pool_maxsize=WFIRMA_HTTP_POOL_MAXSIZE,
+    timeout=GUS_SOAP_TIMEOUT,
+    enabled=WFIRMA_HTTP_KEEPALIVE,
+)
+gus_sessions = GusSessionManager(
+    post=post_soap_gus,
+    check_interval=GUS_SESSION_CHECK_INTERVAL,
+    max_age=GUS_SESSION_MAX_AGE,
+    timeout=GUS_SOAP_TIMEOUT,
+)
+
+
+def gus_bir_host(api_key: str) -> str:
+    """Host BIR dla klucza: publiczny klucz testowy lub GUS_USE_TEST -> środowisko testowe."""
+    return BIR_HOST_TEST if api_key == BIR_TEST_API_KEY or GUS_USE_TEST else BIR_HOST_PROD
+
+
+# ==================== METRYKI (Server-Timing, Prometheus) ====================
+
+@app.before_request
+def metrics_start_request():
+    start_request_timings()
+
+
+@app.after_request
+def metrics_finish_request(response):
+    """Zapisz czas endpointu i dodaj nagłówek Server-Timing z czasami kroków wFirma/GUS."""
+    timings = current_request_timings()
+    if timings is None:
+        return response
+    duration = time.perf_counter() - timings.started
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    response_bytes = 0 if response.is_streamed else (response.content_length or 0)
+    metrics.observe_endpoint(endpoint, request.method, response.status_code, duration, response_bytes)
+    if METRICS_SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.header_value(duration)
     return response
 
 
+@app.teardown_request
+def metrics_teardown_request(exc):
+    end_request_timings()
+
+
+@app.route('/metrics')
+@require_api_key
+def prometheus_metrics():
+    """Metryki w formacie Prometheus: czasy endpointów i wywołań wFirma/GUS, błędy, bajty."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
 # ==================== ENDPOINTY OAUTH ====================
 
 @app.route('/')
@@ -1466,11 +1778,13 @@ def index():
                 '/auth?company=test': 'Rozpocznij autoryzację OAuth 2.0 dla testów',
                 '/callback': 'Callback OAuth (automatyczny redirect)',
                 '/api/token/status?company=md': 'GET - Sprawdź status tokenu dla Medidesk',
-                '/api/token/status?company=test': 'GET - Sprawdź status tokenu dla testów'
+                '/api/token/status?company=test': 'GET - Sprawdź status tokenu dla testów',
+                '/api/cache/stats': 'GET - Statystyki cache (hit/miss) i puli połączeń'
             },
             '👥 Kontrahenci': {
                 '/api/contractor/<nip>': 'GET - Sprawdź kontrahenta po NIP (wFirma)',
-                '/api/contractor/add': 'POST - Dodaj nowego kontrahenta'
+                '/api/contractor/add': 'POST - Dodaj nowego kontrahenta',
+                '/api/contractors/index/warm-up?company=md': 'POST - Wypełnij lokalny indeks NIP -> kontrahent (w tle)'
             },
             '📄 Faktury': {
                 '/api/invoice/create': 'POST - Utwórz fakturę',
@@ -1479,10 +1793,13 @@ def index():
                 '/api/series/list?company=test': 'GET - Lista dostępnych serii faktur'
             },
             '🚀 Workflow (All-in-One)': {
-                '/api/workflow/create-invoice-from-nip': 'POST - NIP→GUS→Kontrahent→Faktura→Email→PDF'
+                '/api/workflow/create-invoice-from-nip': 'POST - NIP→GUS→Kontrahent→Faktura→Email→PDF (?async=1 - w tle)',
+                '/api/workflow/batch-create-invoices': 'POST - Paczka faktur (body: {"items": [...]}), wynik NDJSON',
+                '/api/jobs/<job_id>': 'GET - Stan zadania asynchronicznego'
             },
             '🏢 GUS/REGON': {
-                '/api/gus/name-by-nip': 'POST - Pobierz dane firmy z GUS (body: {"nip": "..."})'
+                '/api/gus/name-by-nip': 'POST - Pobierz dane firmy z GUS (body: {"nip": "..."})',
+                '/api/gus/batch-validate': 'POST - Hurtowa walidacja NIP w GUS (body: {"nips": ["...", ...]})'
             }
         },
         'workflow_example': {
@@ -1545,11 +1862,11 @@ def auth():
         f"state={company}"  # state jest zwracany bez zmian w callbacku
     )
     
-    print(f"[AUTH] Rozpoczynam autoryzację dla firmy: {company.upper()}")
-    print(f"[AUTH] Client ID: {client_id[:10]}...")
-    print(f"[AUTH] Redirect URI: {REDIRECT_URI}")
-    print(f"[AUTH] State (company): {company}")
-    print(f"[AUTH] Scopes count: {len(scopes)}")
+    log_auth.info("Rozpoczynam autoryzację dla firmy: %s", company.upper())
+    log_auth.debug("Client ID: %s...", client_id[:10])
+    log_auth.debug("Redirect URI: %s", REDIRECT_URI)
+    log_auth.debug("State (company): %s", company)
+    log_auth.debug("Scopes count: %s", len(scopes))
     
     return redirect(auth_url)
 
@@ -1570,7 +1887,7 @@ def callback():
     
     config = get_company_config(company)
     
-    print(f"[CALLBACK] Otrzymano callback, state={state}, company={company.upper()}")
+    log_auth.info("Otrzymano callback, state=%s, company=%s", state, company.upper())
     
     if error:
         return jsonify({
@@ -1584,7 +1901,7 @@ def callback():
     
     # WAŻNE: redirect_uri musi być DOKŁADNIE taki jak w /auth (bez query params!)
     # Wymień kod na token używając credentials dla danej firmy
-    token_url = "https://api2.wfirma.pl/oauth2/token?oauth_version=2"
+    token_url = f"{WFIRMA_API_URL}/oauth2/token?oauth_version=2"
     data = {
         'grant_type': 'authorization_code',
         'code': code,
@@ -1593,12 +1910,12 @@ def callback():
         'redirect_uri': REDIRECT_URI  # Musi być identyczny jak zarejestrowany!
     }
     
-    print(f"[CALLBACK] [{company.upper()}] Wymiana kodu na token...")
-    print(f"[CALLBACK] [{company.upper()}] Client ID: {config['client_id'][:10] if config['client_id'] else 'BRAK'}...")
-    print(f"[CALLBACK] [{company.upper()}] Redirect URI: {REDIRECT_URI}")
+    log_auth.info("[%s] Wymiana kodu na token...", company.upper())
+    log_auth.debug("[%s] Client ID: %s...", company.upper(), config['client_id'][:10] if config['client_id'] else 'BRAK')
+    log_auth.debug("[%s] Redirect URI: %s", company.upper(), REDIRECT_URI)
     
     try:
-        response = requests.post(token_url, data=data)
+        response = wfirma_http('POST', token_url, company, data=data)
         if response.status_code != 200:
             return jsonify({
                 'error': 'Błąd wymiany tokenu',
@@ -1615,7 +1932,10 @@ def callback():
         # Zapisz token dla danej firmy (wraz z refresh_token)
         save_token(access_token, expires_in, refresh_token, company=company)
         
-        print(f"[CALLBACK] [{company.upper()}] ✓ Tokeny zapisane pomyślnie!")
+        # Nowy grant = dane z poprzedniej autoryzacji (company_id itd.) mogą być nieaktualne
+        invalidate_company_caches(company)
+        
+        log_auth.info("[%s] ✓ Tokeny zapisane pomyślnie!", company.upper())
         
         return jsonify({
             'message': f'Autoryzacja zakończona pomyślnie dla firmy {company.upper()}',
@@ -1646,11 +1966,12 @@ def token_refresh():
         company = DEFAULT_COMPANY
     
     config = get_company_config(company)
+    current_refresh_token = token_store.snapshot(config['prefix'])['refresh_token']
     
-    print(f"[TOKEN REFRESH] Próba odświeżenia tokenu dla firmy: {company.upper()}")
-    print(f"[TOKEN REFRESH] Client ID exists: {bool(config['client_id'])}")
-    print(f"[TOKEN REFRESH] Client Secret exists: {bool(config['client_secret'])}")
-    print(f"[TOKEN REFRESH] Refresh Token exists: {bool(config['refresh_token'])}")
+    log_token.info("Próba odświeżenia tokenu dla firmy: %s", company.upper())
+    log_token.debug("Client ID exists: %s", bool(config['client_id']))
+    log_token.debug("Client Secret exists: %s", bool(config['client_secret']))
+    log_token.debug("Refresh Token exists: %s", bool(current_refresh_token))
     
     if not config['client_id'] or not config['client_secret']:
         return jsonify({
@@ -1659,7 +1980,7 @@ def token_refresh():
             'company': company
         }), 400
     
-    if not config['refresh_token']:
+    if not current_refresh_token:
         return jsonify({
             'error': f'Brak REFRESH_TOKEN dla firmy {company.upper()}',
             'expected_var': f'{config["prefix"]}REFRESH_TOKEN',
@@ -1668,7 +1989,7 @@ def token_refresh():
         }), 400
     
     # Próba odświeżenia
-    new_token = refresh_access_token(forced_refresh_token=config['refresh_token'], company=company)
+    new_token = refresh_access_token(forced_refresh_token=current_refresh_token, company=company)
     
     if new_token:
         return jsonify({
@@ -1705,13 +2026,68 @@ def token_status():
         status['status'] = 'valid'
         # Loguj ostrzeżenie o refresh tokenie jeśli jest
         if status.get('warning'):
-            print(f"[WARNING] [{company.upper()}] {status['warning']}")
+            log_token.warning("[%s] %s", company.upper(), status['warning'])
         return jsonify(status)
     
     status['status'] = 'invalid'
     status['message'] = f'Brak ważnego tokenu dla firmy {company.upper()}. Przejdź do /auth?company={company}'
     return jsonify(status)
 
+@app.route('/api/cache/stats')
+@require_api_key
+def cache_stats():
+    """Statystyki cache i puli połączeń (hit/miss, rozmiary) - do diagnostyki wydajności."""
+    return jsonify({
+        'company_id': company_id_cache.stats(),
+        'series_index': series_index.stats(),
+        'contractor_index': contractor_index.stats() if contractor_index is not None else None,
+        'http_sessions': wfirma_sessions.stats(),
+        'gus_sessions': gus_sessions.stats(),
+        'gus_results': gus_cache.stats() if gus_cache is not None else None,
+        'gus_http_sessions': gus_http.stats(),
+        'pdf_cache': pdf_cache.stats(),
+        'token_store': token_store.stats(),
+        'render_env': render_env.stats(),
+        'jobs': job_store.stats(),
+        'idempotency': idempotency_store.stats() if idempotency_store is not None else None,
+        'metrics': metrics.stats(),
+    })
+
+
+@app.route('/api/contractors/index/warm-up', methods=['POST'])
+@require_api_key
+def contractor_index_warm_up():
+    """
+    Wypełnij lokalny indeks NIP -> kontrahent wszystkimi kontrahentami z wFirma.
+    Działa w tle (wątek) - postęp widać w logach i w /api/cache/stats.
+    Parametr ?company=md lub ?company=test
+    """
+    if contractor_index is None:
+        return jsonify({'error': 'Indeks kontrahentów jest wyłączony (WFIRMA_CONTRACTOR_INDEX=false)'}), 400
+    
+    company = (request.args.get('company') or DEFAULT_COMPANY).lower().strip()
+    if company not in SUPPORTED_COMPANIES:
+        company = DEFAULT_COMPANY
+    
+    token = load_token(silent=True, company=company)
+    if not token:
+        return jsonify({
+            'error': f'Brak autoryzacji dla firmy {company.upper()}',
+            'message': f'Przejdź do /auth?company={company}'
+        }), 401
+    
+    def run():
+        try:
+            company_id = wfirma_get_company_id(token, company)
+            saved = warm_up_contractor_index(token, company, company_id)
+            log_cache.info("Warm-up indeksu kontrahentów (%s) zakończony: %s kontrahentów", company, saved)
+        except Exception as e:
+            log_cache.warning("Warm-up indeksu kontrahentów (%s) przerwany: %s", company, e)
+    
+    threading.Thread(target=run, name=f'contractor-warm-up-{company}', daemon=True).start()
+    return jsonify({'success': True, 'company': company, 'message': 'Warm-up uruchomiony w tle'}), 202
+
+
 @app.route('/api/contractor/<nip>')
 @require_api_key
 @require_token
@@ -1753,6 +2129,7 @@ def add_contractor(token):
 @app.route('/api/invoice/create', methods=['POST'])
 @require_api_key
 @require_token
+@idempotent
 def create_invoice(token):
     """Utwórz fakturę"""
     data = request.json
@@ -1771,31 +2148,98 @@ def create_invoice(token):
     }), status or 500
 
 
+def wfirma_fetch_invoice_pdf_to_cache(token: str, invoice_id: str, company_id: str | None = None, company: str = None) -> str | None:
+    """
+    Pobierz PDF faktury strumieniowo prosto do cache na dysku (bez trzymania całości w pamięci).
+    Zwraca ścieżkę pliku albo None gdy pobranie się nie powiodło.
+    """
+    cached_path = pdf_cache.get(invoice_id)
+    if cached_path:
+        return cached_path
+    try:
+        resp = wfirma_get_invoice_pdf(token, invoice_id, company_id, company)
+        try:
+            if resp.status_code != 200 or 'pdf' not in resp.headers.get('Content-Type', '').lower():
+                log_wfirma.warning("PDF download failed: %s", resp.status_code)
+                return None
+            # Nagłówki przyszły w invoices/download - tu mierzymy pobranie treści PDF
+            with metrics.timed('wfirma', 'invoices/download.body') as call:
+                for chunk in pdf_cache.tee(invoice_id, resp.iter_content(chunk_size=PDF_STREAM_CHUNK_SIZE)):
+                    call.received += len(chunk)
+        finally:
+            resp.close()
+        path = pdf_cache.path(invoice_id)
+        log_wfirma.debug("PDF saved: %s", path)
+        return path if os.path.exists(path) else None
+    except Exception as e:
+        log_wfirma.warning("PDF exception: %s", e)
+        return None
+
+
 @app.route('/api/invoice/<invoice_id>/pdf', methods=['GET'])
 @require_token
 def download_invoice_pdf(token, invoice_id):
-    """Pobierz PDF faktury i zwróć jako plik do pobrania"""
-    company_id = wfirma_get_company_id(token)
-    
-    try:
-        resp = wfirma_get_invoice_pdf(token, invoice_id, company_id)
-        
-        if resp.status_code == 200 and 'pdf' in resp.headers.get('Content-Type', '').lower():
-            # Zwróć PDF jako response
-            return Response(
-                resp.content,
+    """
+    Pobierz PDF faktury i zwróć jako plik do pobrania.
+    PDF jest przekazywany strumieniowo (kawałkami) - worker nie trzyma całego pliku w pamięci.
+    """
+    # Faktura już pobrana - plik z dysku przez wsgi.file_wrapper (sendfile), bez wywołania wFirma
+    cached_path = pdf_cache.get(invoice_id)
+    if cached_path:
+        try:
+            return send_file(
+                os.path.abspath(cached_path),
                 mimetype='application/pdf',
-                headers={'Content-Disposition': f'attachment; filename=faktura_{invoice_id}.pdf'}
+                as_attachment=True,
+                download_name=f'faktura_{invoice_id}.pdf',
+                conditional=True,
             )
-        else:
-            return jsonify({
-                'error': 'Nie udało się pobrać PDF',
-                'status': resp.status_code,
-                'details': resp.text[:300] if resp.text else ''
-            }), resp.status_code
+        except OSError as e:
+            # Plik usunięty w międzyczasie (eviction) - pobierz z wFirma
+            log_cache.warning("Plik faktury %s zniknął z cache: %s", invoice_id, e)
+
+    # company_id tylko z cache - invoices/download działa też bez niego (domyślna firma),
+    # więc nie dokładamy wywołania companies/find
+    _, company_id = wfirma_cached_company_id(token)
+
+    try:
+        resp = wfirma_get_invoice_pdf(token, invoice_id, company_id)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    if resp.status_code != 200 or 'pdf' not in resp.headers.get('Content-Type', '').lower():
+        details = resp.text[:300] if resp.text else ''
+        resp.close()
+        return jsonify({
+            'error': 'Nie udało się pobrać PDF',
+            'status': resp.status_code,
+            'details': details
+        }), resp.status_code
+
+    def upstream_chunks():
+        # iter_content czyta z wFirma dopiero gdy poprzedni blok został wysłany do klienta
+        # (backpressure) - w pamięci jest najwyżej jeden blok
+        for chunk in resp.iter_content(chunk_size=PDF_STREAM_CHUNK_SIZE):
+            if chunk:
+                yield chunk
+
+    def generate():
+        try:
+            # Pusty kawałek = serwer WSGI wysyła nagłówki od razu, zanim przyjdzie pierwszy blok PDF
+            yield b''
+            # Równolegle zapis do cache (plik pojawia się dopiero po pobraniu całości)
+            yield from pdf_cache.tee(invoice_id, upstream_chunks())
+        except Exception as e:
+            log_wfirma.warning("PDF stream przerwany (invoice %s): %s", invoice_id, e)
+        finally:
+            resp.close()  # zwraca połączenie do puli keep-alive
+
+    headers = {'Content-Disposition': f'attachment; filename=faktura_{invoice_id}.pdf'}
+    content_length = resp.headers.get('Content-Length')
+    if content_length and 'gzip' not in resp.headers.get('Content-Encoding', '').lower():
+        headers['Content-Length'] = content_length
+    return Response(generate(), mimetype='application/pdf', headers=headers, direct_passthrough=True)
+
 
 @app.route('/api/series/list')
 @require_api_key
@@ -1814,8 +2258,10 @@ def list_series(token):
             'message': f'Przejdź do /auth?company={company}'
         }), 401
     
-    company_id = wfirma_get_company_id(token)
-    series_list = wfirma_list_series(token, company_id)
+    company_id = wfirma_get_company_id(token, company)
+    series_list = wfirma_list_series(token, company_id, company)
+    if series_list:
+        series_index.store(company, series_list)
     
     return jsonify({
         'success': True,
@@ -1892,9 +2338,9 @@ def build_invoice_payload(invoice_input: dict, contractor: dict, token: str = No
                 else:
                     base_date = datetime.date.today()
                 payment_due_date = (base_date + datetime.timedelta(days=days_int)).isoformat()
-                print(f"[WFIRMA DEBUG] payment_due_date obliczony: {base_date} + {days_int} dni = {payment_due_date}")
+                log_wfirma.debug("payment_due_date obliczony: %s + %s dni = %s", base_date, days_int, payment_due_date)
             except Exception as e:
-                print(f"[WFIRMA DEBUG] Błąd obliczania payment_due_date: {e}")
+                log_wfirma.debug("Błąd obliczania payment_due_date: %s", e)
                 return None, 'Niepoprawny payment_due_days lub issue_date'
 
     # Używamy contractor_id (int) zamiast zagnieżdżonego obiektu
@@ -1915,7 +2361,7 @@ def build_invoice_payload(invoice_input: dict, contractor: dict, token: str = No
     # Seria faktur (opcjonalnie)
     if series_id:
         payload["series"] = {"id": series_id}
-        print(f"[WFIRMA DEBUG] Używam serii ID: {series_id}")
+        log_wfirma.debug("Używam serii ID: %s", series_id)
     
     if sale_date:
         payload["sale_date"] = sale_date
@@ -1986,7 +2432,7 @@ def build_invoice_payload(invoice_input: dict, contractor: dict, token: str = No
                 "vat_code": {"id": vat_code_id}
             }
         }
-        print(f"[WFIRMA DEBUG] Position: {name}, qty={qty_num}, price={price_num}, vat_code_id={vat_code_id}")
+        log_wfirma.debug("Position: %s, qty=%s, price=%s, vat_code_id=%s", name, qty_num, price_num, vat_code_id)
 
     # Struktura z kluczami numerycznymi (jak wFirma zwraca w odpowiedziach)
     payload["invoicecontents"] = invoice_contents_dict
@@ -1997,13 +2443,13 @@ def build_invoice_payload(invoice_input: dict, contractor: dict, token: str = No
         # Zaokrąglij do 2 miejsc po przecinku
         total_brutto_rounded = round(total_brutto, 2)
         payload["alreadypaid_initial"] = str(total_brutto_rounded)
-        print(f"[WFIRMA DEBUG] mark_as_paid=True, alreadypaid_initial={total_brutto_rounded}")
+        log_wfirma.debug("mark_as_paid=True, alreadypaid_initial=%s", total_brutto_rounded)
     
     # Debug: loguj typy danych w pierwszej pozycji
     if invoice_contents_dict and "0" in invoice_contents_dict:
         first_pos = invoice_contents_dict["0"]["invoicecontent"]
         try:
-            print(f"[WFIRMA DEBUG] invoice first position types: count={type(first_pos['count']).__name__}, price={type(first_pos['price']).__name__}, vat_code_id={first_pos['vat_code']['id']}")
+            log_wfirma.debug("invoice first position types: count=%s, price=%s, vat_code_id=%s", type(first_pos['count']).__name__, type(first_pos['price']).__name__, first_pos['vat_code']['id'])
         except Exception:
             pass
     
@@ -2012,15 +2458,27 @@ def build_invoice_payload(invoice_input: dict, contractor: dict, token: str = No
         payload["ereceipt_integration_receipt"] = {
             "email_to_auto_send": ereceipt_email
         }
-        print(f"[WFIRMA DEBUG] E-paragon: email={ereceipt_email}")
+        log_wfirma.debug("E-paragon: email=%s", ereceipt_email)
     
     return payload, None
 
 
+class WorkflowAbort(Exception):
+    """Przerwanie workflow z gotową odpowiedzią błędu - rzucane z kroków grafu (poza wątkiem requestu)."""
+
+    def __init__(self, body: dict, status: int):
+        super().__init__(body.get('error'))
+        self.body = body
+        self.status = status
+
+
 @app.route('/api/workflow/create-invoice-from-nip', methods=['POST'])
 @require_api_key
+@idempotent
 def workflow_create_invoice():
-    """Pełny workflow: NIP -> (GUS) -> kontrahent -> faktura."""
+    """Pełny workflow: NIP -> (GUS) -> kontrahent -> faktura. Z ?async=1 - zadanie w tle (202 + job_id)."""
+    if (request.args.get('async') or '').lower() in ('1', 'true'):
+        return enqueue_workflow_job()
     
     body = request.get_json(silent=True) or {}
     
@@ -2033,7 +2491,7 @@ def workflow_create_invoice():
         }), 400
     
     config = get_company_config(company)
-    print(f"[WORKFLOW] Używam konfiguracji dla firmy: {company.upper()} (prefix: {config['prefix']})")
+    log_workflow.info("Używam konfiguracji dla firmy: %s (prefix: %s)", company.upper(), config['prefix'], extra=SAMPLED)
     
     # Załaduj token dla wybranej firmy
     token = load_token(silent=False, company=company)
@@ -2047,7 +2505,7 @@ def workflow_create_invoice():
     # Sprawdź ostrzeżenie o wygasającym refresh tokenie
     days_remaining, warning = check_refresh_token_expiry_for_company(company)
     if warning:
-        print(f"[WARNING] [{company.upper()}] {warning}")
+        log_token.warning("[%s] %s", company.upper(), warning)
         # Wyślij powiadomienie jeśli < 7 dni
         if days_remaining is not None and days_remaining <= 7:
             send_token_expiry_notification(days_remaining, warning)
@@ -2065,6 +2523,20 @@ def workflow_create_invoice():
     invoice_input = body.get('invoice')
     email_address = (body.get('email') or '').strip()
     send_email_requested = bool(body.get('send_email')) or bool(email_address)
+    # Tryb zwrotu PDF: inline (base64 w JSON, domyślnie), url (tylko link), none (bez PDF),
+    # multipart (multipart/mixed: najpierw JSON, potem surowy PDF) - także przez Accept: multipart/mixed
+    pdf_mode = body.get('pdf') or ''
+    if isinstance(pdf_mode, str):
+        pdf_mode = pdf_mode.lower().strip()
+    if not pdf_mode and 'multipart/mixed' in (request.headers.get('Accept') or '').lower():
+        pdf_mode = 'multipart'
+    pdf_mode_requested = bool(pdf_mode)  # pdf_mode w odpowiedzi tylko dla jawnie wybranego trybu
+    pdf_mode = pdf_mode or 'inline'
+    if not isinstance(pdf_mode, str) or pdf_mode not in PDF_RESPONSE_MODES:
+        return jsonify({
+            'error': f'Nieobsługiwany tryb pdf: {pdf_mode}',
+            'supported': PDF_RESPONSE_MODES
+        }), 400
     # Seria faktur - domyślna dla TEST i MD to "Eventy"
     default_series = 'Eventy'  # Używana dla obu firm
     series_name = (body.get('series_name') or default_series).strip()
@@ -2110,17 +2582,15 @@ def workflow_create_invoice():
             invoice_input['payment_due_date'] = payment_due_date_param
 
     # LOG: wejście requestu (bez danych wrażliwych)
-    try:
-        print("[WFIRMA DEBUG] workflow_create_invoice called")
-        print("[WFIRMA DEBUG] raw nip:", nip_raw)
-        print("[WFIRMA DEBUG] clean nip:", clean_nip)
-        print("[WFIRMA DEBUG] series_name:", series_name, "(case insensitive)")
-        print("[WFIRMA DEBUG] payment_status:", payment_status_param if payment_status_param else "default", "-> mark_as_paid:", mark_as_paid)
-        print("[WFIRMA DEBUG] issue_date:", issue_date_param, "payment_due_days:", payment_due_days_param, "payment_due_date:", payment_due_date_param)
-        print("[WFIRMA DEBUG] invoice keys:", list(invoice_input.keys()) if isinstance(invoice_input, dict) else invoice_input)
-        print("[WFIRMA DEBUG] send_email_requested:", send_email_requested, "email:", email_address)
-    except Exception:
-        pass
+    if log_wfirma.isEnabledFor(logging.DEBUG):
+        log_wfirma.debug("workflow_create_invoice called")
+        log_wfirma.debug("raw nip: %s", nip_raw)
+        log_wfirma.debug("clean nip: %s", clean_nip)
+        log_wfirma.debug("series_name: %s (case insensitive)", series_name)
+        log_wfirma.debug("payment_status: %s -> mark_as_paid: %s", payment_status_param if payment_status_param else "default", mark_as_paid)
+        log_wfirma.debug("issue_date: %s payment_due_days: %s payment_due_date: %s", issue_date_param, payment_due_days_param, payment_due_date_param)
+        log_wfirma.debug("invoice keys: %s", list(invoice_input.keys()) if isinstance(invoice_input, dict) else invoice_input)
+        log_wfirma.debug("send_email_requested: %s email: %s", send_email_requested, email_address)
 
     # Walidacja: musi być albo poprawny NIP albo dane purchaser
     if not nip_valid and not purchaser_name:
@@ -2132,356 +2602,368 @@ def workflow_create_invoice():
     if not invoice_input:
         return jsonify({'error': 'Brak sekcji invoice'}), 400
 
+    # Kroki workflow jako graf zależności - niezależne wywołania wFirma (kontrahent i seria,
+    # potem PDF i email) wykonują się równolegle na wspólnej puli workflow_executor.
+    # Błąd kroku = WorkflowAbort z gotową odpowiedzią (kroki działają poza wątkiem requestu).
+
+    # Kontrahenci rozwiązani raz dla całej paczki faktur (batch-create-invoices),
+    # NIP -> {'contractor', 'created' (czy utworzony w paczce dla tej pozycji)}
+    prefetched_contractor = (g.get('workflow_contractors') or {}).get(clean_nip) if nip_valid else None
+
     # 0) Pobierz company_id (ID Twojej firmy) - OPCJONALNE
     # Jeśli masz tylko jedną firmę, API użyje jej automatycznie
-    company_id = wfirma_get_company_id(token)
-    if company_id:
-        print(f"[WFIRMA DEBUG] company_id: {company_id}")
-    else:
-        print(f"[WFIRMA DEBUG] company_id: brak (użyje domyślnej firmy)")
+    def step_company_id():
+        company_id = wfirma_get_company_id(token, company)
+        if company_id:
+            log_wfirma.debug("company_id: %s", company_id)
+        else:
+            log_wfirma.debug("company_id: brak (użyje domyślnej firmy)")
+        return company_id
 
     # 1) Szukamy kontrahenta lub tworzymy na podstawie danych z wywołania
-    contractor = None
-    contractor_id = None
-    contractor_created = False
-    contractor_source = None  # 'wfirma', 'gus', 'purchaser'
-    resp_find = None  # Inicjalizacja dla przypadku gdy nie szukamy po NIP
-    
-    if nip_valid:
-        # NIP poprawny - szukamy w wFirma
-        contractor, resp_find = wfirma_find_contractor_by_nip(token, clean_nip, company_id)
-        contractor_id = contractor.get('id') if contractor else None
-        
-        try:
-            print("[WFIRMA DEBUG] find_contractor_by_nip contractor_id:", contractor_id)
-            print("[WFIRMA DEBUG] find_contractor_by_nip raw contractor:", contractor)
-            if resp_find is not None:
-                print("[WFIRMA DEBUG] find response status:", resp_find.status_code)
-                body_txt = resp_find.text or ""
-                print("[WFIRMA DEBUG] find response body len:", len(body_txt))
-                print("[WFIRMA DEBUG] find response body snippet 2000:", body_txt[:2000])
-        except Exception:
-            pass
-        
-        if contractor_id:
+    def step_contractor(company_id):
+        contractor = None
+        contractor_id = None
+        contractor_created = False
+        contractor_source = None  # 'wfirma', 'gus', 'purchaser'
+        resp_find = None  # Inicjalizacja dla przypadku gdy nie szukamy po NIP
+
+        contractor_from_index = False
+        if nip_valid and prefetched_contractor:
+            # Kontrahent ustalony wcześniej dla całej paczki (batch-create-invoices) - traktowany jak wpis indeksu
+            contractor = prefetched_contractor['contractor']
+            contractor_id = contractor.get('id')
+            contractor_from_index = bool(contractor_id)
+            contractor_created = contractor_from_index and prefetched_contractor['created']
             contractor_source = 'wfirma'
-    
-    # 2) Jeśli brak kontrahenta i NIP poprawny – spróbuj GUS
-    if not contractor_id and nip_valid:
-        gus_records, gus_err = gus_lookup_nip(clean_nip)
-        try:
-            print("[WFIRMA DEBUG] gus_lookup_nip records len:", len(gus_records) if gus_records else gus_records, "err:", gus_err)
-            if gus_records:
-                print("[WFIRMA DEBUG] gus first record:", gus_records[0])
-        except Exception:
-            pass
-        
-        # Jeśli GUS znalazł dane - użyj ich do stworzenia kontrahenta
-        if gus_records and len(gus_records) > 0:
-            gus_first = gus_records[0]
-            # Format adresu jak w wFirma
-            street_base = gus_first.get('ulica') or ""
-            nr_domu = gus_first.get('nrNieruchomosci') or ""
-            nr_lokalu = gus_first.get('nrLokalu') or ""
-            
-            if street_base and nr_domu and nr_lokalu:
-                street_full = f"{street_base} {nr_domu}/{nr_lokalu}"
-            elif street_base and nr_domu:
-                street_full = f"{street_base} {nr_domu}"
-            else:
-                street_full = street_base
-
-            contractor_payload = {
-                "name": gus_first.get('nazwa') or clean_nip,
-                "altname": gus_first.get('nazwa') or clean_nip,
-                "nip": clean_nip,
-                "tax_id_type": "nip",
-                "street": street_full,
-                "zip": gus_first.get('kodPocztowy') or "",
-                "city": gus_first.get('miejscowosc') or "",
-                "country": "PL",
-            }
-            contractor_source = 'gus'
-            print(f"[WORKFLOW] Tworzę kontrahenta z danych GUS: {contractor_payload.get('name')}")
-        else:
-            # GUS nie znalazł - fallback na dane purchaser jeśli dostępne
-            if purchaser_name:
-                print(f"[WORKFLOW] GUS nie znalazł NIP {clean_nip}, używam danych purchaser")
-                contractor_payload = {
-                    "name": purchaser_name,
-                    "altname": purchaser_name,
-                    "nip": clean_nip,  # Zachowaj NIP nawet jeśli GUS go nie zna
-                    "tax_id_type": "nip",
-                    "street": purchaser_address,
-                    "zip": purchaser_zip,
-                    "city": purchaser_city,
-                    "country": "PL",
-                }
-                contractor_source = 'purchaser_fallback'
-            else:
-                return jsonify({'error': 'GUS nie znalazł firmy dla podanego NIP i brak danych purchaser'}), 404
-        
-        try:
-            print("[WFIRMA DEBUG] create contractor payload:", contractor_payload)
-        except Exception:
-            pass
+        elif nip_valid and contractor_index is not None:
+            # Stały klient - kontrahent z lokalnego indeksu, bez wywołania contractors/find
+            contractor = contractor_index.get(company, clean_nip)
+            contractor_id = contractor.get('id') if contractor else None
+            contractor_from_index = bool(contractor_id)
+            if contractor_from_index:
+                log_workflow.info("Kontrahent z lokalnego indeksu: NIP %s -> ID %s", clean_nip, contractor_id, extra=SAMPLED)
+                contractor_source = 'wfirma'
+
+        gus_speculative = None
+        if nip_valid and not contractor_from_index:
+            if gus_speculative_executor is not None and gus_cached_nip(clean_nip) is None:
+                # GUS równolegle z contractors/find - wynik użyty tylko dla nowego kontrahenta
+                gus_speculative = Speculative(
+                    gus_speculative_executor, lambda: gus_lookup_nip(clean_nip), wrap=bind_request_timings,
+                    on_settle=lambda outcome, seconds: metrics.observe_speculative('gus_lookup', outcome, seconds),
+                )
+            # NIP poprawny - szukamy w wFirma
+            try:
+                contractor, resp_find = wfirma_find_contractor_by_nip(token, clean_nip, company_id, company)
+            except Exception:
+                if gus_speculative is not None:
+                    gus_speculative.discard()
+                raise
+            contractor_id = contractor.get('id') if contractor else None
+            if contractor_id and gus_speculative is not None:
+                gus_speculative.discard()
+                log_gus.debug("Spekulatywne zapytanie GUS dla NIP=%s niepotrzebne (kontrahent w wFirma)", clean_nip)
+
+            log_wfirma.debug("find_contractor_by_nip contractor_id: %s", contractor_id)
+            log_wfirma.debug("find_contractor_by_nip raw contractor: %s", contractor)
+            if resp_find is not None:
+                log_wfirma.debug("find response status: %s body: %.2000s", resp_find.status_code, lazy(lambda: resp_find.text))
 
-        new_contractor, resp_add = wfirma_add_contractor(token, contractor_payload, company_id)
-        
-        # Obsługa wyniku tworzenia kontrahenta
-        try:
-            print("[WFIRMA DEBUG] add contractor status:", resp_add.status_code if resp_add else None)
-            if resp_add is not None:
-                body_txt = resp_add.text or ""
-                print("[WFIRMA DEBUG] add contractor body len:", len(body_txt))
-                print("[WFIRMA DEBUG] add contractor FULL body:", body_txt)
-        except Exception:
-            pass
-        
-        if not new_contractor:
-            status = resp_add.status_code if resp_add else None
-            return jsonify({
-                'error': 'Nie udało się dodać kontrahenta w wFirma',
-                'status': status,
-                'details': resp_add.text if resp_add else 'Brak odpowiedzi',
-                'contractor_payload': contractor_payload,
-                'contractor_source': contractor_source
-            }), status or 502
-
-        contractor = new_contractor
-        contractor_id = contractor.get('id')
-        contractor_created = True
-    
-    # 3) Jeśli NIP niepoprawny - użyj danych purchaser (osoba fizyczna)
-    elif not contractor_id and not nip_valid and purchaser_name:
-        print(f"[WORKFLOW] NIP niepoprawny/brak, tworzę kontrahenta z danych purchaser: {purchaser_name}")
-        contractor_payload = {
-            "name": purchaser_name,
-            "altname": purchaser_name,
-            "tax_id_type": "none",  # Osoba fizyczna bez NIP
-            "street": purchaser_address,
-            "zip": purchaser_zip,
-            "city": purchaser_city,
-            "country": "PL",
-        }
-        contractor_source = 'purchaser'
-        
-        try:
-            print("[WFIRMA DEBUG] create contractor payload (purchaser):", contractor_payload)
-        except Exception:
-            pass
+            if contractor_id:
+                contractor_source = 'wfirma'
 
-        new_contractor, resp_add = wfirma_add_contractor(token, contractor_payload, company_id)
-        
-        # Obsługa wyniku tworzenia kontrahenta
-        try:
-            print("[WFIRMA DEBUG] add contractor status:", resp_add.status_code if resp_add else None)
-            if resp_add is not None:
-                body_txt = resp_add.text or ""
-                print("[WFIRMA DEBUG] add contractor body len:", len(body_txt))
-                print("[WFIRMA DEBUG] add contractor FULL body:", body_txt)
-        except Exception:
-            pass
-        
-        if not new_contractor:
-            status = resp_add.status_code if resp_add else None
-            return jsonify({
-                'error': 'Nie udało się dodać kontrahenta w wFirma',
-                'status': status,
-                'details': resp_add.text if resp_add else 'Brak odpowiedzi',
-                'contractor_payload': contractor_payload,
-                'contractor_source': contractor_source
-            }), status or 502
+        # 2) Jeśli brak kontrahenta i NIP poprawny – spróbuj GUS
+        if not contractor_id and nip_valid:
+            gus_records, gus_err = gus_speculative.use() if gus_speculative is not None else gus_lookup_nip(clean_nip)
+            log_wfirma.debug("gus_lookup_nip records len: %s err: %s", len(gus_records) if gus_records else gus_records, gus_err)
+            if gus_records:
+                log_wfirma.debug("gus first record: %s", gus_records[0])
 
-        contractor = new_contractor
-        contractor_id = contractor.get('id')
-        contractor_created = True
+            # Jeśli GUS znalazł dane - użyj ich do stworzenia kontrahenta
+            if gus_records and len(gus_records) > 0:
+                contractor_payload = contractor_payload_from_gus(gus_records[0], clean_nip)
+                contractor_source = 'gus'
+                log_workflow.info("Tworzę kontrahenta z danych GUS: %s", contractor_payload.get('name'))
+            else:
+                # GUS nie znalazł - fallback na dane purchaser jeśli dostępne
+                if purchaser_name:
+                    log_workflow.info("GUS nie znalazł NIP %s, używam danych purchaser", clean_nip)
+                    contractor_payload = contractor_payload_from_purchaser(
+                        purchaser_name, purchaser_address, purchaser_zip, purchaser_city, clean_nip)
+                    contractor_source = 'purchaser_fallback'
+                else:
+                    raise WorkflowAbort({'error': 'GUS nie znalazł firmy dla podanego NIP i brak danych purchaser'}, 404)
 
-    if not contractor_id:
-        status = resp_find.status_code if resp_find else None
-        # Log diagnostyczny z odpowiedzi find (bez wrażliwych danych) – ułatwia debug na Render
-        try:
-            print("[WFIRMA DEBUG] find response status:", status)
-            if resp_find is not None:
-                print("[WFIRMA DEBUG] find response body snippet:", (resp_find.text or "")[:500])
-            print("[WFIRMA DEBUG] contractor object before failure:", contractor)
-        except Exception:
-            pass
-        return jsonify({
-            'error': 'Nie udało się uzyskać ID kontrahenta w wFirma',
-            'status': status
-        }), status or 502
+            log_wfirma.debug("create contractor payload: %s", contractor_payload)
 
-    # 3) Szukamy serii faktur (opcjonalnie)
-    series_id = None
-    if series_name:
-        series = wfirma_find_series_by_name(token, series_name, company_id)
-        if series and series.get('id'):
-            series_id = int(series.get('id'))
-            print(f"[WORKFLOW] Znaleziono serię '{series_name}' -> ID {series_id}")
-        else:
-            print(f"[WORKFLOW] UWAGA: Nie znaleziono serii '{series_name}', użyję domyślnej")
-            # Loguj dostępne serie żeby ułatwić debugowanie
-            available_series = wfirma_list_series(token, company_id)
-            if available_series:
-                print(f"[WORKFLOW] Dostępne serie ({len(available_series)}):")
-                for s in available_series:
-                    print(f"[WORKFLOW]   - '{s['name']}' (ID: {s['id']}, szablon: {s['template']})")
-    
-    # 4) Budujemy payload faktury/proformy/paragonu (z alreadypaid_initial jeśli mark_as_paid=True)
-    invoice_payload, map_err = build_invoice_payload(invoice_input, contractor, token, series_id=series_id, mark_as_paid=mark_as_paid, document_type=document_type_param, ereceipt_email=ereceipt_email)
-    try:
-        print("[WFIRMA DEBUG] invoice payload:", invoice_payload)
-        if invoice_payload and 'invoicecontents' in invoice_payload:
-            import json as json_lib
-            print("[WFIRMA DEBUG] invoicecontents JSON:", json_lib.dumps(invoice_payload['invoicecontents'], ensure_ascii=False))
-    except Exception as e:
-        print("[WFIRMA DEBUG] log error:", e)
-    if map_err:
-        return jsonify({'error': map_err}), 400
-
-    # Dodaj description (komentarz/nazwa wydarzenia) do faktury
-    if invoice_payload:
-        if company in ('test', 'md_test'):
-            # Tryb TEST lub MD_TEST: ostrzeżenie + opcjonalnie nazwa wydarzenia
-            test_warning = (
-                "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
-                "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
-                "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
-                "*** DOKUMENT WYSTAWIONY W CELACH TESTOWYCH ***\n"
-                "*** NIE STANOWI PODSTAWY DO ZAPŁATY ***"
-            )
-            if description_param:
-                invoice_payload["description"] = f"{test_warning}\n\n{description_param}"
+            new_contractor, resp_add = wfirma_add_contractor(token, contractor_payload, company_id, company)
+
+            # Obsługa wyniku tworzenia kontrahenta
+            if resp_add is not None:
+                log_wfirma.debug("add contractor status: %s body: %s", resp_add.status_code, lazy(lambda: resp_add.text))
+
+            if not new_contractor:
+                status = resp_add.status_code if resp_add else None
+                raise WorkflowAbort({
+                    'error': 'Nie udało się dodać kontrahenta w wFirma',
+                    'status': status,
+                    'details': resp_add.text if resp_add else 'Brak odpowiedzi',
+                    'contractor_payload': contractor_payload,
+                    'contractor_source': contractor_source
+                }, status or 502)
+
+            contractor = new_contractor
+            contractor_id = contractor.get('id')
+            contractor_created = True
+
+        # 3) Jeśli NIP niepoprawny - użyj danych purchaser (osoba fizyczna)
+        elif not contractor_id and not nip_valid and purchaser_name:
+            log_workflow.info("NIP niepoprawny/brak, tworzę kontrahenta z danych purchaser: %s", purchaser_name)
+            contractor_payload = contractor_payload_from_purchaser(
+                purchaser_name, purchaser_address, purchaser_zip, purchaser_city)
+            contractor_source = 'purchaser'
+
+            log_wfirma.debug("create contractor payload (purchaser): %s", contractor_payload)
+
+            new_contractor, resp_add = wfirma_add_contractor(token, contractor_payload, company_id, company)
+
+            # Obsługa wyniku tworzenia kontrahenta
+            if resp_add is not None:
+                log_wfirma.debug("add contractor status: %s body: %s", resp_add.status_code, lazy(lambda: resp_add.text))
+
+            if not new_contractor:
+                status = resp_add.status_code if resp_add else None
+                raise WorkflowAbort({
+                    'error': 'Nie udało się dodać kontrahenta w wFirma',
+                    'status': status,
+                    'details': resp_add.text if resp_add else 'Brak odpowiedzi',
+                    'contractor_payload': contractor_payload,
+                    'contractor_source': contractor_source
+                }, status or 502)
+
+            contractor = new_contractor
+            contractor_id = contractor.get('id')
+            contractor_created = True
+
+        if not contractor_id:
+            status = resp_find.status_code if resp_find else None
+            # Log diagnostyczny z odpowiedzi find (bez wrażliwych danych) – ułatwia debug na Render
+            log_wfirma.warning("Brak kontrahenta - find response status: %s body: %.500s", status, lazy(lambda: resp_find.text if resp_find is not None else ''))
+            log_wfirma.debug("contractor object before failure: %s", contractor)
+            raise WorkflowAbort({
+                'error': 'Nie udało się uzyskać ID kontrahenta w wFirma',
+                'status': status
+            }, status or 502)
+
+        return {'contractor': contractor, 'created': contractor_created, 'from_index': contractor_from_index}
+
+    # 3) Szukamy serii faktur (opcjonalnie) - niezależnie od kontrahenta
+    def step_series(company_id):
+        series_id = None
+        if series_name:
+            series = wfirma_find_series_by_name(token, series_name, company_id, company)
+            if series and series.get('id'):
+                series_id = int(series.get('id'))
+                log_workflow.info("Znaleziono serię '%s' -> ID %s", series_name, series_id, extra=SAMPLED)
             else:
-                invoice_payload["description"] = test_warning
-            print(f"[WORKFLOW] Tryb {company.upper()} - dodano ostrzeżenie na fakturze")
-        elif description_param:
-            # Tryb PRODUKCJA (md): tylko nazwa wydarzenia (jeśli podana)
-            invoice_payload["description"] = description_param
-            print(f"[WORKFLOW] Dodano opis na fakturze: {description_param}")
-
-    invoice, resp_inv = wfirma_create_invoice(token, invoice_payload, company_id)
-    try:
-        print("[WFIRMA DEBUG] invoice create status:", resp_inv.status_code if resp_inv else None)
+                log_workflow.warning("UWAGA: Nie znaleziono serii '%s', użyję domyślnej", series_name)
+                # Loguj dostępne serie żeby ułatwić debugowanie (z indeksu - bez wywołania API)
+                available_series = series_index.all(company)
+                if available_series:
+                    log_workflow.info("Dostępne serie (%s):", len(available_series))
+                    for s in available_series:
+                        log_workflow.info("  - '%s' (ID: %s, szablon: %s)", s['name'], s['id'], s['template'])
+        return series_id
+
+    def step_invoice(company_id, contractor, series):
+        # 4) Budujemy payload faktury/proformy/paragonu (z alreadypaid_initial jeśli mark_as_paid=True)
+        invoice_payload, map_err = build_invoice_payload(invoice_input, contractor['contractor'], token, series_id=series, mark_as_paid=mark_as_paid, document_type=document_type_param, ereceipt_email=ereceipt_email)
+        log_wfirma.debug("invoice payload: %s", invoice_payload)
+        if invoice_payload and 'invoicecontents' in invoice_payload:
+            log_wfirma.debug("invoicecontents JSON: %s", lazy_json(invoice_payload['invoicecontents']))
+        if map_err:
+            raise WorkflowAbort({'error': map_err}, 400)
+
+        # Dodaj description (komentarz/nazwa wydarzenia) do faktury
+        if invoice_payload:
+            if company in ('test', 'md_test'):
+                # Tryb TEST lub MD_TEST: ostrzeżenie + opcjonalnie nazwa wydarzenia
+                test_warning = (
+                    "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
+                    "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
+                    "!!! FAKTURA NIEWAŻNA - TRYB TESTOWY !!!\n"
+                    "*** DOKUMENT WYSTAWIONY W CELACH TESTOWYCH ***\n"
+                    "*** NIE STANOWI PODSTAWY DO ZAPŁATY ***"
+                )
+                if description_param:
+                    invoice_payload["description"] = f"{test_warning}\n\n{description_param}"
+                else:
+                    invoice_payload["description"] = test_warning
+                log_workflow.info("Tryb %s - dodano ostrzeżenie na fakturze", company.upper(), extra=SAMPLED)
+            elif description_param:
+                # Tryb PRODUKCJA (md): tylko nazwa wydarzenia (jeśli podana)
+                invoice_payload["description"] = description_param
+                log_workflow.info("Dodano opis na fakturze: %s", description_param, extra=SAMPLED)
+
+        invoice, resp_inv = wfirma_create_invoice(token, invoice_payload, company_id, company)
         if resp_inv is not None:
-            body_txt = resp_inv.text or ""
-            print("[WFIRMA DEBUG] invoice create body len:", len(body_txt))
-            print("[WFIRMA DEBUG] invoice create body snippet 2000:", body_txt[:2000])
-        print("[WFIRMA DEBUG] invoice obj:", invoice)
-    except Exception:
-        pass
-    if not invoice:
-        status = resp_inv.status_code if resp_inv else None
-        error_details = resp_inv.text if resp_inv else 'Brak odpowiedzi'
-        
-        # Specjalny komunikat dla błędu schematu księgowego
-        if 'schematu księgowego' in error_details.lower() or 'schematu ksiegowego' in error_details.lower():
-            return jsonify({
-                'error': 'Brak konfiguracji schematu księgowego w wFirma',
-                'message': 'W panelu wFirma ustaw: Ustawienia → Firma → Księgowość → Schematy księgowe',
-                'details': error_details,
-                'status': status
-            }), 400
-        
-        return jsonify({
-            'error': 'Błąd podczas tworzenia faktury',
-            'status': status,
-            'details': error_details
-        }), status or 502
-
-    # Pobierz ID faktury
-    invoice_id = str(invoice.get('id') or invoice.get('invoice_id') or '')
-    if not invoice_id:
-        return jsonify({
-            'error': 'Brak ID faktury w odpowiedzi',
-            'invoice': invoice
-        }), 502
-    
+            log_wfirma.debug("invoice create status: %s body: %.2000s", resp_inv.status_code, lazy(lambda: resp_inv.text))
+        log_wfirma.debug("invoice obj: %s", invoice)
+        if not invoice:
+            status = resp_inv.status_code if resp_inv else None
+            error_details = resp_inv.text if resp_inv else 'Brak odpowiedzi'
+
+            if contractor['from_index'] and contractor_index is not None:
+                # Kontrahent z indeksu mógł zostać usunięty w wFirma - następnym razem szukamy od nowa
+                contractor_index.delete(company, clean_nip)
+
+            # Specjalny komunikat dla błędu schematu księgowego
+            if 'schematu księgowego' in error_details.lower() or 'schematu ksiegowego' in error_details.lower():
+                raise WorkflowAbort({
+                    'error': 'Brak konfiguracji schematu księgowego w wFirma',
+                    'message': 'W panelu wFirma ustaw: Ustawienia → Firma → Księgowość → Schematy księgowe',
+                    'details': error_details,
+                    'status': status
+                }, 400)
+
+            raise WorkflowAbort({
+                'error': 'Błąd podczas tworzenia faktury',
+                'status': status,
+                'details': error_details
+            }, status or 502)
+
+        # Pobierz ID faktury
+        invoice_id = str(invoice.get('id') or invoice.get('invoice_id') or '')
+        if not invoice_id:
+            raise WorkflowAbort({
+                'error': 'Brak ID faktury w odpowiedzi',
+                'invoice': invoice
+            }, 502)
+        return invoice, invoice_id
+
     # Sprawdź status płatności faktury
     # (alreadypaid_initial jest ustawiony przy tworzeniu faktury jeśli mark_as_paid=True)
-    payment_result = None
-    if mark_as_paid:
-        payment_state = invoice.get('paymentstate', 'unknown')
-        already_paid = invoice.get('alreadypaid', '0')
-        already_paid_initial = invoice.get('alreadypaid_initial', '')
-        invoice_total = invoice.get('total', '0')
-        
-        print(f"[WORKFLOW] Status płatności faktury: paymentstate={payment_state}, alreadypaid={already_paid}, alreadypaid_initial={already_paid_initial}, total={invoice_total}")
-        
-        if payment_state == 'paid' or already_paid_initial:
-            payment_result = {'success': True, 'method': 'alreadypaid_initial', 'paymentstate': payment_state}
-            print(f"[WORKFLOW] Faktura oznaczona jako opłacona (alreadypaid_initial przy tworzeniu)")
-        else:
-            # Fallback: jeśli alreadypaid_initial nie zadziałał, spróbuj payments/add
-            print(f"[WORKFLOW] UWAGA: alreadypaid_initial nie zadziałał, próbuję payments/add...")
-            invoice_total_float = float(invoice_total) if invoice_total else 0
-            if invoice_total_float > 0:
-                payment_date = invoice_input.get('issue_date') or invoice.get('date')
-                payment_cashbox_id = None
-                if invoice.get('payment_cashbox') and invoice['payment_cashbox'].get('id'):
-                    payment_cashbox_id = invoice['payment_cashbox']['id']
-                payment, resp_payment = wfirma_add_payment(token, invoice_id, invoice_total_float, payment_date, company_id, payment_cashbox_id)
-                if payment:
-                    payment_result = {'success': True, 'method': 'payments_add', 'payment': payment}
-                    print(f"[WORKFLOW] Płatność dodana przez payments/add (kwota: {invoice_total_float})")
+    def step_payment(company_id, invoice):
+        invoice, invoice_id = invoice
+        payment_result = None
+        if mark_as_paid:
+            payment_state = invoice.get('paymentstate', 'unknown')
+            already_paid = invoice.get('alreadypaid', '0')
+            already_paid_initial = invoice.get('alreadypaid_initial', '')
+            invoice_total = invoice.get('total', '0')
+
+            log_workflow.debug("Status płatności faktury: paymentstate=%s, alreadypaid=%s, alreadypaid_initial=%s, total=%s", payment_state, already_paid, already_paid_initial, invoice_total)
+
+            if payment_state == 'paid' or already_paid_initial:
+                payment_result = {'success': True, 'method': 'alreadypaid_initial', 'paymentstate': payment_state}
+                log_workflow.info("Faktura oznaczona jako opłacona (alreadypaid_initial przy tworzeniu)", extra=SAMPLED)
+            else:
+                # Fallback: jeśli alreadypaid_initial nie zadziałał, spróbuj payments/add
+                log_workflow.warning("UWAGA: alreadypaid_initial nie zadziałał, próbuję payments/add...")
+                invoice_total_float = float(invoice_total) if invoice_total else 0
+                if invoice_total_float > 0:
+                    payment_date = invoice_input.get('issue_date') or invoice.get('date')
+                    payment_cashbox_id = None
+                    if invoice.get('payment_cashbox') and invoice['payment_cashbox'].get('id'):
+                        payment_cashbox_id = invoice['payment_cashbox']['id']
+                    payment, resp_payment = wfirma_add_payment(token, invoice_id, invoice_total_float, payment_date, company_id, payment_cashbox_id, company)
+                    if payment:
+                        payment_result = {'success': True, 'method': 'payments_add', 'payment': payment}
+                        log_workflow.info("Płatność dodana przez payments/add (kwota: %s)", invoice_total_float)
+                    else:
+                        payment_result = {'success': False, 'error': 'Nie udało się dodać płatności'}
+                        log_workflow.warning("UWAGA: Nie udało się oznaczyć faktury jako opłaconej")
+        return payment_result
+
+    # ZAWSZE pobierz PDF faktury (niezależnie od emaila) - po płatności, żeby PDF miał aktualny status
+    def step_pdf(company_id, invoice, payment):
+        invoice, invoice_id = invoice
+        pdf_filename = None
+        pdf_base64 = None
+        pdf_content = None
+        if pdf_mode in ('url', 'multipart'):
+            # Strumieniowo prosto na dysk (cache) - PDF nie trafia do pamięci workera
+            pdf_filename = wfirma_fetch_invoice_pdf_to_cache(token, invoice_id, company_id, company)
+        elif pdf_mode == 'inline':
+            try:
+                resp_pdf = wfirma_get_invoice_pdf(token, invoice_id, company_id, company)
+                if resp_pdf.status_code == 200 and 'pdf' in resp_pdf.headers.get('Content-Type', '').lower():
+                    with metrics.timed('wfirma', 'invoices/download.body') as call:
+                        pdf_content = resp_pdf.content
+                        call.received = len(pdf_content)
+                    # Koduj PDF jako base64 dla zwrócenia w odpowiedzi
+                    pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
+
+                    # Zapisz też lokalnie (cache dla /api/invoice/<id>/pdf)
+                    pdf_filename = pdf_cache.put(invoice_id, pdf_content)
+                    log_wfirma.debug("PDF saved: %s (%s bytes)", pdf_filename, len(pdf_content))
                 else:
-                    payment_result = {'success': False, 'error': 'Nie udało się dodać płatności'}
-                    print(f"[WORKFLOW] UWAGA: Nie udało się oznaczyć faktury jako opłaconej")
-    
-    # ZAWSZE pobierz PDF faktury (niezależnie od emaila)
-    pdf_filename = None
-    pdf_base64 = None
-    pdf_content = None
-    try:
-        resp_pdf = wfirma_get_invoice_pdf(token, invoice_id, company_id)
-        if resp_pdf.status_code == 200 and 'pdf' in resp_pdf.headers.get('Content-Type', '').lower():
-            pdf_content = resp_pdf.content
-            # Koduj PDF jako base64 dla zwrócenia w odpowiedzi
-            pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
-            
-            # Zapisz też lokalnie
-            os.makedirs('invoices', exist_ok=True)
-            pdf_filename = f"invoices/faktura_{invoice_id}.pdf"
-            with open(pdf_filename, 'wb') as f:
-                f.write(pdf_content)
-            print(f"[WFIRMA DEBUG] PDF saved: {pdf_filename} ({len(pdf_content)} bytes)")
-        else:
-            print(f"[WFIRMA DEBUG] PDF download failed: {resp_pdf.status_code}")
-    except Exception as e:
-        print(f"[WFIRMA DEBUG] PDF exception: {e}")
-    
-    # Opcjonalnie wyślij fakturę mailem
-    email_result = None
-    if send_email_requested:
+                    log_wfirma.warning("PDF download failed: %s", resp_pdf.status_code)
+            except Exception as e:
+                log_wfirma.warning("PDF exception: %s", e)
+        return pdf_filename, pdf_base64, pdf_content
+
+    # Opcjonalnie wyślij fakturę mailem (równolegle z PDF).
+    # Zwraca (odpowiedź wFirma, błąd) - błąd zawiera pdf_saved, więc odpowiedź składamy po obu krokach.
+    def step_email(company_id, invoice, payment):
+        invoice, invoice_id = invoice
+        if not send_email_requested:
+            return None, None
         if not email_address or '@' not in email_address:
-            return jsonify({
+            return None, ({
                 'error': 'Brak lub niepoprawny email do wysyłki faktury',
                 'invoice': invoice,
-                'pdf_saved': pdf_filename
-            }), 400
+            }, 400)
 
-        resp_email = wfirma_send_invoice_email(token, invoice_id, email_address, company_id)
-        try:
-            print("[WFIRMA DEBUG] send email status:", resp_email.status_code if resp_email else None)
-            if resp_email is not None:
-                body_txt = resp_email.text or ""
-                print("[WFIRMA DEBUG] send email body len:", len(body_txt))
-                print("[WFIRMA DEBUG] send email body snippet:", body_txt[:500])
-        except Exception:
-            pass
+        resp_email = wfirma_send_invoice_email(token, invoice_id, email_address, company_id, company)
+        if resp_email is not None:
+            log_wfirma.debug("send email status: %s body: %.500s", resp_email.status_code, lazy(lambda: resp_email.text))
         if resp_email.status_code != 200:
-            return jsonify({
+            return None, ({
                 'error': 'Nie udało się wysłać faktury mailem',
                 'status': resp_email.status_code,
                 'details': resp_email.text[:500] if resp_email.text else '',
                 'invoice': invoice,
-                'pdf_saved': pdf_filename
-            }), resp_email.status_code
+            }, resp_email.status_code)
         try:
-            email_result = resp_email.json()
+            return resp_email.json(), None
         except Exception:
-            email_result = {}
+            return {}, None
+
+    graph = TaskGraph(workflow_executor, wrap=bind_request_timings, on_step=g.get('workflow_step_listener'))
+    graph.add('company_id', step_company_id)
+    graph.add('contractor', step_contractor, deps=('company_id',))
+    graph.add('series', step_series, deps=('company_id',))
+    graph.add('invoice', step_invoice, deps=('company_id', 'contractor', 'series'))
+    graph.add('payment', step_payment, deps=('company_id', 'invoice'))
+    graph.add('pdf', step_pdf, deps=('company_id', 'invoice', 'payment'))
+    graph.add('email', step_email, deps=('company_id', 'invoice', 'payment'))
+    debug_timeline = (request.headers.get('X-Debug-Timeline') or '').lower() in ('1', 'true')
+    try:
+        results = graph.run()
+    except WorkflowAbort as e:
+        timeline = graph.timeline()
+        log_workflow.debug("timeline (przerwany): %s", lazy_json(timeline))
+        if debug_timeline:
+            e.body['workflow_timeline'] = timeline
+        return jsonify(e.body), e.status
+    timeline = graph.timeline()
+    log_workflow.debug("timeline: %s", lazy_json(timeline))
+
+    series_id = results['series']
+    contractor = results['contractor']['contractor']
+    contractor_created = results['contractor']['created']
+    invoice, invoice_id = results['invoice']
+    payment_result = results['payment']
+    pdf_filename, pdf_base64, pdf_content = results['pdf']
+    email_result, email_error = results['email']
+    if email_error:
+        error_body, error_status = email_error
+        error_body['pdf_saved'] = pdf_filename
+        if debug_timeline:
+            error_body['workflow_timeline'] = timeline
+        return jsonify(error_body), error_status
 
     # Przygotuj odpowiedź
     # Pobierz status płatności z faktury (dla Make.com)
@@ -2513,13 +2995,18 @@ def workflow_create_invoice():
         'pdf_saved': pdf_filename
     }
     
+    if pdf_mode_requested:
+        response['pdf_mode'] = pdf_mode
+    if debug_timeline:
+        response['workflow_timeline'] = timeline
+
     # Dodaj PDF jako base64 (dla Make.com - żeby nie robić osobnego HTTP request)
     if pdf_base64:
         response['pdf_base64'] = pdf_base64
         response['pdf_size_bytes'] = len(pdf_content) if pdf_content else 0
     
     # Dodaj URL do pobrania PDF (dla opcjonalnego użycia)
-    if invoice_id:
+    if invoice_id and pdf_mode != 'none':
         base_url = request.url_root.rstrip('/') if hasattr(request, 'url_root') else REDIRECT_URI.replace('/callback', '')
         response['pdf_url'] = f"{base_url}/api/invoice/{invoice_id}/pdf"
     
@@ -2528,10 +3015,416 @@ def workflow_create_invoice():
     if warning:
         response['token_warning'] = warning
         response['refresh_token_days_remaining'] = round(days_remaining, 1) if days_remaining else 0
-    
+
+    if pdf_mode == 'multipart':
+        return multipart_json_pdf_response(response, pdf_filename, f'faktura_{invoice_id}.pdf')
+
     return jsonify(response)
 
 
+def multipart_json_pdf_response(payload: dict, pdf_path: str | None, pdf_name: str) -> Response:
+    """
+    Odpowiedź multipart/mixed: część 1 = JSON, część 2 = surowy PDF czytany z dysku blokami.
+    Gdy PDF nie został pobrany (pdf_path=None) wysyłamy tylko część JSON.
+    """
+    pdf_file = None
+    if pdf_path:
+        try:
+            pdf_file = open(pdf_path, 'rb')
+        except OSError as e:
+            log_wfirma.warning("PDF do multipart niedostępny (%s): %s", pdf_path, e)
+    boundary = uuid.uuid4().hex
+
+    def generate():
+        try:
+            yield (
+                f'--{boundary}\r\nContent-Type: application/json; charset=utf-8\r\n\r\n'.encode('ascii')
+                + app.json.dumps(payload).encode('utf-8') + b'\r\n'
+            )
+            if pdf_file is not None:
+                size = os.fstat(pdf_file.fileno()).st_size
+                yield (
+                    f'--{boundary}\r\nContent-Type: application/pdf\r\n'
+                    f'Content-Disposition: attachment; filename="{pdf_name}"\r\n'
+                    f'Content-Length: {size}\r\n\r\n'
+                ).encode('ascii')
+                while True:
+                    chunk = pdf_file.read(PDF_STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+                yield b'\r\n'
+            yield f'--{boundary}--\r\n'.encode('ascii')
+        finally:
+            if pdf_file is not None:
+                pdf_file.close()
+
+    return Response(generate(), mimetype=f'multipart/mixed; boundary={boundary}', direct_passthrough=True)
+
+
+# ==================== ZADANIA ASYNCHRONICZNE (workflow ?async=1) ====================
+
+# Nagłówki przekazywane do workflow wykonywanego poza requestem (zadania, paczki) - reszta jest w body
+WORKFLOW_FORWARDED_HEADERS = ('X-API-Key', 'Cache-Control', 'X-Debug-Timeline')
+
+
+def enqueue_workflow_job():
+    """
+    Przyjmij workflow jako zadanie w tle: 202 + job_id od razu, wynik pod GET /api/jobs/<id>.
+    Opcjonalne pole body "webhook_url" - POST ze stanem zadania po jego zakończeniu.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'Wymagane body JSON (obiekt)'}), 400
+    pdf_mode = body.get('pdf') or ''
+    if not isinstance(pdf_mode, str) or pdf_mode.lower().strip() not in ('', *PDF_RESPONSE_MODES):
+        return jsonify({
+            'error': f'Nieobsługiwany tryb pdf: {pdf_mode}',
+            'supported': PDF_RESPONSE_MODES
+        }), 400
+    if pdf_mode.lower().strip() == 'multipart':
+        return jsonify({'error': 'Tryb pdf=multipart nie jest dostępny dla ?async=1 (użyj inline, url lub none)'}), 400
+
+    webhook_url = (body.get('webhook_url') or '').strip() or None
+    if webhook_url and urlsplit(webhook_url).scheme not in ('http', 'https'):
+        return jsonify({'error': 'webhook_url musi być adresem http(s)'}), 400
+
+    job_id = job_store.create('workflow', webhook_url=webhook_url)
+    headers = {name: request.headers[name] for name in WORKFLOW_FORWARDED_HEADERS if name in request.headers}
+    job_executor.submit(run_workflow_job, job_id, body, headers, request.host_url)
+    log_workflow.info("Zadanie %s przyjęte (webhook: %s)", job_id, 'tak' if webhook_url else 'nie')
+
+    status_url = f"{request.host_url.rstrip('/')}/api/jobs/{job_id}"
+    response = jsonify({'job_id': job_id, 'status': 'queued', 'status_url': status_url})
+    response.headers['Location'] = status_url
+    return response, 202
+
+
+def run_workflow_job(job_id: str, body: dict, headers: dict, base_url: str) -> None:
+    """Wykonaj workflow w wątku puli job_executor - ten sam kod co request synchroniczny."""
+    job_store.start(job_id)
+    timings = start_request_timings()
+    http_status, result, error = 500, None, None
+    try:
+        with app.test_request_context('/api/workflow/create-invoice-from-nip', method='POST', json=body,
+                                      headers=headers, base_url=base_url,
+                                      environ_overrides={'wfirma.job_id': job_id}):
+            g.workflow_step_listener = lambda step, status: job_store.step(job_id, step, status)
+            response = app.make_response(workflow_create_invoice())
+            http_status = response.status_code
+            result = response.get_json(silent=True)
+    except Exception as e:
+        log_workflow.exception("Zadanie %s przerwane wyjątkiem", job_id)
+        error = f'{type(e).__name__}: {e}'
+        result = {'error': 'Błąd wewnętrzny workflow', 'details': error}
+    finally:
+        metrics.observe_endpoint('/api/workflow/create-invoice-from-nip (async)', 'POST', http_status,
+                                 time.perf_counter() - timings.started)
+        end_request_timings()
+
+    # Część błędów wFirma przychodzi z HTTP 200 (np. status ERROR w treści) - liczy się pole "error"
+    if error is None and isinstance(result, dict):
+        error = result.get('error')
+    status = 'succeeded' if http_status < 400 and not error else 'failed'
+    job_store.finish(job_id, status, http_status, result, error)
+    log_workflow.info("Zadanie %s zakończone: %s (HTTP %s)", job_id, status, http_status)
+
+    job = job_store.get(job_id)
+    if job and job.get('webhook'):
+        deliver_job_webhook(job)
+
+
+def deliver_job_webhook(job: dict) -> None:
+    """
+    POST stanu zakończonego zadania na webhook_url (do JOBS_WEBHOOK_RETRIES prób, odstęp 1, 2, 4 s...).
+    Z JOBS_WEBHOOK_SECRET nagłówek X-Webhook-Signature: sha256=<HMAC body>.
+    """
+    url = job['webhook']['url']
+    payload = json.dumps({key: value for key, value in job.items() if key != 'webhook'}, ensure_ascii=False).encode('utf-8')
+    headers = {'Content-Type': 'application/json', 'X-Job-Id': job['job_id']}
+    if JOBS_WEBHOOK_SECRET:
+        signature = hmac.new(JOBS_WEBHOOK_SECRET.encode('utf-8'), payload, hashlib.sha256).hexdigest()
+        headers['X-Webhook-Signature'] = f'sha256={signature}'
+
+    status = None
+    attempts = 0
+    for attempt in range(max(1, JOBS_WEBHOOK_RETRIES)):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+        attempts += 1
+        try:
+            resp = requests.post(url, data=payload, headers=headers, timeout=JOBS_WEBHOOK_TIMEOUT)
+            status = 'delivered' if resp.status_code < 400 else f'http_{resp.status_code}'
+        except requests.RequestException as e:
+            status = type(e).__name__
+        if status == 'delivered':
+            break
+        log_workflow.warning("Webhook zadania %s: próba %s nieudana (%s)", job['job_id'], attempts, status)
+    job_store.webhook_result(job['job_id'], status, attempts)
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@require_api_key
+def job_status(job_id):
+    """Stan zadania asynchronicznego: status, postęp kroków, a po zakończeniu odpowiedź workflow (result)."""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Nie znaleziono zadania', 'job_id': job_id}), 404
+    return jsonify(job)
+
+
+# ==================== PACZKA FAKTUR (batch-create-invoices) ====================
+
+def batch_item_nip(item) -> tuple[str, str] | None:
+    """(firma, NIP) pozycji paczki albo None (pozycja bez poprawnego NIP lub nie-obiekt)."""
+    if not isinstance(item, dict):
+        return None
+    company = str(item.get('company') or DEFAULT_COMPANY).lower().strip()
+    clean_nip = re.sub(r'[^0-9]', '', str(item.get('nip', '')))
+    return (company, clean_nip) if len(clean_nip) == 10 else None
+
+
+def batch_purchaser_payload(item: dict, clean_nip: str) -> dict | None:
+    """Payload purchaser_fallback z pozycji paczki (jak w workflow) albo None bez purchaser_name."""
+    fields = {name: item.get(name).strip() if isinstance(item.get(name), str) else ''
+              for name in ('purchaser_name', 'purchaser_address', 'purchaser_zip', 'purchaser_city')}
+    if not fields['purchaser_name']:
+        return None
+    return contractor_payload_from_purchaser(fields['purchaser_name'], fields['purchaser_address'],
+                                             fields['purchaser_zip'], fields['purchaser_city'], clean_nip)
+
+
+def batch_prefetch_contractors(items: list, concurrency: int) -> tuple[dict, dict]:
+    """
+    Rozwiąż wspólne dane paczki raz, zanim ruszą faktury: company_id i serie (rozgrzewa cache)
+    oraz kontrahentów - każdy NIP tylko raz: indeks -> contractors/find -> GUS (paczkami po 20)
+    albo dane purchaser pierwszej pozycji z tym NIP, która je ma -> contractors/add.
+    Zwraca ({firma: {NIP: {'contractor', 'created_by'}}}, statystyki); created_by to indeks pozycji,
+    dla której kontrahent został utworzony (None - istniał wcześniej). Pozycje z NIP-ami
+    nierozwiązanymi (błąd GUS/wFirma) wykonują się po kolei - patrz workflow_batch_create_invoices.
+    """
+    started = time.perf_counter()
+    stats = {'unique_nips': 0, 'from_index': 0, 'found': 0, 'created': 0, 'unresolved': 0}
+    by_company: dict[str, dict] = {}
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            continue
+        company = str(item.get('company') or DEFAULT_COMPANY).lower().strip()
+        if company not in SUPPORTED_COMPANIES:
+            continue
+        entry = by_company.setdefault(company, {'nips': {}, 'series': set()})
+        series_name = item.get('series_name') or 'Eventy'
+        if isinstance(series_name, str):
+            entry['series'].add(series_name.strip())
+        key = batch_item_nip(item)
+        if key is None:
+            continue
+        # NIP -> pierwsza pozycja (kontrahent z GUS) i pierwsza pozycja z danymi purchaser (fallback)
+        nip_entry = entry['nips'].setdefault(key[1], {'first': index, 'purchaser': None})
+        if nip_entry['purchaser'] is None:
+            payload = batch_purchaser_payload(item, key[1])
+            if payload is not None:
+                nip_entry['purchaser'] = (index, payload)
+
+    contractors_by_company: dict[str, dict] = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch-prefetch') as executor:
+        for company, entry in by_company.items():
+            nips = entry['nips']
+            stats['unique_nips'] += len(nips)
+            token = load_token(silent=True, company=company)
+            if not token:
+                stats['unresolved'] += len(nips)
+                continue  # pozycje zwrócą 401 z workflow
+            company_id = wfirma_get_company_id(token, company)
+            for series_name in entry['series']:
+                wfirma_find_series_by_name(token, series_name, company_id, company)
+
+            resolved: dict[str, dict] = {}
+            missing = []
+            for nip in nips:
+                contractor = contractor_index.get(company, nip) if contractor_index is not None else None
+                if contractor and contractor.get('id'):
+                    resolved[nip] = {'contractor': contractor, 'created_by': None}
+                    stats['from_index'] += 1
+                else:
+                    missing.append(nip)
+
+            find = bind_request_timings(lambda nip: wfirma_find_contractor_by_nip(token, nip, company_id, company)[0])
+            not_found = []
+            for nip, contractor in zip(missing, executor.map(find, missing)):
+                if contractor and contractor.get('id'):
+                    resolved[nip] = {'contractor': contractor, 'created_by': None}
+                    stats['found'] += 1
+                else:
+                    not_found.append(nip)
+
+            # Jak w workflow: dane GUS, a gdy GUS nie znalazł (lub zawiódł) - dane purchaser
+            gus_results = gus_lookup_nips(not_found) if not_found else {}
+            payloads = {}
+            for nip in not_found:
+                records = (gus_results.get(nip) or (None, None))[0]
+                if records:
+                    payloads[nip] = (nips[nip]['first'], contractor_payload_from_gus(records[0], nip))
+                elif nips[nip]['purchaser'] is not None:
+                    payloads[nip] = nips[nip]['purchaser']
+            add = bind_request_timings(lambda payload: wfirma_add_contractor(token, payload, company_id, company)[0])
+            created = executor.map(add, [payload for _index, payload in payloads.values()])
+            for (nip, (creator, _payload)), contractor in zip(payloads.items(), created):
+                if contractor and contractor.get('id'):
+                    resolved[nip] = {'contractor': contractor, 'created_by': creator}
+                    stats['created'] += 1
+            stats['unresolved'] += len(nips) - len(resolved)
+            contractors_by_company[company] = resolved
+
+    stats['duration_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return contractors_by_company, stats
+
+
+def run_batch_item(index: int, item, headers: dict, base_url: str, contractors_by_company: dict,
+                   nip_lock=None) -> dict:
+    """
+    Jedna pozycja paczki przez zwykły workflow (z kontrahentem rozwiązanym dla paczki).
+    nip_lock - wspólny dla pozycji z tym samym nierozwiązanym NIP: wykonują się po kolei,
+    więc kontrahenta tworzy tylko pierwsza z nich (kolejne znajdą go w wFirma / indeksie).
+    """
+    started = time.perf_counter()
+    try:
+        if not isinstance(item, dict):
+            http_status, result = 400, {'error': 'Pozycja paczki musi być obiektem JSON'}
+        elif isinstance(item.get('pdf'), str) and item['pdf'].lower().strip() == 'multipart':
+            http_status, result = 400, {'error': 'Tryb pdf=multipart nie jest dostępny w paczce (użyj inline, url lub none)'}
+        else:
+            item_headers = dict(headers)
+            if item.get('idempotency_key'):
+                item_headers['Idempotency-Key'] = str(item['idempotency_key'])
+            key = batch_item_nip(item)
+            prefetched = contractors_by_company.get(key[0], {}).get(key[1]) if key else None
+            with nip_lock or nullcontext():
+                with app.test_request_context('/api/workflow/create-invoice-from-nip', method='POST', json=item,
+                                              headers=item_headers, base_url=base_url):
+                    if prefetched is not None:
+                        g.workflow_contractors = {key[1]: {'contractor': prefetched['contractor'],
+                                                           'created': prefetched['created_by'] == index}}
+                    response = app.make_response(workflow_create_invoice())
+                    http_status, result = response.status_code, response.get_json(silent=True)
+    except Exception as e:
+        log_workflow.exception("Paczka: pozycja %s przerwana wyjątkiem", index)
+        http_status, result = 500, {'error': 'Błąd wewnętrzny workflow', 'details': f'{type(e).__name__}: {e}'}
+    ok = http_status < 400 and not (isinstance(result, dict) and result.get('error'))
+    return {
+        'type': 'item',
+        'index': index,
+        'ok': ok,
+        'http_status': http_status,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        'result': result,
+    }
+
+
+@app.route('/api/workflow/batch-create-invoices', methods=['POST'])
+@require_api_key
+def workflow_batch_create_invoices():
+    """
+    Paczka faktur: body {"items": [<body workflow>, ...], "defaults": {...}, "concurrency": 4} (albo sama lista).
+    Odpowiedź NDJSON strumieniowana w trakcie: start, prefetch (wspólne dane i kontrahenci),
+    po jednej linii na pozycję w kolejności zakończenia (pole index), na końcu summary.
+    """
+    body = request.get_json(silent=True)
+    options = body if isinstance(body, dict) else {}
+    items = body if isinstance(body, list) else options.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'Wymagana niepusta lista items'}), 400
+    if len(items) > WORKFLOW_BATCH_MAX_ITEMS:
+        return jsonify({
+            'error': f'Za dużo pozycji w paczce (max {WORKFLOW_BATCH_MAX_ITEMS})',
+            'items': len(items)
+        }), 400
+    defaults = options.get('defaults') or {}
+    if not isinstance(defaults, dict):
+        return jsonify({'error': 'Pole defaults musi być obiektem'}), 400
+    try:
+        concurrency = int(options.get('concurrency') or WORKFLOW_BATCH_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Pole concurrency musi być liczbą'}), 400
+    concurrency = max(1, min(concurrency, WORKFLOW_BATCH_MAX_CONCURRENCY))
+
+    # PDF domyślnie pomijany (pdf=none): setki pobrań invoices/download to połowa wywołań paczki,
+    # a base64 w NDJSON nie ma sensu - "pdf": "url" w defaults/pozycji daje link i PDF w cache
+    items = [{'pdf': 'none', **defaults, **item} if isinstance(item, dict) else item for item in items]
+    headers = {name: request.headers[name] for name in WORKFLOW_FORWARDED_HEADERS if name in request.headers}
+    base_url = request.host_url
+    log_workflow.info("Paczka faktur: %s pozycji, współbieżność %s", len(items), concurrency)
+
+    def line(obj) -> bytes:
+        return (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+
+    def generate():
+        started = time.perf_counter()
+        yield line({'type': 'start', 'items': len(items), 'concurrency': concurrency})
+        try:
+            contractors_by_company, prefetch = batch_prefetch_contractors(items, concurrency)
+        except Exception as e:
+            log_workflow.exception("Paczka: rozwiązywanie kontrahentów przerwane wyjątkiem")
+            contractors_by_company, prefetch = {}, {'error': f'{type(e).__name__}: {e}'}
+        yield line({'type': 'prefetch', **prefetch})
+
+        # Pozycje z NIP-em nierozwiązanym w prefetch nie mogą ścigać się o utworzenie
+        # tego samego kontrahenta - jeden lock na (firma, NIP), wykonują się po kolei
+        nip_locks = {}
+        for item in items:
+            key = batch_item_nip(item)
+            if key and key[1] not in contractors_by_company.get(key[0], {}):
+                nip_locks.setdefault(key, threading.Lock())
+
+        succeeded = failed = 0
+        pending = {}
+        queue = iter(enumerate(items))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+            try:
+                while True:
+                    # Najwyżej `concurrency` pozycji w locie - rozłączony klient nie uruchamia kolejnych
+                    for index, item in queue:
+                        pending[executor.submit(run_batch_item, index, item, headers, base_url,
+                                                contractors_by_company,
+                                                nip_locks.get(batch_item_nip(item)))] = index
+                        if len(pending) >= concurrency:
+                            break
+                    if not pending:
+                        break
+                    done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        index = pending.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            # Błąd poza workflow pozycji nie może przerwać strumienia pozostałych
+                            log_workflow.exception("Paczka: pozycja %s zakończona wyjątkiem", index)
+                            result = {'type': 'item', 'index': index, 'ok': False, 'http_status': 500,
+                                      'duration_ms': None,
+                                      'result': {'error': 'Błąd wewnętrzny workflow',
+                                                 'details': f'{type(e).__name__}: {e}'}}
+                        if result['ok']:
+                            succeeded += 1
+                        else:
+                            failed += 1
+                        yield line(result)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+        summary = {
+            'type': 'summary',
+            'items': len(items),
+            'succeeded': succeeded,
+            'failed': failed,
+            'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+        }
+        log_workflow.info("Paczka faktur zakończona: %s", lazy_json(summary))
+        yield line(summary)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
 # ==================== ENDPOINTY GUS / REGON ====================
 
 # ==================== ENDPOINTY GUS / REGON ====================
@@ -2540,7 +3433,7 @@ def workflow_create_invoice():
 def gus_name_by_nip():
     """
     Prosty port endpointu /api/gus/name-by-nip z backendu Googie_GUS.
-    Headers: X-API-Key: <REGON_API_KEY_TOKEN>
+    Headers: X-API-Key: <REGON_API_KEY_TOKEN>, opcjonalnie Cache-Control: no-cache (pomiń cache GUS)
     Wejście: JSON { "nip": "1234567890" }
     Wyjście: { "data": [ { regon, nip, nazwa, ... } ] } albo komunikat błędu.
     """
@@ -2573,176 +3466,61 @@ def gus_name_by_nip():
         }), 400
 
     # Przełącznik środowiska test/produkcyjne – zgodnie z Googie_GUS
-    use_test_env = api_key == 'abcde12345abcde12345' or GUS_USE_TEST
-    bir_host = 'wyszukiwarkaregontest.stat.gov.pl' if use_test_env else 'wyszukiwarkaregon.stat.gov.pl'
-    bir_url = f'https://{bir_host}/wsBIR/UslugaBIRzewnPubl.svc'
+    bir_host = gus_bir_host(api_key)
 
     # Log tylko diagnostyczny (bez pełnego klucza)
-    print(f"[GUS] name-by-nip nip={clean_nip} env={'TEST' if use_test_env else 'PROD'} host={bir_host}")
-
-    safe_api_key = escape_xml(api_key)
-    login_envelope = (
-        '<?xml version="1.0" encoding="utf-8"?>'
-        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" xmlns:ns="http://CIS/BIR/PUBL/2014/07">'
-        '<soap:Header xmlns:wsa="http://www.w3.org/2005/08/addressing">'
-        f'<wsa:To>{bir_url}</wsa:To>'
-        '<wsa:Action>http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/Zaloguj</wsa:Action>'
-        '</soap:Header>'
-        '<soap:Body>'
-        '<ns:Zaloguj>'
-        f'<ns:pKluczUzytkownika>{safe_api_key}</ns:pKluczUzytkownika>'
-        '</ns:Zaloguj>'
-        '</soap:Body>'
-        '</soap:Envelope>'
-    )
-
-    try:
-        login_resp = post_soap_gus(bir_host, login_envelope, sid=None, timeout=10)
-        # Szczegółowe logi z logowania do GUS
-        print(f"[GUS] LOGIN status={login_resp.status_code}")
-        login_snippet = (login_resp.text or '')[:500]
-        print(f"[GUS] LOGIN body snippet={repr(login_snippet)}")
-    except Exception as e:
-        return jsonify({
-            'error': 'Błąd komunikacji z GUS podczas logowania',
-            'message': str(e)
-        }), 502
+    log_gus.info("name-by-nip nip=%s env=%s host=%s", clean_nip, 'TEST' if bir_host == BIR_HOST_TEST else 'PROD', bir_host, extra=SAMPLED)
 
-    sid_match = re.search(r'<ZalogujResult>([^<]*)</ZalogujResult>', login_resp.text or '')
-    sid = sid_match.group(1).strip() if sid_match else ''
-
-    if not sid:
-        snippet = (login_resp.text or '')[:300]
+    data_list, gus_err = gus_lookup_nip(clean_nip, api_key=api_key, use_cache=not gus_cache_bypass_requested())
+    if gus_err:
         return jsonify({
-            'error': 'Logowanie do GUS nie powiodło się (brak SID)',
-            'debug': snippet
+            'error': 'Błąd komunikacji z GUS',
+            'message': gus_err
         }), 502
 
-    safe_nip = escape_xml(clean_nip)
-    search_envelope = (
-        '<?xml version="1.0" encoding="utf-8"?>'
-        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
-        'xmlns:ns="http://CIS/BIR/PUBL/2014/07" '
-        'xmlns:q1="http://CIS/BIR/PUBL/2014/07/DataContract" '
-        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">'
-        '<soap:Header xmlns:wsa="http://www.w3.org/2005/08/addressing">'
-        f'<wsa:To>{bir_url}</wsa:To>'
-        '<wsa:Action>http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/DaneSzukajPodmioty</wsa:Action>'
-        '</soap:Header>'
-        '<soap:Body>'
-        '<ns:DaneSzukajPodmioty>'
-        '<ns:pParametryWyszukiwania>'
-        '<q1:Krs xsi:nil="true"/>'
-        '<q1:Krsy xsi:nil="true"/>'
-        f'<q1:Nip>{safe_nip}</q1:Nip>'
-        '<q1:Nipy xsi:nil="true"/>'
-        '<q1:Regon xsi:nil="true"/>'
-        '<q1:Regony14zn xsi:nil="true"/>'
-        '<q1:Regony9zn xsi:nil="true"/>'
-        '</ns:pParametryWyszukiwania>'
-        '</ns:DaneSzukajPodmioty>'
-        '</soap:Body>'
-        '</soap:Envelope>'
-    )
-
-    try:
-        search_resp = post_soap_gus(bir_host, search_envelope, sid=sid, timeout=10)
-        # Szczegółowe logi z wyszukiwania w GUS
-        print(f"[GUS] SEARCH status={search_resp.status_code}")
-        search_snippet = (search_resp.text or '')[:800]
-        print(f"[GUS] SEARCH body snippet={repr(search_snippet)}")
-    except Exception as e:
-        return jsonify({
-            'error': 'Błąd komunikacji z GUS podczas wyszukiwania',
-            'message': str(e)
-        }), 502
-
-    soap_part = search_resp.text or ''
-
-    # Obsługa odpowiedzi multipart/MTOM – wyciągamy część SOAP, jeśli trzeba
-    if 'Content-Type: application/xop+xml' in soap_part:
-        match = re.search(
-            r'Content-Type: application/xop\+xml[^\r\n]*\r?\n\r?\n([\s\S]*?)\r?\n--uuid:',
-            soap_part,
-            re.MULTILINE | re.DOTALL,
-        )
-        if match:
-            soap_part = match.group(1)
-
     # Brak wyniku
-    if re.search(r'<DaneSzukajResult\s*/>', soap_part):
+    if not data_list:
         return jsonify({
             'error': 'GUS nie znalazł podmiotu dla podanego NIP'
         }), 404
 
-    result_match = re.search(
-        r'<DaneSzukajPodmiotyResult>([\s\S]*?)</DaneSzukajPodmiotyResult>',
-        soap_part,
-        re.MULTILINE | re.DOTALL,
-    )
-    inner_xml = result_match.group(1) if result_match else ''
-
-    if not inner_xml:
-        print("[GUS] Brak sekcji <DaneSzukajPodmiotyResult> w odpowiedzi GUS")
-        return jsonify({
-            'error': 'Brak danych w odpowiedzi GUS (DaneSzukajPodmiotyResult pusty)'
-        }), 404
-
-    decoded_xml = decode_bir_inner_xml(inner_xml)
-    decoded_snippet = decoded_xml[:800]
-    print(f"[GUS] DECODED inner XML snippet={repr(decoded_snippet)}")
-    if not decoded_xml:
-        return jsonify({
-            'error': 'Brak danych po dekodowaniu odpowiedzi GUS'
-        }), 502
+    log_gus.debug("PARSED records=%s", len(data_list))
+    # Dla podglądu logujemy tylko pierwszy rekord
+    log_gus.debug("FIRST record=%r", data_list[0])
 
-    try:
-        root = ET.fromstring(decoded_xml)
-    except ET.ParseError as e:
-        return jsonify({
-            'error': 'Nie udało się sparsować danych GUS',
-            'message': str(e)
-        }), 502
+    return jsonify({'data': data_list}), 200
 
-    data_list: list[dict] = []
 
-    for dane in root.findall('.//dane'):
-        def get_text(tag: str) -> str | None:
-            el = dane.find(tag)
-            return el.text if el is not None else None
-
-        mapped = {
-            'regon': get_text('Regon'),
-            'nip': get_text('Nip'),
-            'nazwa': get_text('Nazwa'),
-            'wojewodztwo': get_text('Wojewodztwo'),
-            'powiat': get_text('Powiat'),
-            'gmina': get_text('Gmina'),
-            'miejscowosc': get_text('Miejscowosc'),
-            'kodPocztowy': get_text('KodPocztowy'),
-            'ulica': get_text('Ulica'),
-            'nrNieruchomosci': get_text('NrNieruchomosci'),
-            'nrLokalu': get_text('NrLokalu'),
-            'typ': get_text('Typ'),
-            'silosId': get_text('SilosID'),
-            'miejscowoscPoczty': get_text('MiejscowoscPoczty'),
-            'krs': get_text('Krs'),
-        }
-        data_list.append(mapped)
+def gus_validation_data(gus_first: dict) -> dict:
+    """Dane podmiotu z GUS w formacie odpowiedzi validate-nip (pełny adres, województwo małymi literami)."""
+    # Składamy pełny adres
+    street_parts = [gus_first.get('ulica') or '']
+    if gus_first.get('nrNieruchomosci'):
+        street_parts.append(gus_first.get('nrNieruchomosci'))
+    if gus_first.get('nrLokalu'):
+        street_parts[1] = f"{street_parts[1]}/{gus_first.get('nrLokalu')}" if len(street_parts) > 1 else gus_first.get('nrLokalu')
+    full_street = ' '.join(filter(None, street_parts))
 
-    print(f"[GUS] PARSED records={len(data_list)}")
-    if data_list:
-        # Dla podglądu logujemy tylko pierwszy rekord
-        print(f"[GUS] FIRST record={repr(data_list[0])}")
+    # Województwo na małe litery
+    voivodeship = gus_first.get('wojewodztwo') or ''
+    voivodeship_lower = voivodeship.lower() if voivodeship else None
 
-    return jsonify({'data': data_list}), 200
+    return {
+        'name': gus_first.get('nazwa'),
+        'regon': gus_first.get('regon'),
+        'street': full_street,
+        'zip': gus_first.get('kodPocztowy'),
+        'city': gus_first.get('miejscowosc'),
+        'voivodeship': voivodeship_lower,
+        'krs': gus_first.get('krs')
+    }
 
 
 @app.route('/api/gus/validate-nip', methods=['POST'])
 def gus_validate_nip():
     """
     Sprawdź czy NIP jest poprawny i czy istnieje w bazie GUS/REGON.
-    Headers: X-API-Key: <REGON_API_KEY_TOKEN>
+    Headers: X-API-Key: <REGON_API_KEY_TOKEN>, opcjonalnie Cache-Control: no-cache (pomiń cache GUS)
     Wejście: JSON { "nip": "1234567890" }
     Wyjście: { "nip_status": "brak/niepoprawny/poprawny", "gus_data": {...} lub null }
     """
@@ -2760,7 +3538,7 @@ def gus_validate_nip():
 
     # Brak NIP
     if not clean_nip:
-        print(f"[GUS] validate-nip BRAK nip_raw='{nip_raw}'")
+        log_gus.info("validate-nip BRAK nip_raw='%s'", nip_raw)
         return jsonify({
             'nip_status': 'brak',
             'nip_provided': nip_raw,
@@ -2768,13 +3546,13 @@ def gus_validate_nip():
         }), 200
 
     # Sprawdź w GUS/REGON
-    print(f"[GUS] validate-nip START nip={clean_nip}")
-    gus_records, gus_err = gus_lookup_nip(clean_nip)
-    print(f"[GUS] validate-nip RESULT nip={clean_nip} err={gus_err} records_count={len(gus_records) if gus_records else 0}")
+    log_gus.debug("validate-nip START nip=%s", clean_nip)
+    gus_records, gus_err = gus_lookup_nip(clean_nip, use_cache=not gus_cache_bypass_requested())
+    log_gus.debug("validate-nip RESULT nip=%s err=%s records_count=%s", clean_nip, gus_err, len(gus_records) if gus_records else 0)
 
     # Nie znaleziono w GUS lub błąd
     if gus_err or not gus_records or len(gus_records) == 0:
-        print(f"[GUS] validate-nip NIEPOPRAWNY nip={clean_nip} (err={gus_err}, records={gus_records})")
+        log_gus.info("validate-nip NIEPOPRAWNY nip=%s (err=%s, records=%s)", clean_nip, gus_err, gus_records)
         return jsonify({
             'nip_status': 'niepoprawny',
             'nip': clean_nip,
@@ -2782,36 +3560,66 @@ def gus_validate_nip():
         }), 200
 
     # NIP znaleziony w GUS
-    print(f"[GUS] validate-nip POPRAWNY nip={clean_nip}")
-    gus_first = gus_records[0]
-    
-    # Składamy pełny adres
-    street_parts = [gus_first.get('ulica') or '']
-    if gus_first.get('nrNieruchomosci'):
-        street_parts.append(gus_first.get('nrNieruchomosci'))
-    if gus_first.get('nrLokalu'):
-        street_parts[1] = f"{street_parts[1]}/{gus_first.get('nrLokalu')}" if len(street_parts) > 1 else gus_first.get('nrLokalu')
-    full_street = ' '.join(filter(None, street_parts))
-    
-    # Województwo na małe litery
-    voivodeship = gus_first.get('wojewodztwo') or ''
-    voivodeship_lower = voivodeship.lower() if voivodeship else None
-    
+    log_gus.info("validate-nip POPRAWNY nip=%s", clean_nip, extra=SAMPLED)
     return jsonify({
         'nip_status': 'poprawny',
         'nip': clean_nip,
-        'gus_data': {
-            'name': gus_first.get('nazwa'),
-            'regon': gus_first.get('regon'),
-            'street': full_street,
-            'zip': gus_first.get('kodPocztowy'),
-            'city': gus_first.get('miejscowosc'),
-            'voivodeship': voivodeship_lower,
-            'krs': gus_first.get('krs')
-        }
+        'gus_data': gus_validation_data(gus_records[0])
     }), 200
 
 
+@app.route('/api/gus/batch-validate', methods=['POST'])
+def gus_batch_validate():
+    """
+    Hurtowa walidacja NIP (np. nocne sprawdzanie jakości danych w CRM).
+    Headers: X-API-Key: <REGON_API_KEY_TOKEN>, opcjonalnie Cache-Control: no-cache (pomiń cache GUS)
+    Wejście: JSON { "nips": ["1234567890", ...] }
+    Wyjście: { "results": { "<nip>": { nip_status, nip, gus_data[, error] } }, "summary": {...} }
+    NIP z błędną sumą kontrolną nie jest wysyłany do GUS; nip_status "blad" = GUS nie odpowiedział.
+    """
+    # Sprawdź osobny token dla endpointów GUS/REGON
+    api_key_header = request.headers.get('X-API-Key', '')
+    if not REGON_API_KEY_TOKEN:
+        return jsonify({'error': 'Brak REGON_API_KEY_TOKEN w konfiguracji serwera'}), 500
+    if api_key_header != REGON_API_KEY_TOKEN:
+        return jsonify({'error': 'Unauthorized - nieprawidłowy token'}), 401
+
+    body = request.get_json(silent=True) or {}
+    nips_raw = body.get('nips')
+    if not isinstance(nips_raw, list) or not nips_raw:
+        return jsonify({'error': 'Brak listy NIP (pole "nips")'}), 400
+    if len(nips_raw) > GUS_BATCH_MAX_NIPS:
+        return jsonify({'error': f'Za dużo NIP w jednym żądaniu (maks. {GUS_BATCH_MAX_NIPS})'}), 400
+
+    results: dict[str, dict] = {}
+    to_lookup = []
+    for nip_raw in nips_raw:
+        nip_raw = str(nip_raw or '').strip()
+        clean_nip = re.sub(r'[^0-9]', '', nip_raw)
+        if not clean_nip:
+            results[nip_raw] = {'nip_status': 'brak', 'nip_provided': nip_raw, 'gus_data': None}
+        elif not validate_nip_checksum(clean_nip):
+            # Suma kontrolna najpierw - błędny NIP nie zużywa limitu zapytań BIR
+            results[clean_nip] = {'nip_status': 'niepoprawny', 'nip': clean_nip, 'gus_data': None}
+        else:
+            to_lookup.append(clean_nip)
+
+    log_gus.info("batch-validate START nips=%s do GUS=%s", len(nips_raw), len(set(to_lookup)))
+    for clean_nip, (gus_records, gus_err) in gus_lookup_nips(to_lookup, use_cache=not gus_cache_bypass_requested()).items():
+        if gus_err:
+            results[clean_nip] = {'nip_status': 'blad', 'nip': clean_nip, 'gus_data': None, 'error': gus_err}
+        elif not gus_records:
+            results[clean_nip] = {'nip_status': 'niepoprawny', 'nip': clean_nip, 'gus_data': None}
+        else:
+            results[clean_nip] = {'nip_status': 'poprawny', 'nip': clean_nip, 'gus_data': gus_validation_data(gus_records[0])}
+
+    summary: dict[str, int] = {}
+    for result in results.values():
+        summary[result['nip_status']] = summary.get(result['nip_status'], 0) + 1
+    log_gus.info("batch-validate KONIEC %s", summary)
+    return jsonify({'results': results, 'summary': summary}), 200
+
+
 @app.route('/api/invoice/<invoice_id>/send-email', methods=['POST'])
 @require_api_key
 @require_token
@@ -2840,19 +3648,19 @@ def invoice_send_email(token, invoice_id):
 # ==================== FAKTURA KORYGUJĄCA ====================
 
 
-def wfirma_get_invoice(token: str, invoice_id: str, company_id: str = None) -> tuple[dict | None, str | None]:
+def wfirma_get_invoice(token: str, invoice_id: str, company_id: str = None, company: str = None) -> tuple[dict | None, str | None]:
     """
     Pobierz szczegóły faktury z wFirma (invoices/get).
     Zwraca (invoice_dict, error_message).
     """
-    api_url = f"https://api2.wfirma.pl/invoices/get/{invoice_id}?inputFormat=json&outputFormat=json&oauth_version=2"
+    api_url = f"{WFIRMA_API_URL}/invoices/get/{invoice_id}?inputFormat=json&outputFormat=json&oauth_version=2"
     if company_id:
         api_url += f"&company_id={company_id}"
     
     headers = get_wfirma_headers(token)
     try:
-        resp = requests.get(api_url, headers=headers)
-        print(f"[WFIRMA] invoices/get/{invoice_id} status={resp.status_code}")
+        resp = wfirma_http('GET', api_url, company, headers=headers)
+        log_wfirma.debug("invoices/get/%s status=%s", invoice_id, resp.status_code)
         
         if resp.status_code == 200:
             result = resp.json()
@@ -2871,6 +3679,7 @@ def wfirma_get_invoice(token: str, invoice_id: str, company_id: str = None) -> t
 @app.route('/api/workflow/correction', methods=['POST'])
 @require_api_key
 @require_token
+@idempotent
 def workflow_create_correction(token):
     """
     Utwórz fakturę korygującą do istniejącej faktury.
@@ -2915,7 +3724,7 @@ def workflow_create_correction(token):
         if not pos.get('parent_position_id'):
             return jsonify({'error': f'Pozycja {idx+1} nie ma parent_position_id'}), 400
     
-    print(f"[CORRECTION] Tworzę korektę dla faktury ID={parent_invoice_id}, company={company}")
+    log_workflow.info("Tworzę korektę dla faktury ID=%s, company=%s", parent_invoice_id, company)
     
     # 1) Pobierz oryginalną fakturę żeby uzyskać dane kontrahenta i pozycji
     original_invoice, err = wfirma_get_invoice(token, str(parent_invoice_id))
@@ -2926,7 +3735,7 @@ def workflow_create_correction(token):
             'parent_invoice_id': parent_invoice_id
         }), 404
     
-    print(f"[CORRECTION] Pobrano fakturę oryginalną: {original_invoice.get('fullnumber')}")
+    log_workflow.info("Pobrano fakturę oryginalną: %s", original_invoice.get('fullnumber'))
     
     # Pobierz contractor_id z oryginalnej faktury
     contractor_data = original_invoice.get('contractor', {})
@@ -2947,10 +3756,10 @@ def workflow_create_correction(token):
                             s = val['serie']
                             if s.get('name', '').lower() == series_name.lower():
                                 series_id = int(s.get('id'))
-                                print(f"[CORRECTION] Znaleziono serię: {series_name} -> ID {series_id}")
+                                log_workflow.info("Znaleziono serię: %s -> ID %s", series_name, series_id)
                                 break
             except Exception as e:
-                print(f"[CORRECTION] Błąd parsowania serii: {e}")
+                log_workflow.warning("Błąd parsowania serii: %s", e)
     
     # 3) Buduj payload faktury korygującej
     # Mapowanie stawek VAT
@@ -3009,7 +3818,7 @@ def workflow_create_correction(token):
     if series_id:
         correction_payload["series"] = {"id": series_id}
     
-    print(f"[CORRECTION] Payload: contractor_id={contractor_id}, parent_id={parent_invoice_id}, positions={len(positions)}")
+    log_workflow.debug("Payload: contractor_id=%s, parent_id=%s, positions=%s", contractor_id, parent_invoice_id, len(positions))
     
     # 4) Utwórz fakturę korygującą
     invoice_result, resp = wfirma_create_invoice(token, correction_payload)
@@ -3080,42 +3889,42 @@ def upload_stopka_photo():
     if api_key != HTML_GENERATOR_API_KEY_TOKEN:
         return cors_response({'success': False, 'error': 'Unauthorized - nieprawidłowy token'}, 401)
     
-    print(f"[STOPKA] === START upload-photo ===")
+    log_stopka.info("=== START upload-photo ===")
     data = request.get_json(silent=True) or {}
     
     if 'image_base64' not in data:
-        print(f"[STOPKA] BŁĄD: Brak image_base64 w request body")
+        log_stopka.warning("BŁĄD: Brak image_base64 w request body")
         return cors_response({'success': False, 'error': 'Brak image_base64'}, 400)
     
     if not GITHUB_STOPKA_TOKEN:
-        print(f"[STOPKA] BŁĄD: Brak ADMINZOHO_GITHUB_STOPKA_TOKEN w ENV")
+        log_stopka.warning("BŁĄD: Brak ADMINZOHO_GITHUB_STOPKA_TOKEN w ENV")
         return cors_response({'success': False, 'error': 'Brak ADMINZOHO_GITHUB_STOPKA_TOKEN w konfiguracji'}, 500)
     
     try:
         # Dekoduj base64
         image_data = data['image_base64']
         original_length = len(image_data)
-        print(f"[STOPKA] Otrzymano image_base64, długość={original_length}")
+        log_stopka.debug("Otrzymano image_base64, długość=%s", original_length)
         
         if ',' in image_data:
             image_data = image_data.split(',')[1]  # usuń prefix "data:image/png;base64,"
-            print(f"[STOPKA] Usunięto prefix data:..., nowa długość={len(image_data)}")
+            log_stopka.debug("Usunięto prefix data:..., nowa długość=%s", len(image_data))
         
         image_bytes = base64.b64decode(image_data)
-        print(f"[STOPKA] Zdekodowano base64, rozmiar obrazu={len(image_bytes)} bajtów ({len(image_bytes)/1024:.1f} KB)")
+        log_stopka.debug("Zdekodowano base64, rozmiar obrazu=%s bajtów (%.1f KB)", len(image_bytes), len(image_bytes)/1024)
         
         # Generuj losową nazwę (40 znaków)
         random_name = uuid.uuid4().hex + uuid.uuid4().hex[:8]  # 32 + 8 = 40 znaków
         filename = f"{random_name}.png"
         filepath = f"photos/{filename}"
-        print(f"[STOPKA] Wygenerowano nazwę pliku: {filename}")
+        log_stopka.debug("Wygenerowano nazwę pliku: %s", filename)
         
         # Push na GitHub via API
         repo = "adminzohomedidesk/Stopka_email"
         branch = "main"
         
         url = f"https://api.github.com/repos/{repo}/contents/{filepath}"
-        print(f"[STOPKA] GitHub API URL: {url}")
+        log_stopka.debug("GitHub API URL: %s", url)
         
         headers = {
             "Authorization": f"token {GITHUB_STOPKA_TOKEN[:4]}...{GITHUB_STOPKA_TOKEN[-4:]}",  # log tylko fragment tokena
@@ -3134,27 +3943,27 @@ def upload_stopka_photo():
             "branch": branch
         }
         
-        print(f"[STOPKA] Wysyłam PUT do GitHub API (token: {GITHUB_STOPKA_TOKEN[:4]}...)")
+        log_stopka.debug("Wysyłam PUT do GitHub API")
         response = requests.put(url, json=payload, headers=real_headers, timeout=30)
-        print(f"[STOPKA] GitHub response status={response.status_code}")
+        log_stopka.debug("GitHub response status=%s", response.status_code)
         
         if response.status_code in [200, 201]:
             public_url = f"https://raw.githubusercontent.com/{repo}/{branch}/{filepath}"
-            print(f"[STOPKA] Upload OK: {public_url}")
+            log_stopka.info("Upload OK: %s", public_url, extra=SAMPLED)
             return cors_response({
                 'success': True,
                 'url': public_url,
                 'filename': filename
             })
         else:
-            print(f"[STOPKA] GitHub API error: {response.status_code} - {response.text[:500]}")
+            log_stopka.warning("GitHub API error: %s - %s", response.status_code, response.text[:500])
             return cors_response({
                 'success': False,
                 'error': f"GitHub API error: {response.status_code} - {response.text}"
             }, 500)
     
     except Exception as e:
-        print(f"[STOPKA] Exception: {e}")
+        log_stopka.warning("Exception: %s", e)
         return cors_response({'success': False, 'error': str(e)}, 500)
 
 
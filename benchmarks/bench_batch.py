@@ -0,0 +1,178 @@
+"""
+Benchmark paczki faktur: N osobnych wywołań /api/workflow/create-invoice-from-nip
+kontra jedno /api/workflow/batch-create-invoices z tymi samymi pozycjami.
+
+Aplikacja działa pod gunicornem (jak w bench_e2e.py) na lokalnych fake wFirma i fake GUS
+(cache GUS wyłączony). Obie strony dostają świeży zestaw NIP-ów nowych klientów
+(każdy NIP w kilku fakturach, jak rozliczenie wydarzeń na koniec miesiąca), więc
+porównanie obejmuje też rozwiązywanie kontrahentów. Raportuje czas całości,
+wywołania wFirma/GUS per krok i liczbę utworzonych kontrahentów (duplikaty przy
+równoległych wywołaniach dla tego samego nowego NIP). Kod wyjścia 1, gdy któraś faktura
+się nie udała albo paczka utworzyła inną liczbę kontrahentów niż różnych NIP-ów.
+
+Użycie:
+    python benchmarks/bench_batch.py --items 300 --nips 100 --concurrency 8
+    python benchmarks/bench_batch.py --single-concurrency 8   # pojedyncze wywołania też równolegle
+    python benchmarks/bench_batch.py --items 300 --latency 0.1 --gus-latency 0.2 --pdf-mode none
+"""
+
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_e2e import API_KEY, free_port, random_nip, run_load, start_app  # noqa: E402
+from fake_gus import start_fake_gus  # noqa: E402
+from fake_wfirma import start_fake_wfirma  # noqa: E402
+
+POSITIONS = [{'name': 'Udział w wydarzeniu', 'quantity': 1, 'unit_price_net': 100, 'vat_rate': '23'}]
+
+
+def make_items(rng: random.Random, items: int, nips: int, pdf_mode: str) -> list:
+    pool = [random_nip(rng) for _ in range(nips)]
+    return [{'company': 'md', 'nip': pool[i % len(pool)], 'payment_status': 'paid', 'pdf': pdf_mode,
+             'invoice': {'positions': POSITIONS}} for i in range(items)]
+
+
+def upstream_stats(state, gus_state) -> dict:
+    stats, gus_stats = state.stats(), gus_state.stats()
+    return {
+        'wfirma_calls': stats['requests'],
+        'wfirma_calls_by_step': stats['calls'],
+        'gus_calls': gus_stats['requests'],
+        'gus_calls_by_method': gus_stats['calls'],
+    }
+
+
+def run_singles(base_url: str, items: list, concurrency: int) -> dict:
+    def make(i):
+        return 'POST', '/api/workflow/create-invoice-from-nip', {'headers': {'X-API-Key': API_KEY}, 'json': items[i]}
+    result = run_load(base_url, make, len(items), concurrency)
+    return {'wall_s': result['wall_s'], 'ok': result['ok'], 'errors': result['errors'],
+            'latency_ms': result['latency_ms']}
+
+
+def run_batch(base_url: str, items: list, concurrency: int) -> dict:
+    started = time.perf_counter()
+    first_line = None
+    lines = []
+    with requests.post(f'{base_url}/api/workflow/batch-create-invoices', stream=True, timeout=3600,
+                       headers={'X-API-Key': API_KEY}, json={'items': items, 'concurrency': concurrency}) as resp:
+        resp.raise_for_status()
+        for raw in resp.iter_lines():
+            if raw:
+                if first_line is None:
+                    first_line = time.perf_counter() - started
+                lines.append(json.loads(raw))
+    wall = time.perf_counter() - started
+    item_lines = [line for line in lines if line['type'] == 'item']
+    prefetch = next((line for line in lines if line['type'] == 'prefetch'), {})
+    return {
+        'wall_s': round(wall, 3),
+        'first_line_ms': round((first_line or 0) * 1000, 1),
+        'ok': sum(1 for line in item_lines if line['ok']),
+        'errors': sum(1 for line in item_lines if not line['ok']),
+        'prefetch': prefetch,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark paczki faktur (batch) vs pojedyncze wywołania workflow')
+    parser.add_argument('--items', type=int, default=300, help='liczba faktur')
+    parser.add_argument('--nips', type=int, default=100, help='liczba różnych (nowych) kontrahentów')
+    parser.add_argument('--concurrency', type=int, default=8, help='pole concurrency paczki')
+    parser.add_argument('--single-concurrency', type=int, default=1,
+                        help='współbieżność pojedynczych wywołań (scenariusz Make.com wysyła je po kolei)')
+    parser.add_argument('--latency', type=float, default=0.05, help='opóźnienie odpowiedzi fake wFirma (s)')
+    parser.add_argument('--gus-latency', type=float, default=0.1, help='opóźnienie odpowiedzi fake GUS (s)')
+    parser.add_argument('--pdf-mode', default='url', help='tryb pdf pozycji w obu wariantach (url, none, inline)')
+    parser.add_argument('--gunicorn-args', default='-k gthread --threads 16',
+                        help='argumenty gunicorna (wątki dla równoległych pojedynczych wywołań)')
+    parser.add_argument('--output', help='plik JSON z wynikami (domyślnie bench_batch_<czas>.json)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    server, state = start_fake_wfirma(latency=args.latency)
+    gus_server, gus_state = start_fake_gus(latency=args.gus_latency)
+    workdir = tempfile.mkdtemp(prefix='bench_batch_')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir)
+
+    env = dict(os.environ)
+    for name in ('RENDER_API_KEY', 'RENDER_SERVICE_ID', 'WEBHOOK_TOKEN_EXPIRE_NOTIFY'):
+        env.pop(name, None)
+    env.update({
+        'WFIRMA_API_URL': server.base_url,
+        'WFIRMA_MD_ACCESS_TOKEN': 'bench-token',
+        'WFIRMA_MD_TOKEN_EXPIRES': str(int(time.time()) + 24 * 3600),
+        'MAKE_RENDER_API_KEY': API_KEY,
+        'GUS_API_KEY': 'bench-gus-key',
+        'GUS_BIR_URL': gus_server.service_url,
+        'GUS_CACHE': 'false',
+        'WFIRMA_DATA_DIR': data_dir,
+        'PDF_CACHE_DIR': os.path.join(workdir, 'invoices'),
+    })
+    port = free_port()
+    app_proc = start_app(workdir, port, env, args.gunicorn_args)
+    base_url = f'http://127.0.0.1:{port}'
+
+    runs = {}
+    try:
+        for mode, runner, concurrency in (('single', run_singles, args.single_concurrency),
+                                          ('batch', run_batch, args.concurrency)):
+            # Świeże NIP-y dla każdej strony - obie zaczynają od nowych kontrahentów
+            items = make_items(rng, args.items, args.nips, args.pdf_mode)
+            contractors_before = len(state.contractors)
+            state.reset_counters()
+            gus_state.reset_counters()
+            result = runner(base_url, items, concurrency)
+            result.update(upstream_stats(state, gus_state))
+            result['contractors_created'] = len(state.contractors) - contractors_before
+            runs[mode] = result
+            print(f"{mode:<7} wall={result['wall_s']}s ok={result['ok']} errors={result['errors']} "
+                  f"wfirma={result['wfirma_calls']} gus={result['gus_calls']} "
+                  f"kontrahenci={result['contractors_created']} {json.dumps(result['wfirma_calls_by_step'])}", flush=True)
+    finally:
+        app_proc.send_signal(signal.SIGTERM)
+        try:
+            app_proc.wait(10)
+        except subprocess.TimeoutExpired:
+            app_proc.kill()
+        server.shutdown()
+        gus_server.shutdown()
+
+    single, batch = runs['single'], runs['batch']
+    print(f"batch/single: czas {batch['wall_s'] / single['wall_s']:.2f}x, "
+          f"wywołania wFirma {batch['wfirma_calls'] / max(1, single['wfirma_calls']):.2f}x, "
+          f"GUS {batch['gus_calls'] / max(1, single['gus_calls']):.2f}x")
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': vars(args),
+        'runs': runs,
+    }
+    output = args.output or f"bench_batch_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f'Wyniki: {output}')
+
+    failures = [f"{mode}: {run['errors']} faktur z błędem" for mode, run in runs.items() if run['errors']]
+    if batch['contractors_created'] != args.nips:
+        failures.append(f"paczka utworzyła {batch['contractors_created']} kontrahentów dla {args.nips} NIP-ów")
+    if failures:
+        print('BŁĄD: ' + '; '.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+"""
+Benchmark: parsowanie odpowiedzi DaneSzukajPodmioty - poprzednia ścieżka (regex na całym tekście,
+decode_bir_inner_xml, ET.fromstring + find per pole) vs jednoprzebiegowe iter_bir_records.
+
+Odpowiedzi budowane są tak jak w fake_gus.py (MTOM, wewnętrzny XML zakodowany encjami).
+Raportuje czas na odpowiedź i szczyt zaalokowanej pamięci (tracemalloc) dla różnej liczby rekordów;
+gdy obie ścieżki zwracają różne rekordy, kończy się kodem 1.
+
+Użycie:
+    python benchmarks/bench_bir_parse.py [liczba_powtórzeń]
+"""
+
+import os
+import re
+import sys
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_gus import _search_dane, generated_entity, mtom, soap_response  # noqa: E402
+from gus_bir import iter_bir_records  # noqa: E402
+
+FIELDS = ('Regon', 'Nip', 'Nazwa', 'Wojewodztwo', 'Powiat', 'Gmina', 'Miejscowosc', 'KodPocztowy', 'Ulica',
+          'NrNieruchomosci', 'NrLokalu', 'Typ', 'SilosID', 'MiejscowoscPoczty', 'Krs')
+
+
+def build_response(records: int) -> bytes:
+    entities = [generated_entity(str(1000000000 + i)) for i in range(records)]
+    inner = '﻿<root>\n' + '\n'.join('  ' + _search_dane(entity) for entity in entities) + '\n</root>'
+    body, _ = mtom(soap_response('DaneSzukajPodmioty', inner))
+    return body
+
+
+def extract_soap_part(text: str) -> str:
+    """Obsługa odpowiedzi multipart/MTOM – wyciągamy część SOAP, jeśli trzeba."""
+    soap_part = text or ''
+    if 'Content-Type: application/xop+xml' in soap_part:
+        match = re.search(
+            r'Content-Type: application/xop\+xml[^\r\n]*\r?\n\r?\n([\s\S]*?)\r?\n--uuid:',
+            soap_part,
+            re.MULTILINE | re.DOTALL,
+        )
+        if match:
+            soap_part = match.group(1)
+    return soap_part
+
+
+def decode_bir_inner_xml(encoded: str) -> str:
+    """
+    Dekodowanie wewnętrznego XML zwracanego przez GUS (DaneSzukajPodmiotyResult).
+    Port funkcji decodeBirInnerXml z backendu Googie_GUS (poprzednia ścieżka, tylko do porównania).
+    """
+    if not isinstance(encoded, str):
+        return ""
+
+    return (
+        encoded.lstrip("\ufeff")
+        .replace("&amp;amp;", "&amp;")
+        .replace("&#xD;", "\r")
+        .replace("&#xA;", "\n")
+        .replace("&lt;", "<")
+        .replace("&gt;", ">")
+        .replace("&quot;", '"')
+        .replace("&apos;", "'")
+        .replace("&amp;", "&")
+        .strip()
+    )
+
+
+def parse_previous(content: bytes) -> list:
+    """Ścieżka sprzed iter_bir_records (jak gus_search_nips w poprzedniej wersji)."""
+    soap_part = extract_soap_part(content.decode('utf-8'))
+    match = re.search(r'<DaneSzukajPodmiotyResult>([\s\S]*?)</DaneSzukajPodmiotyResult>', soap_part,
+                      re.MULTILINE | re.DOTALL)
+    root = ET.fromstring(decode_bir_inner_xml(match.group(1)))
+    result = []
+    for dane in root.findall('.//dane'):
+        record = {}
+        for field in FIELDS:
+            el = dane.find(field)
+            record[field] = el.text if el is not None else None
+        result.append(record)
+    return result
+
+
+def parse_streaming(content: bytes) -> list:
+    return [{field: dane.get(field) for field in FIELDS} for dane in iter_bir_records(content)]
+
+
+def measure(fn, content: bytes, repeat: int) -> tuple[float, int]:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn(content)
+    per_call = (time.perf_counter() - started) / repeat
+    tracemalloc.start()
+    fn(content)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return per_call, peak
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"{'rekordy':>8} {'KB':>7} | {'poprzednio ms':>13} {'peak KB':>8} | {'strumień ms':>11} {'peak KB':>8}")
+    for records in (1, 20, 200, 2000):
+        content = build_response(records)
+        if parse_previous(content) != parse_streaming(content):
+            print(f'BŁĄD: iter_bir_records zwraca inne rekordy niż poprzednia ścieżka ({records} rekordów)',
+                  file=sys.stderr)
+            sys.exit(1)
+        n = max(1, repeat // max(1, records // 20))
+        old_time, old_peak = measure(parse_previous, content, n)
+        new_time, new_peak = measure(parse_streaming, content, n)
+        print(f'{records:>8} {len(content) // 1024:>7} | {old_time * 1000:>13.3f} {old_peak // 1024:>8} | '
+              f'{new_time * 1000:>11.3f} {new_peak // 1024:>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,382 @@
+"""
+Benchmark end-to-end: przepustowość i opóźnienia endpointów aplikacji pod obciążeniem.
+
+Uruchamia aplikację przez gunicorna (jak na Render, Procfile: gunicorn app:app)
+w osobnym procesie, kieruje ją na lokalne serwery udające wFirma (fake_wfirma.py)
+i GUS BIR (fake_gus.py) i wysyła requesty z zadaną współbieżnością. Scenariusze:
+    workflow      POST /api/workflow/create-invoice-from-nip (stali klienci, PDF inline + email)
+    gus-validate  POST /api/gus/validate-nip (--gus-source cache: wyniki z lokalnego cache aplikacji,
+                  fake: każde zapytanie idzie do fake_gus - cache GUS wyłączony)
+    pdf           GET  /api/invoice/<id>/pdf (faktury utworzone wcześniej w fake wFirma)
+
+Dla każdego scenariusza i poziomu współbieżności raportuje p50/p95/p99, requesty/s,
+błędy, wywołania wFirma i GUS na request (per krok) i szczytowy RSS procesów gunicorna.
+Wynik zapisywany jest do JSON; --compare pokazuje zmianę względem poprzedniego pliku.
+Gdy któryś request zakończył się błędem (fake serwery nie wstrzykują błędów), kod wyjścia to 1.
+
+Użycie:
+    python benchmarks/bench_e2e.py --requests 200 --concurrency 1,4,16 --latency 0.05
+    python benchmarks/bench_e2e.py --scenario workflow --output after.json --compare before.json
+    python benchmarks/bench_e2e.py --gunicorn-args "-w 2 -k gthread --threads 8"
+    python benchmarks/bench_e2e.py --scenario gus-validate --gus-source fake --gus-latency 0.2
+"""
+
+import argparse
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fake_gus import start_fake_gus  # noqa: E402
+from fake_wfirma import start_fake_wfirma  # noqa: E402
+from gus_bir import BIR_HOST_TEST, BIR_TEST_API_KEY, GusResultCache  # noqa: E402
+
+SCENARIOS = ('workflow', 'gus-validate', 'pdf')
+
+API_KEY = 'bench-api-key'
+REGON_KEY = 'bench-regon-key'
+NIP_WEIGHTS = (6, 5, 7, 2, 3, 4, 5, 6, 7)
+
+
+def random_nip(rng: random.Random) -> str:
+    """Losowy NIP z poprawną sumą kontrolną."""
+    while True:
+        digits = [rng.randint(1, 9)] + [rng.randint(0, 9) for _ in range(8)]
+        checksum = sum(d * w for d, w in zip(digits, NIP_WEIGHTS)) % 11
+        if checksum != 10:
+            return ''.join(map(str, digits)) + str(checksum)
+
+
+def gus_record(nip: str) -> dict:
+    """Rekord DaneSzukajPodmioty w kształcie zwracanym przez gus_search_nips."""
+    return {
+        'nip': nip, 'regon': nip[:9], 'nazwa': f'FIRMA BENCHMARKOWA {nip} SP. Z O.O.',
+        'wojewodztwo': 'MAZOWIECKIE', 'powiat': 'Warszawa', 'gmina': 'Śródmieście',
+        'miejscowosc': 'Warszawa', 'kodPocztowy': '00-001', 'ulica': 'ul. Testowa',
+        'nrNieruchomosci': '1', 'nrLokalu': '', 'typ': 'P', 'krs': '',
+    }
+
+
+def percentile(values: list, p: float) -> float | None:
+    """Percentyl (metoda najbliższego rzędu) z posortowanej listy."""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def process_tree(pid: int) -> list[int]:
+    """pid i wszyscy potomkowie (Linux /proc)."""
+    result, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        result.append(current)
+        try:
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                queue.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return result
+
+
+def peak_rss_kb(pid: int) -> dict:
+    """Szczytowy RSS (VmHWM) procesu głównego gunicorna i workerów, w KB."""
+    peaks = {}
+    for current in process_tree(pid):
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks[current] = int(line.split()[1])
+        except OSError:
+            pass
+    return {
+        'max_process_kb': max(peaks.values()) if peaks else None,
+        'sum_kb': sum(peaks.values()) if peaks else None,
+        'processes': len(peaks),
+    }
+
+
+def start_app(workdir: str, port: int, env: dict, gunicorn_args: str) -> subprocess.Popen:
+    """Uruchom gunicorna z aplikacją i poczekaj aż zacznie odpowiadać."""
+    cmd = [sys.executable, '-m', 'gunicorn', '--chdir', ROOT, '--bind', f'127.0.0.1:{port}',
+           *shlex.split(gunicorn_args), 'app:app']
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn zakończył się: {proc.stderr.read().decode(errors="replace")[-2000:]}')
+        try:
+            requests.get(f'http://127.0.0.1:{port}/api/token/status', headers={'X-API-Key': API_KEY}, timeout=1)
+            return proc
+        except requests.RequestException:
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('gunicorn nie wystartował w 30 s')
+
+
+def build_requests(scenario: str, args, nips: list, invoice_ids: list):
+    """Funkcja (i) -> (metoda, ścieżka, kwargs) dla scenariusza."""
+    if scenario == 'workflow':
+        def make(i):
+            return 'POST', '/api/workflow/create-invoice-from-nip', {
+                'headers': {'X-API-Key': API_KEY},
+                'json': {
+                    'company': 'md', 'nip': nips[i % len(nips)], 'email': 'klient@example.com',
+                    'payment_status': 'paid', 'pdf': args.pdf_mode,
+                    'invoice': {'positions': [{'name': 'Usługa', 'quantity': 1, 'unit_price_net': 100, 'vat_rate': '23'}]},
+                },
+            }
+    elif scenario == 'gus-validate':
+        def make(i):
+            return 'POST', '/api/gus/validate-nip', {
+                'headers': {'X-API-Key': REGON_KEY}, 'json': {'nip': nips[i % len(nips)]},
+            }
+    else:
+        def make(i):
+            return 'GET', f'/api/invoice/{invoice_ids[i % len(invoice_ids)]}/pdf', {
+                'headers': {'X-API-Key': API_KEY},
+            }
+    return make
+
+
+def run_load(base_url: str, make_request, total: int, concurrency: int) -> dict:
+    """Wyślij `total` requestów z `concurrency` wątków (każdy z własną sesją keep-alive)."""
+    latencies, statuses, errors = [], {}, []
+    counter = iter(range(total))
+    lock = threading.Lock()
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            method, path, kwargs = make_request(i)
+            started = time.perf_counter()
+            try:
+                resp = session.request(method, base_url + path, timeout=120, **kwargs)
+                _ = resp.content
+                status = resp.status_code
+            except requests.RequestException as e:
+                status = 'exception'
+                with lock:
+                    errors.append(str(e)[:200])
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ok = sum(count for status, count in statuses.items() if status.startswith('2'))
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'wall_s': round(wall, 3),
+        'rps': round(total / wall, 2) if wall else None,
+        'ok': ok,
+        'errors': total - ok,
+        'statuses': statuses,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 2),
+            'p95': round(percentile(latencies, 95) * 1000, 2),
+            'p99': round(percentile(latencies, 99) * 1000, 2),
+            'max': round(latencies[-1] * 1000, 2),
+            'mean': round(sum(latencies) / len(latencies) * 1000, 2),
+        },
+        'exceptions': errors[:5],
+    }
+
+
+def compare(results: dict, baseline_path: str) -> list[str]:
+    """Linie porównania p50/p95/rps z poprzednim plikiem wyników."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    before = {(r['scenario'], r['concurrency']): r for r in baseline.get('runs', [])}
+    lines = []
+    for run in results['runs']:
+        old = before.get((run['scenario'], run['concurrency']))
+        if not old:
+            continue
+
+        def delta(new, prev):
+            return f'{(new - prev) / prev * 100:+.1f}%' if prev else 'n/a'
+        lines.append(
+            f"{run['scenario']:<13} c={run['concurrency']:<3} "
+            f"p50 {old['latency_ms']['p50']}->{run['latency_ms']['p50']} ms ({delta(run['latency_ms']['p50'], old['latency_ms']['p50'])}), "
+            f"p95 {old['latency_ms']['p95']}->{run['latency_ms']['p95']} ms ({delta(run['latency_ms']['p95'], old['latency_ms']['p95'])}), "
+            f"rps {old['rps']}->{run['rps']} ({delta(run['rps'], old['rps'])})"
+        )
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark end-to-end aplikacji (gunicorn + fake wFirma)')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenariusz (można powtarzać, domyślnie wszystkie)')
+    parser.add_argument('--requests', type=int, default=200, help='liczba requestów na scenariusz i poziom współbieżności')
+    parser.add_argument('--concurrency', default='1,4,16', help='poziomy współbieżności, np. 1,4,16')
+    parser.add_argument('--warmup', type=int, default=10, help='requesty rozgrzewające (nie liczone)')
+    parser.add_argument('--latency', type=float, default=0.05, help='opóźnienie odpowiedzi fake wFirma (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='losowe dodatkowe opóźnienie fake wFirma (s)')
+    parser.add_argument('--gus-source', choices=('cache', 'fake'), default='cache',
+                        help='cache = wyniki GUS z cache aplikacji, fake = zapytania do fake_gus (cache GUS wyłączony)')
+    parser.add_argument('--gus-latency', type=float, default=0.1, help='opóźnienie odpowiedzi fake GUS (s)')
+    parser.add_argument('--pdf-mode', default='inline', help='tryb pdf w workflow (inline, url, none, multipart)')
+    parser.add_argument('--pdf-size', type=int, default=60000, help='rozmiar PDF faktury (bajty)')
+    parser.add_argument('--nips', type=int, default=50, help='liczba różnych NIP (stałych klientów)')
+    parser.add_argument('--invoices', type=int, default=20, help='liczba faktur w scenariuszu pdf')
+    parser.add_argument('--gunicorn-args', default='', help='dodatkowe argumenty gunicorna, np. "-w 2 --threads 8"')
+    parser.add_argument('--output', help='plik JSON z wynikami (domyślnie bench_e2e_<czas>.json)')
+    parser.add_argument('--compare', help='poprzedni plik wyników do porównania')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    scenarios = args.scenario or list(SCENARIOS)
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    rng = random.Random(args.seed)
+    nips = sorted({random_nip(rng) for _ in range(args.nips)})
+
+    server, state = start_fake_wfirma(latency=args.latency, jitter=args.jitter, pdf_size=args.pdf_size,
+                                      auto_contractors=True)
+    workdir = tempfile.mkdtemp(prefix='bench_e2e_')
+    data_dir = os.path.join(workdir, 'data')
+    os.makedirs(data_dir)
+
+    gus_server = gus_state = None
+    if args.gus_source == 'fake':
+        gus_server, gus_state = start_fake_gus(latency=args.gus_latency)
+    else:
+        # GUS bez sieci: wyniki dla NIP-ów z puli w cache aplikacji (środowisko testowe BIR)
+        gus_cache = GusResultCache(os.path.join(data_dir, 'gus_cache.sqlite3'))
+        for nip in nips:
+            gus_cache.put(BIR_HOST_TEST, nip, [gus_record(nip)])
+
+    # Faktury do scenariusza pdf
+    contractor = state.contractors_add({'contractors': {'contractor': {'name': 'Klient PDF', 'nip': nips[0]}}})
+    contractor_id = contractor['contractors']['0']['contractor']['id']
+    invoice_ids = []
+    for _ in range(args.invoices):
+        added = state.invoices_add({'invoices': {'invoice': {
+            'contractor_id': contractor_id,
+            'invoicecontents': {'0': {'invoicecontent': {'name': 'Usługa', 'count': 1, 'price': 100, 'vat_code': {'id': 222}}}},
+        }}})
+        invoice_ids.append(added['invoices']['0']['invoice']['id'])
+
+    env = dict(os.environ)
+    for name in ('RENDER_API_KEY', 'RENDER_SERVICE_ID', 'WEBHOOK_TOKEN_EXPIRE_NOTIFY'):
+        env.pop(name, None)
+    env.update({
+        'WFIRMA_API_URL': server.base_url,
+        'WFIRMA_MD_ACCESS_TOKEN': 'bench-token',
+        'WFIRMA_MD_TOKEN_EXPIRES': str(int(time.time()) + 24 * 3600),
+        'MAKE_RENDER_API_KEY': API_KEY,
+        'REGON_API_KEY_TOKEN': REGON_KEY,
+        'GUS_API_KEY': BIR_TEST_API_KEY,
+        'WFIRMA_DATA_DIR': data_dir,
+        'PDF_CACHE_DIR': os.path.join(workdir, 'invoices'),
+    })
+    if gus_server is not None:
+        env.update({'GUS_BIR_URL': gus_server.service_url, 'GUS_CACHE': 'false'})
+    port = free_port()
+    app_proc = start_app(workdir, port, env, args.gunicorn_args)
+    base_url = f'http://127.0.0.1:{port}'
+
+    runs = []
+    try:
+        for scenario in scenarios:
+            make_request = build_requests(scenario, args, nips, invoice_ids)
+            if args.warmup:
+                run_load(base_url, make_request, args.warmup, 1)
+            for concurrency in levels:
+                state.reset_counters()
+                if gus_state is not None:
+                    gus_state.reset_counters()
+                result = run_load(base_url, make_request, args.requests, concurrency)
+                stats = state.stats()
+                result['scenario'] = scenario
+                result['upstream'] = {
+                    'wfirma_calls_per_request': round(stats['requests'] / args.requests, 3),
+                    'wfirma_calls_by_step': {step: round(count / args.requests, 3) for step, count in stats['calls'].items()},
+                    'wfirma_connections': stats['connections'],
+                }
+                if gus_state is not None:
+                    gus_stats = gus_state.stats()
+                    result['upstream'].update({
+                        'gus_calls_per_request': round(gus_stats['requests'] / args.requests, 3),
+                        'gus_calls_by_method': {method: round(count / args.requests, 3)
+                                                for method, count in gus_stats['calls'].items()},
+                        'gus_logins': gus_stats['logins'],
+                        'gus_connections': gus_stats['connections'],
+                    })
+                runs.append(result)
+                print(f"{scenario:<13} c={concurrency:<3} rps={result['rps']:<8} "
+                      f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                      f"p99={result['latency_ms']['p99']}ms errors={result['errors']} "
+                      f"wfirma/req={result['upstream']['wfirma_calls_per_request']}"
+                      f"{' gus/req=%s' % result['upstream']['gus_calls_per_request'] if gus_state else ''}", flush=True)
+        rss = peak_rss_kb(app_proc.pid)
+    finally:
+        app_proc.send_signal(signal.SIGTERM)
+        try:
+            app_proc.wait(10)
+        except subprocess.TimeoutExpired:
+            app_proc.kill()
+        server.shutdown()
+        if gus_server is not None:
+            gus_server.shutdown()
+
+    results = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'requests': args.requests, 'concurrency': levels, 'warmup': args.warmup,
+            'wfirma_latency_s': args.latency, 'wfirma_jitter_s': args.jitter, 'pdf_mode': args.pdf_mode,
+            'pdf_size': args.pdf_size, 'nips': len(nips), 'invoices': args.invoices,
+            'gunicorn_args': args.gunicorn_args, 'gus_source': args.gus_source,
+            'gus_latency_s': args.gus_latency if args.gus_source == 'fake' else None,
+        },
+        'peak_rss': rss,
+        'runs': runs,
+    }
+    output = args.output or f"bench_e2e_{time.strftime('%Y%m%d_%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"peak RSS: {rss['max_process_kb']} KB (max proces), {rss['sum_kb']} KB (suma {rss['processes']} procesów)")
+    print(f'Wyniki: {output}')
+    if args.compare:
+        print('\n'.join(compare(results, args.compare)))
+    failed_runs = [f"{run['scenario']} c={run['concurrency']}: {run['errors']}" for run in runs if run['errors']]
+    if failed_runs:
+        print('BŁĄD: requesty zakończone błędem - ' + ', '.join(failed_runs), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
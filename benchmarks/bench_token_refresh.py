@@ -0,0 +1,139 @@
+"""
+Benchmark: ile wywołań oauth2/token powoduje fala równoczesnych requestów
+z wygasłym access tokenem.
+
+Uruchamia lokalny serwer udający oauth2/token wFirma (z opóźnieniem, żeby
+okno wyścigu było szerokie), ustawia wygasły token i startuje kilka procesów
+(jak workery gunicorna), w każdym kilka wątków wołających jednocześnie
+load_token(). Przy single-flight odświeżenie powinno nastąpić dokładnie raz,
+a pozostałe requesty powinny dostać nowy token w milisekundach po nim - inaczej
+skrypt kończy się kodem 1.
+
+Użycie:
+    python benchmarks/bench_token_refresh.py [procesy] [wątki_na_proces]
+"""
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOKEN_ENDPOINT_DELAY = 0.2
+
+
+class FakeOAuthHandler(BaseHTTPRequestHandler):
+    """oauth2/token zwracający kolejno ponumerowane tokeny."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    token_calls = 0
+    _lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        return  # wycisz logi serwera
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        with FakeOAuthHandler._lock:
+            FakeOAuthHandler.token_calls += 1
+            number = FakeOAuthHandler.token_calls
+        time.sleep(TOKEN_ENDPOINT_DELAY)
+        body = json.dumps({
+            'access_token': f'bench-token-{number}',
+            'refresh_token': f'bench-refresh-{number}',
+            'expires_in': 3600,
+        }).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def worker(app_module, threads: int, barrier, results):
+    """Jeden proces = jeden worker gunicorna: `threads` równoczesnych load_token()."""
+    outcomes = []
+    lock = threading.Lock()
+
+    def one_request():
+        barrier.wait()
+        started = time.perf_counter()
+        token = app_module.load_token(silent=True, company='md')
+        with lock:
+            outcomes.append((token, time.perf_counter() - started))
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        pool = [threading.Thread(target=one_request) for _ in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    results.put(outcomes)
+
+
+def main():
+    processes = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeOAuthHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Konfiguracja aplikacji PRZED importem (app.py czyta ENV przy imporcie)
+    os.environ['WFIRMA_API_URL'] = f'http://127.0.0.1:{server.server_port}'
+    os.environ['WFIRMA_MD_ACCESS_TOKEN'] = 'expired-token'
+    os.environ['WFIRMA_MD_TOKEN_EXPIRES'] = str(int(time.time()) - 10)
+    os.environ['WFIRMA_MD_REFRESH_TOKEN'] = 'bench-refresh-0'
+    os.environ.pop('RENDER_API_KEY', None)
+    os.chdir(tempfile.mkdtemp(prefix='bench_tokens_'))  # WFIRMA_DATA_DIR=data (blokady, stan tokenów)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(processes * threads)
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(app_module, threads, barrier, results)) for _ in range(processes)]
+    for p in procs:
+        p.start()
+    outcomes = [item for _ in procs for item in results.get()]
+    for p in procs:
+        p.join()
+    server.shutdown()
+
+    latencies = sorted(elapsed for _, elapsed in outcomes)
+    distinct_tokens = sorted({token for token, _ in outcomes}, key=str)
+    print(json.dumps({
+        'processes': processes,
+        'threads_per_process': threads,
+        'requests': len(outcomes),
+        'oauth2_token_calls': FakeOAuthHandler.token_calls,
+        'distinct_tokens': distinct_tokens,
+        'token_endpoint_delay_s': TOKEN_ENDPOINT_DELAY,
+        'latency_max_s': round(latencies[-1], 3),
+        'latency_p50_s': round(latencies[len(latencies) // 2], 3),
+    }, indent=2))
+
+    failures = []
+    if len(outcomes) != processes * threads:
+        failures.append(f'odpowiedzi: {len(outcomes)} z {processes * threads}')
+    if FakeOAuthHandler.token_calls != 1:
+        failures.append(f'oauth2/token wywołane {FakeOAuthHandler.token_calls} razy (oczekiwano 1)')
+    if distinct_tokens != ['bench-token-1']:
+        failures.append(f'requesty dostały tokeny {distinct_tokens} (oczekiwano jednego nowego)')
+    if failures:
+        print('BŁĄD: ' + '; '.join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark: ile nowych połączeń TCP (= handshake'ów TLS na produkcji) kosztuje
+jedno wywołanie /api/workflow/create-invoice-from-nip.
+
+Uruchamia lokalny serwer udający api2.wfirma.pl (benchmarks/fake_wfirma.py), kieruje na niego
+aplikację przez WFIRMA_API_URL i porównuje:
+  - przed: każde wywołanie wfirma_* przez goły requests (WFIRMA_HTTP_KEEPALIVE=false)
+  - po:    współdzielona sesja keep-alive per firma (SessionRegistry)
+Kończy się kodem 1, gdy sesja keep-alive nie zmniejsza liczby połączeń.
+
+Użycie:
+    python benchmarks/bench_wfirma_handshakes.py [liczba_workflow]
+"""
+
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_wfirma import start_fake_wfirma  # noqa: E402
+
+
+def run_workflows(app_module, state, count: int, keepalive: bool) -> dict:
+    """Wykonaj `count` workflow przez test client Flaska i zlicz połączenia."""
+    app_module.wfirma_sessions.close()
+    app_module.company_id_cache.invalidate()
+    app_module.series_index.invalidate()
+    app_module.wfirma_sessions.enabled = keepalive
+    state.reset_counters()
+
+    client = app_module.app.test_client()
+    body = {
+        'company': 'md',
+        'nip': '5261040828',
+        'email': 'klient@example.com',
+        'payment_status': 'paid',
+        'invoice': {'positions': [{'name': 'Usługa', 'quantity': 1, 'unit_price_net': 100, 'vat_rate': '23'}]},
+    }
+    started = time.perf_counter()
+    for _ in range(count):
+        resp = client.post('/api/workflow/create-invoice-from-nip', json=body)
+        if resp.status_code != 200:
+            raise RuntimeError(f'Workflow zwrócił {resp.status_code}: {resp.get_data(as_text=True)[:300]}')
+    elapsed = time.perf_counter() - started
+
+    return {
+        'keepalive': keepalive,
+        'workflows': count,
+        'upstream_requests': state.requests_count,
+        'connections': state.connections,
+        'connections_per_workflow': round(state.connections / count, 2),
+        'elapsed_s': round(elapsed, 3),
+    }
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    # Stały klient: contractors/find znajduje każdy NIP (bez GUS i contractors/add)
+    server, state = start_fake_wfirma(auto_contractors=True)
+
+    # Konfiguracja aplikacji PRZED importem (app.py czyta ENV przy imporcie)
+    os.environ['WFIRMA_API_URL'] = server.base_url
+    os.environ['WFIRMA_MD_ACCESS_TOKEN'] = 'bench-token'
+    os.environ['WFIRMA_MD_TOKEN_EXPIRES'] = str(int(time.time()) + 3600)
+    os.environ.pop('MAKE_RENDER_API_KEY', None)
+    os.chdir(tempfile.mkdtemp(prefix='bench_wfirma_'))  # workflow zapisuje PDF do invoices/
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        import app as app_module
+
+        before = run_workflows(app_module, state, count, keepalive=False)
+        after = run_workflows(app_module, state, count, keepalive=True)
+
+    server.shutdown()
+    print(json.dumps({'before': before, 'after': after}, indent=2))
+    if after['connections'] >= before['connections']:
+        print(f"BŁĄD: keep-alive nie zmniejsza liczby połączeń ({before['connections']} -> {after['connections']})",
+              file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
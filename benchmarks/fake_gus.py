@@ -0,0 +1,654 @@
+"""
+Lokalny serwer udający usługę GUS BIR1.1 (UslugaBIRzewnPubl.svc) - do benchmarków
+i testów ścieżek GUS bez sieci i bez limitów wyszukiwarkaregon.stat.gov.pl.
+
+Zbudowany na podstawie dokumentacji BIR dołączonej do repozytorium
+(Googie_GUS/Documents/GUS-Regon-UslugaBIRver1.2-dokumentacjaVer1.35):
+    - metody: Zaloguj, Wyloguj, GetValue (StatusSesji, KomunikatKod, KomunikatTresc,
+      StanDanych, StatusUslugi, KomunikatUslugi), DaneSzukajPodmioty (Nip, Nipy, Regon,
+      Regony9zn, Regony14zn, Krs, Krsy) i DanePobierzPelnyRaport,
+    - odpowiedzi SOAP 1.2 w kopercie MTOM (multipart/related, application/xop+xml)
+      z wewnętrznym XML zakodowanym encjami - jak w prawdziwej usłudze,
+    - kody błędów z BIR11_StrukturyDanych: 2 (za dużo identyfikatorów), 4 (nie znaleziono),
+      5 (nieprawidłowa nazwa raportu), KomunikatKod 7 / pusty wynik przy braku sesji,
+    - raporty pełne z BIR11-PrzykladoweDane.xml (REGON, NIP i nazwa podmienione).
+
+Podmioty: GUS z przykładu w dokumentacji (NIP 5261040828) oraz - dla każdego innego NIP
+z poprawną sumą kontrolną - deterministycznie wygenerowany podmiot (unknown_nips=generate).
+unknown_nips=not_found: tylko znane podmioty, reszta ErrorCode 4.
+
+Opóźnienia, wygasanie sesji i błędy można ustawić z linii poleceń albo w trakcie działania:
+    POST /_fake/config  {"latency": 0.2, "step_latency": {"Zaloguj": 0.5}, "session_ttl": 60,
+                         "error_rate": 0.1, "error_mode": "session", "not_found_nips": ["1234563218"]}
+    GET  /_fake/stats   liczniki wywołań per metoda, logowań, odrzuconych sesji, połączeń TCP
+    POST /_fake/expire-sessions   unieważnij wszystkie sesje (test ponownego logowania)
+    POST /_fake/reset   wyczyść sesje, wygenerowane podmioty i liczniki (/_fake/reset-counters - tylko liczniki)
+
+Tryby błędów (error_mode): http (HTTP 500 z SOAP Fault), session (sesja unieważniona przed
+wywołaniem - pusty wynik i KomunikatKod 7), code (dane z ErrorCode = error_code),
+timeout (odpowiedź dopiero po hang_seconds).
+
+Aplikację kieruje się na serwer zmienną GUS_BIR_URL:
+    python benchmarks/fake_gus.py --port 8082 --latency 0.2
+    GUS_BIR_URL=http://127.0.0.1:8082/wsBIR/UslugaBIRzewnPubl.svc python app.py
+
+Użycie z kodu (benchmarki):
+    server, state = start_fake_gus(latency=0.1)
+    os.environ['GUS_BIR_URL'] = server.service_url
+"""
+
+import argparse
+import hashlib
+import html
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from xml.sax.saxutils import escape
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_DATA = os.path.join(ROOT, 'Googie_GUS', 'Documents', 'GUS-Regon-UslugaBIRver1.2-dokumentacjaVer1.35',
+                           'BIR11-PrzykladoweDane.xml')
+
+NS_PUBL = 'http://CIS/BIR/PUBL/2014/07'
+NS_BIR = 'http://CIS/BIR/2014/07'
+ACTION_PUBL = 'http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/'
+ACTION_BIR = 'http://CIS/BIR/2014/07/IUslugaBIR/'
+
+ERROR_MODES = ('http', 'session', 'code', 'timeout')
+UNKNOWN_NIPS_MODES = ('generate', 'not_found')
+
+MAX_IDS_PER_SEARCH = 20  # limit identyfikatorów w Nipy / Regony9zn / Regony14zn / Krsy
+
+NIP_WEIGHTS = (6, 5, 7, 2, 3, 4, 5, 6, 7)
+REGON9_WEIGHTS = (8, 9, 2, 3, 4, 5, 6, 7)
+
+ERROR_MESSAGES = {
+    '2': ('Do metody DaneSzukaj przekazano zbyt wiele identyfikatorów.',
+          'Too many identifiers were passed to the DaneSzukaj method.'),
+    '4': ('Nie znaleziono podmiotu dla podanych kryteriów wyszukiwania.',
+          'No data found for the specified search criteria.'),
+    '5': ('Nieprawidłowa lub pusta nazwa raportu.', 'Invalid or empty report name.'),
+}
+
+# Podmiot z przykładu 1 w BIR11-PrzykladoweDane.xml (Główny Urząd Statystyczny)
+GUS_ENTITY = {
+    'Regon': '000331501', 'Nip': '5261040828', 'Nazwa': 'GŁÓWNY URZĄD STATYSTYCZNY',
+    'Wojewodztwo': 'MAZOWIECKIE', 'Powiat': 'm. st. Warszawa', 'Gmina': 'Śródmieście',
+    'Miejscowosc': 'Warszawa', 'KodPocztowy': '00-925', 'Ulica': 'ul. Test-Krucza',
+    'NrNieruchomosci': '208', 'NrLokalu': '', 'Typ': 'P', 'SilosID': '6',
+    'MiejscowoscPoczty': 'Warszawa', 'Krs': '',
+}
+
+# Adresy wygenerowanych podmiotów: (województwo, powiat, gmina, miejscowość, kod pocztowy)
+ADDRESSES = (
+    ('MAZOWIECKIE', 'm. st. Warszawa', 'Mokotów', 'Warszawa', '02-672'),
+    ('MAŁOPOLSKIE', 'm. Kraków', 'Kraków-Śródmieście', 'Kraków', '31-042'),
+    ('WIELKOPOLSKIE', 'm. Poznań', 'Poznań', 'Poznań', '61-701'),
+    ('POMORSKIE', 'm. Gdańsk', 'Gdańsk', 'Gdańsk', '80-831'),
+    ('DOLNOŚLĄSKIE', 'm. Wrocław', 'Wrocław', 'Wrocław', '50-077'),
+    ('LUBELSKIE', 'kraśnicki', 'Kraśnik', 'Kraśnik', '23-200'),
+)
+STREETS = ('ul. Test-Krucza', 'ul. Test-Wilcza', 'ul. Testowa', 'al. Próbna', 'ul. Przykładowa')
+
+# Pola wyniku DaneSzukajPodmioty w kolejności z DaneSzukajPodmioty.xsd
+SEARCH_FIELDS = ('Regon', 'Nip', 'StatusNip', 'Nazwa', 'Wojewodztwo', 'Powiat', 'Gmina', 'Miejscowosc',
+                 'KodPocztowy', 'Ulica', 'NrNieruchomosci', 'NrLokalu', 'Typ', 'SilosID',
+                 'DataZakonczeniaDzialalnosci', 'MiejscowoscPoczty')
+
+
+def nip_valid(nip: str) -> bool:
+    if len(nip) != 10 or not nip.isdigit():
+        return False
+    checksum = sum(int(d) * w for d, w in zip(nip, NIP_WEIGHTS)) % 11
+    return checksum != 10 and checksum == int(nip[9])
+
+
+def regon9(digits: str) -> str:
+    """REGON 9-cyfrowy z 8 cyfr i cyfry kontrolnej (reszta 10 -> 0)."""
+    checksum = sum(int(d) * w for d, w in zip(digits, REGON9_WEIGHTS)) % 11
+    return digits + str(checksum % 10)
+
+
+def generated_entity(nip: str) -> dict:
+    """Deterministyczny podmiot dla NIP (ten sam NIP -> te same dane przy każdym uruchomieniu)."""
+    digest = hashlib.sha256(nip.encode('ascii')).hexdigest()
+    seed = int(digest, 16)
+    voivodeship, county, commune, city, postal = ADDRESSES[seed % len(ADDRESSES)]
+    natural_person = seed % 4 == 0  # co czwarty podmiot to osoba fizyczna (CEIDG)
+    return {
+        'Regon': regon9(str(seed % 10 ** 8).zfill(8)),
+        'Nip': nip,
+        'Nazwa': (f'PRZEDSIĘBIORSTWO TESTOWE {nip} JAN KOWALSKI' if natural_person
+                  else f'FIRMA TESTOWA {nip} SPÓŁKA Z OGRANICZONĄ ODPOWIEDZIALNOŚCIĄ'),
+        'Wojewodztwo': voivodeship, 'Powiat': county, 'Gmina': commune, 'Miejscowosc': city,
+        'KodPocztowy': postal, 'Ulica': STREETS[(seed >> 8) % len(STREETS)],
+        'NrNieruchomosci': str((seed >> 16) % 200 + 1), 'NrLokalu': str((seed >> 24) % 30) if seed % 3 else '',
+        'Typ': 'F' if natural_person else 'P', 'SilosID': '1' if natural_person else '6',
+        'MiejscowoscPoczty': city, 'Krs': '' if natural_person else str((seed >> 32) % 10 ** 6).zfill(10),
+    }
+
+
+def load_report_templates(path: str = SAMPLE_DATA) -> dict:
+    """
+    Raporty DanePobierzPelnyRaport z pliku przykładowych danych BIR: {nazwa raportu: <root>...</root>}.
+    Bierzemy pierwszy przykład każdego raportu (komentarz <!-- BIR11... --> przed blokiem <root>).
+    """
+    try:
+        with open(path, encoding='utf-8-sig') as f:
+            text = f.read()
+    except OSError:
+        return {}
+    templates = {}
+    for match in re.finditer(r'<!--\s*(?:Raport\s+)?(BIR11\w+)\s*-->\s*(<root>.*?</root>)', text, re.DOTALL):
+        templates.setdefault(match.group(1), match.group(2))
+    return templates
+
+
+def report_entity_type(report: str) -> str | None:
+    """Typ podmiotu, którego dotyczy raport (P, F, LP, LF) - raport dla innego typu zwraca ErrorCode 4."""
+    name = report[len('BIR11'):]
+    if name.startswith('JednLokalnaOsPrawnej'):
+        return 'LP'
+    if name.startswith('JednLokalnaOsFizycznej'):
+        return 'LF'
+    if name.startswith('OsPrawna'):
+        return 'P'
+    if name.startswith('OsFizyczna'):
+        return 'F'
+    return None
+
+
+def _error_dane(code: str, **fields) -> str:
+    message_pl, message_en = ERROR_MESSAGES.get(code, ('Wstrzyknięty błąd (fake_gus).', 'Injected error (fake_gus).'))
+    extra = ''.join(f'<{name}>{escape(str(value))}</{name}>' for name, value in fields.items())
+    return (f'<root><dane><ErrorCode>{code}</ErrorCode><ErrorMessagePl>{message_pl}</ErrorMessagePl>'
+            f'<ErrorMessageEn>{message_en}</ErrorMessageEn>{extra}</dane></root>')
+
+
+def _search_dane(entity: dict) -> str:
+    parts = []
+    for field in SEARCH_FIELDS:
+        value = entity.get(field) or ''
+        parts.append(f'<{field}>{escape(value)}</{field}>' if value else f'<{field} />')
+    return '<dane>' + ''.join(parts) + '</dane>'
+
+
+def _ids(value: str) -> list[str]:
+    """Identyfikatory z parametru zbiorczego (Nipy, Regony9zn, ...) - dowolny separator."""
+    return re.findall(r'\d+', value or '')
+
+
+class FakeGusState:
+    """
+    Stan i konfiguracja serwera (bezpieczne wątkowo).
+
+    Args:
+        latency: Bazowe opóźnienie każdej odpowiedzi (s)
+        jitter: Losowe dodatkowe opóźnienie 0..jitter (s)
+        step_latency: Opóźnienie per metoda, np. {"Zaloguj": 0.5} (zastępuje latency)
+        session_ttl: Czas życia sesji od zalogowania (s; BIR: 60 minut)
+        error_rate: Prawdopodobieństwo wstrzyknięcia błędu w każdym wywołaniu (0-1)
+        step_errors: Prawdopodobieństwo błędu per metoda (zastępuje error_rate)
+        error_mode: Rodzaj wstrzykiwanego błędu (ERROR_MODES)
+        error_code: ErrorCode zwracany w trybie code
+        hang_seconds: Czas "zawieszenia" w trybie timeout
+        unknown_nips: generate = każdy poprawny NIP istnieje, not_found = tylko znane podmioty
+        not_found_nips: NIP-y, dla których zawsze ErrorCode 4
+        api_keys: Akceptowane klucze Zaloguj (pusta lista = każdy niepusty klucz)
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, step_latency: dict = None,
+                 session_ttl: float = 3600.0, error_rate: float = 0.0, step_errors: dict = None,
+                 error_mode: str = 'http', error_code: str = '2', hang_seconds: float = 120.0,
+                 unknown_nips: str = 'generate', not_found_nips: list = None, api_keys: list = None):
+        self._lock = threading.Lock()
+        self.config = {}
+        self.templates = load_report_templates()
+        self.configure(latency=latency, jitter=jitter, step_latency=step_latency or {},
+                       session_ttl=session_ttl, error_rate=error_rate, step_errors=step_errors or {},
+                       error_mode=error_mode, error_code=str(error_code), hang_seconds=hang_seconds,
+                       unknown_nips=unknown_nips, not_found_nips=list(not_found_nips or []),
+                       api_keys=list(api_keys or []))
+        self.reset()
+
+    def configure(self, **changes) -> dict:
+        """Zmień konfigurację w trakcie działania (np. z POST /_fake/config)."""
+        unknown = set(changes) - {'latency', 'jitter', 'step_latency', 'session_ttl', 'error_rate', 'step_errors',
+                                  'error_mode', 'error_code', 'hang_seconds', 'unknown_nips', 'not_found_nips',
+                                  'api_keys'}
+        if unknown:
+            raise ValueError(f'Nieznane opcje: {sorted(unknown)}')
+        if changes.get('error_mode', 'http') not in ERROR_MODES:
+            raise ValueError(f'error_mode: jeden z {ERROR_MODES}')
+        if changes.get('unknown_nips', 'generate') not in UNKNOWN_NIPS_MODES:
+            raise ValueError(f'unknown_nips: jeden z {UNKNOWN_NIPS_MODES}')
+        with self._lock:
+            self.config.update(changes)
+            return dict(self.config)
+
+    def reset(self) -> None:
+        """Wyczyść sesje i podmioty (zostaje GUS z dokumentacji) oraz liczniki."""
+        with self._lock:
+            self.sessions = {}  # sid -> {'created': time, 'code': KomunikatKod ostatniej operacji}
+            self.entities = {}  # regon -> podmiot
+            self.regons_by_nip = {}
+            self.regons_by_krs = {}
+            self._add_entity(dict(GUS_ENTITY))
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        """Wyzeruj liczniki wywołań i połączeń (sesje i podmioty zostają)."""
+        with self._lock:
+            self.connections = 0
+            self.requests_count = 0
+            self.calls = {}
+            self.injected_errors = {}
+            self.logins = 0
+            self.rejected_sessions = 0
+            self.searched_ids = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'requests': self.requests_count,
+                'calls': dict(sorted(self.calls.items())),
+                'injected_errors': dict(sorted(self.injected_errors.items())),
+                'logins': self.logins,
+                'rejected_sessions': self.rejected_sessions,
+                'searched_ids': self.searched_ids,
+                'active_sessions': len(self.sessions),
+                'entities': len(self.entities),
+                'config': dict(self.config),
+            }
+
+    # ---- podmioty ----
+
+    def _add_entity(self, entity: dict) -> dict:
+        self.entities[entity['Regon']] = entity
+        self.regons_by_nip[entity['Nip']] = entity['Regon']
+        if entity.get('Krs'):
+            self.regons_by_krs[entity['Krs']] = entity['Regon']
+        return entity
+
+    def add_entity(self, **fields) -> dict:
+        """Dodaj podmiot (np. z benchmarku); brakujące pola jak w podmiocie wygenerowanym dla NIP."""
+        entity = {**generated_entity(fields['Nip']), **fields}
+        with self._lock:
+            return self._add_entity(entity)
+
+    def find_by_nip(self, nip: str) -> dict | None:
+        with self._lock:
+            if nip in self.config['not_found_nips']:
+                return None
+            regon = self.regons_by_nip.get(nip)
+            if regon:
+                return self.entities[regon]
+            if self.config['unknown_nips'] == 'generate' and nip_valid(nip):
+                return self._add_entity(generated_entity(nip))
+        return None
+
+    def find_by_regon(self, regon: str) -> dict | None:
+        with self._lock:
+            return self.entities.get(regon[:9]) if len(regon) in (9, 14) else None
+
+    def find_by_krs(self, krs: str) -> dict | None:
+        with self._lock:
+            regon = self.regons_by_krs.get(krs.zfill(10))
+            return self.entities.get(regon) if regon else None
+
+    # ---- sesje ----
+
+    def login(self, api_key: str) -> str:
+        with self._lock:
+            keys = self.config['api_keys']
+            if not api_key or (keys and api_key not in keys):
+                return ''
+            sid = uuid.uuid4().hex[:20]
+            self.sessions[sid] = {'created': time.time(), 'code': '0'}
+            self.logins += 1
+            return sid
+
+    def logout(self, sid: str) -> bool:
+        with self._lock:
+            return self.sessions.pop(sid, None) is not None
+
+    def session(self, sid: str | None) -> dict | None:
+        """Aktywna sesja dla nagłówka sid (wygasła jest usuwana) albo None."""
+        with self._lock:
+            session = self.sessions.get(sid or '')
+            if session is not None and time.time() - session['created'] > self.config['session_ttl']:
+                del self.sessions[sid]
+                session = None
+            if session is None:
+                self.rejected_sessions += 1
+            return session
+
+    def expire_sessions(self) -> int:
+        with self._lock:
+            count = len(self.sessions)
+            self.sessions.clear()
+            return count
+
+    # ---- wstrzykiwanie opóźnień i błędów ----
+
+    def count_connection(self) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def before_call(self, method: str) -> str | None:
+        """Policz wywołanie, odczekaj opóźnienie; zwraca tryb błędu do wstrzyknięcia albo None."""
+        with self._lock:
+            self.requests_count += 1
+            self.calls[method] = self.calls.get(method, 0) + 1
+            config = self.config
+            delay = config['step_latency'].get(method, config['latency'])
+            delay += random.uniform(0, config['jitter']) if config['jitter'] else 0
+            rate = config['step_errors'].get(method, config['error_rate'])
+            error = config['error_mode'] if rate and random.random() < rate else None
+            if error:
+                self.injected_errors[method] = self.injected_errors.get(method, 0) + 1
+        if delay:
+            time.sleep(delay)
+        return error
+
+    # ---- metody BIR ----
+
+    def search(self, params: dict) -> tuple[str, str]:
+        """DaneSzukajPodmioty -> (wewnętrzny XML, KomunikatKod)."""
+        single = {'Nip': self.find_by_nip, 'Regon': self.find_by_regon, 'Krs': self.find_by_krs}
+        multi = {'Nipy': self.find_by_nip, 'Regony9zn': self.find_by_regon, 'Regony14zn': self.find_by_regon,
+                 'Krsy': self.find_by_krs}
+        for name, find in list(single.items()) + list(multi.items()):
+            value = (params.get(name) or '').strip()
+            if not value:
+                continue
+            ids = _ids(value) if name in multi else [value]
+            if len(ids) > MAX_IDS_PER_SEARCH:
+                return _error_dane('2', **{name: value}), '2'
+            with self._lock:
+                self.searched_ids += len(ids)
+            found, seen = [], set()
+            for identifier in ids:
+                entity = find(identifier)
+                if entity is not None and entity['Regon'] not in seen:
+                    seen.add(entity['Regon'])
+                    found.append(entity)
+            if not found:
+                return _error_dane('4', **{name: value}), '4'
+            return '<root>' + ''.join(_search_dane(entity) for entity in found) + '</root>', '0'
+        return _error_dane('4'), '4'
+
+    def full_report(self, regon: str, report: str) -> tuple[str, str]:
+        """DanePobierzPelnyRaport -> (wewnętrzny XML, KomunikatKod). Raporty BIR12 = szablony BIR11."""
+        template_name = 'BIR11' + report[len('BIR12'):] if report.startswith('BIR12') else report
+        template = self.templates.get(template_name)
+        if not template:
+            return _error_dane('5', pRegon=regon, Typ_podmiotu='', Raport=report), '5'
+        entity = self.find_by_regon(regon or '')
+        if entity is None or report_entity_type(template_name) != entity['Typ']:
+            return _error_dane('4', pRegon=regon, Typ_podmiotu='', Raport=report), '4'
+        xml = re.sub(r'<(\w+_regon9)>[^<]*</\1>', lambda m: f'<{m.group(1)}>{entity["Regon"]}</{m.group(1)}>', template)
+        xml = re.sub(r'<(\w+_nip)>[^<]*</\1>', lambda m: f'<{m.group(1)}>{entity["Nip"]}</{m.group(1)}>', xml)
+        xml = re.sub(r'<((?:praw|fiz)_nazwa)>[^<]*</\1>',
+                     lambda m: f'<{m.group(1)}>{escape(entity["Nazwa"])}</{m.group(1)}>', xml)
+        if entity.get('Krs'):
+            xml = re.sub(r'<praw_numerWRejestrzeEwidencji>[^<]*<',
+                         f'<praw_numerWRejestrzeEwidencji>{entity["Krs"]}<', xml)
+        return xml, '0'
+
+    def get_value(self, sid: str | None, parameter: str) -> str:
+        if parameter == 'StatusUslugi':
+            return '1'
+        if parameter == 'KomunikatUslugi':
+            return ''
+        if parameter == 'StanDanych':
+            return time.strftime('%d-%m-%Y 00:00:00')
+        session = self.session(sid)
+        if parameter == 'StatusSesji':
+            return '1' if session else '0'
+        if parameter == 'KomunikatKod':
+            return session['code'] if session else ('7' if sid else '')
+        if parameter == 'KomunikatTresc':
+            if not session:
+                return 'Brak sesji. Sesja wygasła lub przekazano nieprawidłową wartość nagłówka sid.'
+            return ERROR_MESSAGES.get(session['code'], ('',))[0]
+        return ''
+
+    def set_code(self, sid: str, code: str) -> None:
+        with self._lock:
+            session = self.sessions.get(sid)
+            if session is not None:
+                session['code'] = code
+
+
+def _param(envelope: str, name: str) -> str | None:
+    """Wartość elementu <ns:Nazwa>...</ns:Nazwa> z envelope (xsi:nil / brak -> None)."""
+    match = re.search(r'<(?:\w+:)?%s(?:\s[^>]*)?>([^<]*)</(?:\w+:)?%s>' % (name, name), envelope)
+    return html.unescape(match.group(1)) if match else None
+
+
+def soap_response(method: str, result: str | None) -> str:
+    """Envelope odpowiedzi SOAP 1.2; result = tekst wyniku (zakodowany encjami) albo None -> pusty element."""
+    is_get_value = method == 'GetValue'
+    action = (ACTION_BIR if is_get_value else ACTION_PUBL) + method + 'Response'
+    namespace = NS_BIR if is_get_value else NS_PUBL
+    result_xml = f'<{method}Result>{escape(result)}</{method}Result>' if result else f'<{method}Result/>'
+    return (
+        '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope" xmlns:a="http://www.w3.org/2005/08/addressing">'
+        f'<s:Header><a:Action s:mustUnderstand="1">{action}</a:Action></s:Header>'
+        f'<s:Body><{method}Response xmlns="{namespace}">{result_xml}</{method}Response></s:Body>'
+        '</s:Envelope>'
+    )
+
+
+def soap_fault(reason: str) -> str:
+    return (
+        '<s:Envelope xmlns:s="http://www.w3.org/2003/05/soap-envelope">'
+        '<s:Body><s:Fault><s:Code><s:Value>s:Receiver</s:Value></s:Code>'
+        f'<s:Reason><s:Text xml:lang="pl-PL">{escape(reason)}</s:Text></s:Reason>'
+        '</s:Fault></s:Body></s:Envelope>'
+    )
+
+
+def mtom(envelope: str) -> tuple[bytes, str]:
+    """Koperta MTOM jak w UslugaBIRzewnPubl.svc -> (treść, nagłówek Content-Type)."""
+    boundary = f'uuid:{uuid.uuid4()}+id=1'
+    body = (
+        f'--{boundary}\r\n'
+        'Content-ID: <http://tempuri.org/0>\r\n'
+        'Content-Transfer-Encoding: 8bit\r\n'
+        'Content-Type: application/xop+xml;charset=utf-8;type="application/soap+xml"\r\n\r\n'
+        f'{envelope}\r\n'
+        f'--{boundary}--\r\n'
+    )
+    content_type = (f'multipart/related; type="application/xop+xml"; start="<http://tempuri.org/0>"; '
+                    f'boundary="{boundary}"; start-info="application/soap+xml"')
+    return body.encode('utf-8'), content_type
+
+
+class FakeGusHandler(BaseHTTPRequestHandler):
+    """Handler HTTP/1.1 (keep-alive); stan w self.server.state."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.state.count_connection()
+
+    def log_message(self, format, *args):
+        return  # wycisz logi serwera
+
+    def _send(self, status: int, body: bytes, content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: dict, status: int = 200) -> None:
+        self._send(status, json.dumps(data, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def _send_soap(self, method: str, result: str | None) -> None:
+        self._send(200, *mtom(soap_response(method, result)))
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        state: FakeGusState = self.server.state
+        raw = self._read_body()
+        parts = urlsplit(self.path).path.strip('/').split('/')
+        if parts[0] == '_fake':
+            return self._control(state, parts[1] if len(parts) > 1 else '', raw)
+
+        envelope = raw.decode('utf-8', errors='replace')
+        action = re.search(r'<(?:\w+:)?Action[^>]*>([^<]*)</(?:\w+:)?Action>', envelope)
+        method = action.group(1).rstrip('/').rsplit('/', 1)[-1] if action else ''
+        if method not in ('Zaloguj', 'Wyloguj', 'GetValue', 'DaneSzukajPodmioty', 'DanePobierzPelnyRaport'):
+            return self._send(500, soap_fault(f'Nieobsługiwana akcja: {method or "brak"}').encode('utf-8'),
+                              'application/soap+xml; charset=utf-8')
+
+        sid = self.headers.get('sid')
+        error = state.before_call(method)
+        if error == 'timeout':
+            time.sleep(state.config['hang_seconds'])
+        elif error == 'http':
+            return self._send(500, soap_fault('Wstrzyknięty błąd (fake_gus)').encode('utf-8'),
+                              'application/soap+xml; charset=utf-8')
+        elif error == 'session' and sid:
+            state.logout(sid)
+
+        if method == 'Zaloguj':
+            return self._send_soap(method, None if error == 'code' else state.login(_param(envelope, 'pKluczUzytkownika')))
+        if method == 'Wyloguj':
+            logged_out = state.logout(_param(envelope, 'pIdentyfikatorSesji') or sid or '')
+            return self._send_soap(method, 'true' if logged_out else 'false')
+        if method == 'GetValue':
+            return self._send_soap(method, state.get_value(sid, _param(envelope, 'pNazwaParametru') or ''))
+
+        # DaneSzukajPodmioty / DanePobierzPelnyRaport wymagają aktywnej sesji
+        if state.session(sid) is None:
+            return self._send_soap(method, None)
+        if error == 'code':
+            code = state.config['error_code']
+            result = _error_dane(code)
+        elif method == 'DaneSzukajPodmioty':
+            names = ('Nip', 'Nipy', 'Regon', 'Regony9zn', 'Regony14zn', 'Krs', 'Krsy')
+            result, code = state.search({name: _param(envelope, name) for name in names})
+        else:
+            result, code = state.full_report(_param(envelope, 'pRegon'), _param(envelope, 'pNazwaRaportu') or '')
+        state.set_code(sid, code)
+        self._send_soap(method, result)
+
+    def _control(self, state: FakeGusState, action: str, raw: bytes) -> None:
+        if action == 'stats':
+            return self._send_json(state.stats())
+        if action == 'reset':
+            state.reset()
+            return self._send_json({'status': 'ok'})
+        if action == 'reset-counters':
+            state.reset_counters()
+            return self._send_json({'status': 'ok'})
+        if action == 'expire-sessions':
+            return self._send_json({'status': 'ok', 'expired': state.expire_sessions()})
+        if action == 'config' and self.command == 'POST':
+            try:
+                return self._send_json(state.configure(**json.loads(raw or b'{}')))
+            except (TypeError, ValueError) as e:
+                return self._send_json({'error': str(e)}, 400)
+        if action == 'config':
+            return self._send_json(dict(state.config))
+        self._send_json({'error': f'Nieznana akcja {action}'}, 404)
+
+
+class FakeGusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: FakeGusState):
+        self.state = state
+        super().__init__(address, FakeGusHandler)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def service_url(self) -> str:
+        """Adres usługi do GUS_BIR_URL (ścieżka jak w wyszukiwarkaregon.stat.gov.pl)."""
+        return f'{self.base_url}/wsBIR/UslugaBIRzewnPubl.svc'
+
+
+def start_fake_gus(host: str = '127.0.0.1', port: int = 0, **config) -> tuple[FakeGusServer, FakeGusState]:
+    """Uruchom serwer w wątku w tle; zwraca (serwer, stan). Zatrzymanie: server.shutdown()."""
+    state = FakeGusState(**config)
+    server = FakeGusServer((host, port), state)
+    threading.Thread(target=server.serve_forever, name='fake-gus', daemon=True).start()
+    return server, state
+
+
+def _step_values(items: list, cast=float) -> dict:
+    """['Zaloguj=0.5', ...] -> {'Zaloguj': 0.5}"""
+    result = {}
+    for item in items or []:
+        method, _, value = item.partition('=')
+        result[method.strip()] = cast(value)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lokalny serwer udający usługę GUS BIR1.1 (SOAP/MTOM)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--latency', type=float, default=0.0, help='opóźnienie każdej odpowiedzi (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='losowe dodatkowe opóźnienie 0..jitter (s)')
+    parser.add_argument('--step-latency', action='append', metavar='METODA=S',
+                        help='opóźnienie metody, np. Zaloguj=0.5 (można powtarzać)')
+    parser.add_argument('--session-ttl', type=float, default=3600.0, help='czas życia sesji od zalogowania (s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='prawdopodobieństwo błędu (0-1)')
+    parser.add_argument('--step-error', action='append', metavar='METODA=P',
+                        help='prawdopodobieństwo błędu metody, np. DaneSzukajPodmioty=0.1 (można powtarzać)')
+    parser.add_argument('--error-mode', choices=ERROR_MODES, default='http')
+    parser.add_argument('--error-code', default='2', help='ErrorCode w trybie code')
+    parser.add_argument('--hang-seconds', type=float, default=120.0, help='czas zawieszenia w trybie timeout')
+    parser.add_argument('--unknown-nips', choices=UNKNOWN_NIPS_MODES, default='generate',
+                        help='generate = każdy poprawny NIP istnieje, not_found = tylko znane podmioty')
+    parser.add_argument('--not-found-nip', action='append', metavar='NIP', help='NIP zawsze nieznaleziony')
+    parser.add_argument('--api-key', action='append', metavar='KLUCZ',
+                        help='akceptowany klucz Zaloguj (domyślnie każdy niepusty)')
+    args = parser.parse_args()
+
+    state = FakeGusState(
+        latency=args.latency, jitter=args.jitter, step_latency=_step_values(args.step_latency),
+        session_ttl=args.session_ttl, error_rate=args.error_rate, step_errors=_step_values(args.step_error),
+        error_mode=args.error_mode, error_code=args.error_code, hang_seconds=args.hang_seconds,
+        unknown_nips=args.unknown_nips, not_found_nips=args.not_found_nip, api_keys=args.api_key,
+    )
+    server = FakeGusServer((args.host, args.port), state)
+    print(f'fake GUS BIR: {server.service_url} (GUS_BIR_URL={server.service_url}, '
+          f'raporty: {len(state.templates)})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
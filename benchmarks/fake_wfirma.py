@@ -0,0 +1,538 @@
+"""
+Lokalny serwer udający API wFirma (api2.wfirma.pl) - do benchmarków i testów obciążeniowych
+bez sieci i bez dotykania konta produkcyjnego / testowego.
+
+Obsługuje endpointy używane przez aplikację, z odpowiedziami w tym samym kształcie
+co wFirma (klucze numeryczne "0", "1", ... + "parameters" + "status"):
+    contractors/find|add, goods/find|add, series/find, companies/find,
+    invoices/add|get|edit|download|send, payments/add, oauth2/token
+
+Stan (kontrahenci, produkty, faktury, płatności) trzymany jest w pamięci procesu.
+Opóźnienia i błędy można wstrzykiwać z linii poleceń albo w trakcie działania:
+    POST /_fake/config  {"latency": 0.05, "step_latency": {"invoices/add": 0.4},
+                         "error_rate": 0.1, "error_mode": "http", "step_errors": {"invoices/send": 1}}
+    GET  /_fake/stats   liczniki wywołań per krok, połączeń TCP, wstrzykniętych błędów
+    POST /_fake/reset   wyczyść stan i liczniki (/_fake/reset-counters - tylko liczniki)
+
+Tryby błędów (error_mode): status (HTTP 200 + status.code=ERROR, jak wFirma przy błędach
+walidacji), limit (status.code=TOTAL REQUESTS LIMIT EXCEEDED), http (HTTP 500),
+timeout (odpowiedź dopiero po hang_seconds).
+
+Aplikację kieruje się na serwer zmienną WFIRMA_API_URL:
+    python benchmarks/fake_wfirma.py --port 8081 --latency 0.05
+    WFIRMA_API_URL=http://127.0.0.1:8081 python app.py
+
+Użycie z kodu (benchmarki):
+    server, state = start_fake_wfirma(latency=0.02)
+    os.environ['WFIRMA_API_URL'] = server.base_url
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Stawki VAT wg vat_code.id wFirma (jak vat_code_map w app.py)
+VAT_RATES = {222: 0.23, 223: 0.08, 224: 0.05, 225: 0.0, 226: 0.0, 227: 0.0}
+
+DEFAULT_SERIES = (
+    {'id': '3001', 'name': 'Eventy', 'template': 'EV', 'module': 'invoice'},
+    {'id': '3002', 'name': 'Domyślna', 'template': 'FV', 'module': 'invoice'},
+)
+
+ERROR_MODES = ('status', 'limit', 'http', 'timeout')
+
+
+def fake_pdf(size: int) -> bytes:
+    """Minimalny PDF wypełniony do zadanego rozmiaru (aplikacja sprawdza tylko Content-Type)."""
+    head = b'%PDF-1.4\n'
+    tail = b'\n%%EOF'
+    return head + b'0' * max(0, size - len(head) - len(tail)) + tail
+
+
+def _numbered(items: list, name: str) -> dict:
+    """Lista obiektów w kształcie wFirma: {"0": {name: {...}}, "1": ...}."""
+    return {str(i): {name: item} for i, item in enumerate(items)}
+
+
+def _condition_value(body: dict, module: str, field: str):
+    """Wartość warunku {module: {parameters: {conditions: {condition: {field, value}}}}} (lub None)."""
+    conditions = ((body.get(module) or {}).get('parameters') or {}).get('conditions') or {}
+    condition = conditions.get('condition')
+    for item in (condition if isinstance(condition, list) else [condition]):
+        if isinstance(item, dict) and item.get('field') == field:
+            return str(item.get('value'))
+    return None
+
+
+class FakeWfirmaState:
+    """
+    Stan i konfiguracja serwera (bezpieczne wątkowo).
+
+    Args:
+        latency: Bazowe opóźnienie każdej odpowiedzi (s)
+        jitter: Losowe dodatkowe opóźnienie 0..jitter (s)
+        step_latency: Opóźnienie per krok, np. {"invoices/add": 0.4} (zastępuje latency)
+        error_rate: Prawdopodobieństwo wstrzyknięcia błędu w każdym wywołaniu (0-1)
+        step_errors: Prawdopodobieństwo błędu per krok (zastępuje error_rate)
+        error_mode: Rodzaj wstrzykiwanego błędu (ERROR_MODES)
+        hang_seconds: Czas "zawieszenia" w trybie timeout
+        pdf_size: Rozmiar zwracanego PDF (bajty)
+        auto_contractors: True = contractors/find znajduje każdy NIP (stały klient),
+                          False = nieznany NIP -> pusty wynik (ścieżka GUS + contractors/add)
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, step_latency: dict = None,
+                 error_rate: float = 0.0, step_errors: dict = None, error_mode: str = 'status',
+                 hang_seconds: float = 120.0, pdf_size: int = 20000, auto_contractors: bool = False):
+        self._lock = threading.Lock()
+        self.config = {}
+        self.configure(latency=latency, jitter=jitter, step_latency=step_latency or {},
+                       error_rate=error_rate, step_errors=step_errors or {}, error_mode=error_mode,
+                       hang_seconds=hang_seconds, pdf_size=pdf_size, auto_contractors=auto_contractors)
+        self.reset()
+
+    def configure(self, **changes) -> dict:
+        """Zmień konfigurację w trakcie działania (np. z POST /_fake/config)."""
+        unknown = set(changes) - {'latency', 'jitter', 'step_latency', 'error_rate', 'step_errors',
+                                  'error_mode', 'hang_seconds', 'pdf_size', 'auto_contractors'}
+        if unknown:
+            raise ValueError(f'Nieznane opcje: {sorted(unknown)}')
+        if changes.get('error_mode', 'status') not in ERROR_MODES:
+            raise ValueError(f'error_mode: jeden z {ERROR_MODES}')
+        with self._lock:
+            self.config.update(changes)
+            if 'pdf_size' in changes:
+                self.pdf = fake_pdf(int(changes['pdf_size']))
+            return dict(self.config)
+
+    def reset(self) -> None:
+        """Wyczyść dane i liczniki (konfiguracja zostaje)."""
+        with self._lock:
+            self.contractors = {}  # id -> contractor
+            self.contractor_ids_by_nip = {}
+            self.goods = {}
+            self.invoices = {}
+            self.payments = {}
+            self.series = [dict(s) for s in DEFAULT_SERIES]
+            self.series_numbers = {}
+            self.next_id = 10001
+            self.token_number = 0
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        """Wyzeruj liczniki wywołań i połączeń (dane zostają)."""
+        with self._lock:
+            self.connections = 0
+            self.requests_count = 0
+            self.calls = {}
+            self.injected_errors = {}
+
+    def _new_id(self) -> str:
+        self.next_id += 1
+        return str(self.next_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'connections': self.connections,
+                'requests': self.requests_count,
+                'calls': dict(sorted(self.calls.items())),
+                'injected_errors': dict(sorted(self.injected_errors.items())),
+                'contractors': len(self.contractors),
+                'invoices': len(self.invoices),
+                'config': dict(self.config),
+            }
+
+    # ---- wstrzykiwanie opóźnień i błędów ----
+
+    def count_connection(self) -> None:
+        with self._lock:
+            self.connections += 1
+
+    def before_call(self, step: str) -> str | None:
+        """Policz wywołanie, odczekaj opóźnienie; zwraca tryb błędu do wstrzyknięcia albo None."""
+        with self._lock:
+            self.requests_count += 1
+            self.calls[step] = self.calls.get(step, 0) + 1
+            config = self.config
+            delay = config['step_latency'].get(step, config['latency'])
+            delay += random.uniform(0, config['jitter']) if config['jitter'] else 0
+            rate = config['step_errors'].get(step, config['error_rate'])
+            error = config['error_mode'] if rate and random.random() < rate else None
+            if error:
+                self.injected_errors[step] = self.injected_errors.get(step, 0) + 1
+        if delay:
+            time.sleep(delay)
+        return error
+
+    # ---- endpointy wFirma ----
+
+    def contractors_find(self, body: dict) -> dict:
+        nip = _condition_value(body, 'contractors', 'nip')
+        parameters = (body.get('contractors') or {}).get('parameters') or {}
+        with self._lock:
+            if nip is not None:
+                contractor_id = self.contractor_ids_by_nip.get(nip)
+                if contractor_id is None and self.config['auto_contractors']:
+                    contractor_id = self._add_contractor({
+                        'name': f'Firma {nip}', 'nip': nip, 'tax_id_type': 'nip',
+                        'street': 'ul. Testowa 1', 'zip': '00-001', 'city': 'Warszawa', 'country': 'PL',
+                    })['id']
+                found = [dict(self.contractors[contractor_id])] if contractor_id else []
+                limit, page = 20, 1
+            else:
+                limit = int(parameters.get('limit') or 20)
+                page = int(parameters.get('page') or 1)
+                found = [dict(c) for c in list(self.contractors.values())[(page - 1) * limit:page * limit]]
+            total = len(found) if nip is not None else len(self.contractors)
+        result = _numbered(found, 'contractor')
+        result['parameters'] = {'limit': str(limit), 'page': str(page), 'total': str(total)}
+        return {'contractors': result, 'status': {'code': 'OK'}}
+
+    def _add_contractor(self, payload: dict) -> dict:
+        contractor = {key: str(value) for key, value in payload.items() if not isinstance(value, dict)}
+        contractor['id'] = self._new_id()
+        self.contractors[contractor['id']] = contractor
+        if contractor.get('nip'):
+            self.contractor_ids_by_nip[contractor['nip']] = contractor['id']
+        return contractor
+
+    def contractors_add(self, body: dict) -> dict:
+        payload = (body.get('contractors') or {}).get('contractor') or {}
+        if not payload.get('name'):
+            return _error('contractor.name: Pole nie może być puste')
+        with self._lock:
+            contractor = dict(self._add_contractor(payload))
+        return {'contractors': _numbered([contractor], 'contractor'), 'status': {'code': 'OK'}}
+
+    def goods_find(self, body: dict) -> dict:
+        name = _condition_value(body, 'goods', 'name')
+        with self._lock:
+            found = [dict(g) for g in self.goods.values() if name is None or g['name'] == name]
+        result = _numbered(found, 'good')
+        result['parameters'] = {'limit': '20', 'page': '1', 'total': str(len(found))}
+        return {'goods': result, 'status': {'code': 'OK'}}
+
+    def goods_add(self, body: dict) -> dict:
+        payload = (body.get('goods') or {}).get('good') or {}
+        if not payload.get('name'):
+            return _error('good.name: Pole nie może być puste')
+        with self._lock:
+            good = {key: value for key, value in payload.items()}
+            good['id'] = self._new_id()
+            self.goods[good['id']] = good
+        return {'goods': _numbered([dict(good)], 'good'), 'status': {'code': 'OK'}}
+
+    def series_find(self, body: dict) -> dict:
+        with self._lock:
+            series = [dict(s) for s in self.series]
+        result = _numbered(series, 'series')
+        result['parameters'] = {'limit': '100', 'page': '1', 'total': str(len(series))}
+        return {'series': result, 'status': {'code': 'OK'}}
+
+    def companies_find(self, body: dict) -> dict:
+        company = {'id': '1001', 'name': 'Firma Benchmarkowa Sp. z o.o.', 'nip': '5261040828'}
+        return {'companies': _numbered([company], 'company'), 'status': {'code': 'OK'}}
+
+    def _payment_state(self, invoice: dict) -> None:
+        total = float(invoice['total'])
+        paid = float(invoice.get('alreadypaid_initial') or 0) + sum(
+            float(p['value']) for p in self.payments.values() if p['object_id'] == invoice['id'])
+        invoice['alreadypaid'] = f'{paid:.2f}'
+        invoice['remaining'] = f'{max(0.0, total - paid):.2f}'
+        invoice['paymentstate'] = 'paid' if paid >= total - 0.005 else 'unpaid'
+
+    def invoices_add(self, body: dict) -> dict:
+        payload = (body.get('invoices') or {}).get('invoice') or {}
+        contractor_id = str(payload.get('contractor_id') or (payload.get('contractor') or {}).get('id') or '')
+        contents = payload.get('invoicecontents') or {}
+        if not contractor_id:
+            return _error('invoice.contractor: Wybierz kontrahenta')
+        if not contents:
+            return _error('invoice.invoicecontents: Faktura musi mieć co najmniej jedną pozycję')
+        with self._lock:
+            if contractor_id not in self.contractors:
+                return _error(f'invoice.contractor: Nie znaleziono kontrahenta {contractor_id}')
+            series_id = str((payload.get('series') or {}).get('id') or self.series[0]['id'])
+            series = next((s for s in self.series if s['id'] == series_id), self.series[0])
+            number = self.series_numbers.get(series['id'], 0) + 1
+            self.series_numbers[series['id']] = number
+            date = payload.get('date') or time.strftime('%Y-%m-%d')
+
+            netto = brutto = 0.0
+            invoicecontents = {}
+            for key, item in (contents.items() if isinstance(contents, dict) else enumerate(contents)):
+                content = dict(item.get('invoicecontent') or {})
+                count = float(content.get('count') or 0)
+                price = float(content.get('price') or 0)
+                vat = VAT_RATES.get(int((content.get('vat_code') or {}).get('id') or 222), 0.23)
+                netto += count * price
+                brutto += count * price * (1 + vat)
+                content['id'] = self._new_id()
+                invoicecontents[str(key)] = {'invoicecontent': content}
+
+            invoice = {
+                'id': self._new_id(),
+                'type': payload.get('type', 'normal'),
+                'number': str(number),
+                'fullnumber': f"FV/{series['template']}/{number}/{date[:4]}",
+                'date': date,
+                'disposaldate': payload.get('sale_date') or date,
+                'paymentdate': payload.get('payment_date') or date,
+                'paymenttype': payload.get('paymenttype', 'transfer'),
+                'currency': payload.get('currency', 'PLN'),
+                'netto': f'{netto:.2f}',
+                'brutto': f'{brutto:.2f}',
+                'total': f'{brutto:.2f}',
+                'alreadypaid_initial': str(payload.get('alreadypaid_initial') or '0.00'),
+                'contractor': {'id': contractor_id},
+                'series': {'id': series['id']},
+                'payment_cashbox': {'id': '5001'},
+                'invoicecontents': invoicecontents,
+            }
+            if payload.get('parent'):
+                invoice['parent'] = payload['parent']
+            self._payment_state(invoice)
+            self.invoices[invoice['id']] = invoice
+            return {'invoices': _numbered([json.loads(json.dumps(invoice))], 'invoice'), 'status': {'code': 'OK'}}
+
+    def invoices_get(self, invoice_id: str) -> dict:
+        with self._lock:
+            invoice = self.invoices.get(invoice_id)
+            if invoice is None:
+                return _not_found(invoice_id)
+            return {'invoices': _numbered([json.loads(json.dumps(invoice))], 'invoice'), 'status': {'code': 'OK'}}
+
+    def invoices_edit(self, invoice_id: str, body: dict) -> dict:
+        changes = (body.get('invoices') or {}).get('invoice') or {}
+        with self._lock:
+            invoice = self.invoices.get(invoice_id)
+            if invoice is None:
+                return _not_found(invoice_id)
+            for key, value in changes.items():
+                invoice[key] = str(value) if key == 'alreadypaid_initial' else value
+            self._payment_state(invoice)
+            return {'invoices': _numbered([json.loads(json.dumps(invoice))], 'invoice'), 'status': {'code': 'OK'}}
+
+    def payments_add(self, body: dict) -> dict:
+        payload = (body.get('payments') or {}).get('payment') or {}
+        invoice_id = str(payload.get('object_id') or '')
+        with self._lock:
+            invoice = self.invoices.get(invoice_id)
+            if invoice is None:
+                return _error(f'payment.object_id: Nie znaleziono dokumentu {invoice_id}')
+            payment = {
+                'id': self._new_id(),
+                'object_name': payload.get('object_name', 'invoice'),
+                'object_id': invoice_id,
+                'value': f"{float(payload.get('value') or 0):.2f}",
+                'date': payload.get('date') or time.strftime('%Y-%m-%d'),
+                'payment_method': payload.get('payment_method', 'transfer'),
+            }
+            self.payments[payment['id']] = payment
+            self._payment_state(invoice)
+        return {'payments': _numbered([dict(payment)], 'payment'), 'status': {'code': 'OK'}}
+
+    def invoice_exists(self, invoice_id: str) -> bool:
+        with self._lock:
+            return invoice_id in self.invoices
+
+    def oauth_token(self) -> dict:
+        with self._lock:
+            self.token_number += 1
+            number = self.token_number
+        return {
+            'access_token': f'fake-access-{number}',
+            'refresh_token': f'fake-refresh-{number}',
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+        }
+
+
+def _error(message: str, code: str = 'ERROR') -> dict:
+    return {'status': {'code': code, 'message': message}}
+
+
+def _not_found(invoice_id: str) -> dict:
+    return _error(f'Nie znaleziono faktury {invoice_id}', 'NOT FOUND')
+
+
+class FakeWfirmaHandler(BaseHTTPRequestHandler):
+    """Handler HTTP/1.1 (keep-alive); stan w self.server.state."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # bez tego keep-alive traci ~40 ms na delayed ACK
+
+    def setup(self):
+        super().setup()
+        self.server.state.count_connection()
+
+    def log_message(self, format, *args):
+        return  # wycisz logi serwera
+
+    def _send(self, status: int, body: bytes, content_type: str = 'application/json') -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, data: dict, status: int = 200) -> None:
+        self._send(status, json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def _dispatch(self):
+        state: FakeWfirmaState = self.server.state
+        raw = self._read_body()
+        path = urlsplit(self.path).path.strip('/')
+        parts = path.split('/')
+
+        if parts[0] == '_fake':
+            return self._control(state, parts[1] if len(parts) > 1 else '', raw)
+
+        step = '/'.join(parts[:2])
+        object_id = parts[2] if len(parts) > 2 else ''
+        error = state.before_call(step)
+        if error == 'timeout':
+            time.sleep(state.config['hang_seconds'])
+        elif error == 'http':
+            return self._send(500, b'<html><body>500 Internal Server Error</body></html>', 'text/html')
+        elif error == 'status':
+            return self._send_json(_error('Wstrzyknięty błąd (fake_wfirma)'))
+        elif error == 'limit':
+            return self._send_json(_error('Przekroczono limit zapytań', 'TOTAL REQUESTS LIMIT EXCEEDED'))
+
+        if step == 'oauth2/token':
+            form = parse_qs(raw.decode('utf-8'))
+            if not (form.get('refresh_token') or form.get('code')):
+                return self._send_json({'error': 'invalid_request'}, 400)
+            return self._send_json(state.oauth_token())
+
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError:
+            return self._send_json(_error('Niepoprawny JSON'))
+
+        if step == 'invoices/download':
+            if not state.invoice_exists(object_id):
+                return self._send_json(_not_found(object_id))
+            return self._send(200, state.pdf, 'application/pdf')
+        if step == 'invoices/send':
+            if not state.invoice_exists(object_id):
+                return self._send_json(_not_found(object_id))
+            return self._send_json({'status': {'code': 'OK'}})
+
+        routes = {
+            'contractors/find': lambda: state.contractors_find(body),
+            'contractors/add': lambda: state.contractors_add(body),
+            'goods/find': lambda: state.goods_find(body),
+            'goods/add': lambda: state.goods_add(body),
+            'series/find': lambda: state.series_find(body),
+            'companies/find': lambda: state.companies_find(body),
+            'invoices/add': lambda: state.invoices_add(body),
+            'invoices/get': lambda: state.invoices_get(object_id),
+            'invoices/edit': lambda: state.invoices_edit(object_id, body),
+            'payments/add': lambda: state.payments_add(body),
+        }
+        route = routes.get(step)
+        if route is None:
+            return self._send_json(_error(f'Nieznany endpoint {step}', 'NOT FOUND'))
+        self._send_json(route())
+
+    def _control(self, state: FakeWfirmaState, action: str, raw: bytes) -> None:
+        if action == 'stats':
+            return self._send_json(state.stats())
+        if action == 'reset':
+            state.reset()
+            return self._send_json({'status': 'ok'})
+        if action == 'reset-counters':
+            state.reset_counters()
+            return self._send_json({'status': 'ok'})
+        if action == 'config' and self.command == 'POST':
+            try:
+                return self._send_json(state.configure(**json.loads(raw or b'{}')))
+            except (TypeError, ValueError) as e:
+                return self._send_json({'error': str(e)}, 400)
+        if action == 'config':
+            return self._send_json(dict(state.config))
+        self._send_json({'error': f'Nieznana akcja {action}'}, 404)
+
+
+class FakeWfirmaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state: FakeWfirmaState):
+        self.state = state
+        super().__init__(address, FakeWfirmaHandler)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_fake_wfirma(host: str = '127.0.0.1', port: int = 0, **config) -> tuple[FakeWfirmaServer, FakeWfirmaState]:
+    """Uruchom serwer w wątku w tle; zwraca (serwer, stan). Zatrzymanie: server.shutdown()."""
+    state = FakeWfirmaState(**config)
+    server = FakeWfirmaServer((host, port), state)
+    threading.Thread(target=server.serve_forever, name='fake-wfirma', daemon=True).start()
+    return server, state
+
+
+def _step_values(items: list, cast=float) -> dict:
+    """['invoices/add=0.4', ...] -> {'invoices/add': 0.4}"""
+    result = {}
+    for item in items or []:
+        step, _, value = item.partition('=')
+        result[step.strip('/')] = cast(value)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Lokalny serwer udający API wFirma')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='opóźnienie każdej odpowiedzi (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='losowe dodatkowe opóźnienie 0..jitter (s)')
+    parser.add_argument('--step-latency', action='append', metavar='KROK=S',
+                        help='opóźnienie kroku, np. invoices/add=0.4 (można powtarzać)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='prawdopodobieństwo błędu (0-1)')
+    parser.add_argument('--step-error', action='append', metavar='KROK=P',
+                        help='prawdopodobieństwo błędu kroku, np. invoices/send=1 (można powtarzać)')
+    parser.add_argument('--error-mode', choices=ERROR_MODES, default='status')
+    parser.add_argument('--hang-seconds', type=float, default=120.0, help='czas zawieszenia w trybie timeout')
+    parser.add_argument('--pdf-size', type=int, default=20000, help='rozmiar PDF faktury (bajty)')
+    parser.add_argument('--auto-contractors', action='store_true',
+                        help='contractors/find znajduje każdy NIP (bez ścieżki GUS + contractors/add)')
+    args = parser.parse_args()
+
+    state = FakeWfirmaState(
+        latency=args.latency, jitter=args.jitter, step_latency=_step_values(args.step_latency),
+        error_rate=args.error_rate, step_errors=_step_values(args.step_error), error_mode=args.error_mode,
+        hang_seconds=args.hang_seconds, pdf_size=args.pdf_size, auto_contractors=args.auto_contractors,
+    )
+    server = FakeWfirmaServer((args.host, args.port), state)
+    print(f'fake wFirma: {server.base_url} (WFIRMA_API_URL={server.base_url})')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,513 @@
+"""
+Obsługa usługi GUS BIR1.1 (SOAP): budowanie envelope, dekodowanie odpowiedzi,
+pula zalogowanych sesji (SID) i trwały cache wyników wyszukiwania po NIP.
+
+Sesja BIR żyje 60 minut i może być używana wielokrotnie - zamiast wywoływać
+Zaloguj przed każdym DaneSzukajPodmioty trzymamy jeden SID per klucz API
+i host (test/produkcja) i logujemy się ponownie dopiero gdy sesja wygaśnie.
+"""
+
+import hashlib
+import json
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from xml.parsers import expat
+
+import requests
+
+from wfirma_log import get_logger
+from wfirma_sqlite import connect, open_db
+
+log = get_logger('GUS')
+
+
+BIR_HOST_PROD = 'wyszukiwarkaregon.stat.gov.pl'
+BIR_HOST_TEST = 'wyszukiwarkaregontest.stat.gov.pl'
+BIR_TEST_API_KEY = 'abcde12345abcde12345'  # publiczny klucz środowiska testowego
+
+
+def escape_xml(unsafe: str) -> str:
+    """
+    Bezpieczne wstawianie wartości do SOAP XML (ochrona przed SOAP injection).
+    Port funkcji escapeXml z backendu Googie_GUS (Node).
+    """
+    if not isinstance(unsafe, str):
+        return ""
+    return (
+        unsafe.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace(">", "&gt;")
+        .replace('"', "&quot;")
+        .replace("'", "&apos;")
+    )
+
+
+def bir_url(bir_host: str) -> str:
+    return f'https://{bir_host}/wsBIR/UslugaBIRzewnPubl.svc'
+
+
+def _envelope(bir_host: str, action: str, body: str, extra_ns: str = '') -> str:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<soap:Envelope xmlns:soap="http://www.w3.org/2003/05/soap-envelope" '
+        f'xmlns:ns="http://CIS/BIR/PUBL/2014/07"{extra_ns}>'
+        '<soap:Header xmlns:wsa="http://www.w3.org/2005/08/addressing">'
+        f'<wsa:To>{bir_url(bir_host)}</wsa:To>'
+        f'<wsa:Action>{action}</wsa:Action>'
+        '</soap:Header>'
+        f'<soap:Body>{body}</soap:Body>'
+        '</soap:Envelope>'
+    )
+
+
+def build_login_envelope(bir_host: str, api_key: str) -> str:
+    """Envelope metody Zaloguj."""
+    return _envelope(
+        bir_host,
+        'http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/Zaloguj',
+        '<ns:Zaloguj>'
+        f'<ns:pKluczUzytkownika>{escape_xml(api_key)}</ns:pKluczUzytkownika>'
+        '</ns:Zaloguj>',
+    )
+
+
+def build_get_value_envelope(bir_host: str, parameter: str) -> str:
+    """Envelope metody GetValue (np. StatusSesji, KomunikatKod)."""
+    return _envelope(
+        bir_host,
+        'http://CIS/BIR/2014/07/IUslugaBIR/GetValue',
+        '<GetValue xmlns="http://CIS/BIR/2014/07">'
+        f'<pNazwaParametru>{escape_xml(parameter)}</pNazwaParametru>'
+        '</GetValue>',
+    )
+
+
+BIR_MAX_NIPS_PER_SEARCH = 20  # limit identyfikatorów w parametrze Nipy
+
+
+def _search_envelope(bir_host: str, nip_xml: str, nipy_xml: str) -> str:
+    return _envelope(
+        bir_host,
+        'http://CIS/BIR/PUBL/2014/07/IUslugaBIRzewnPubl/DaneSzukajPodmioty',
+        '<ns:DaneSzukajPodmioty>'
+        '<ns:pParametryWyszukiwania>'
+        '<q1:Krs xsi:nil="true"/>'
+        '<q1:Krsy xsi:nil="true"/>'
+        f'{nip_xml}'
+        f'{nipy_xml}'
+        '<q1:Regon xsi:nil="true"/>'
+        '<q1:Regony14zn xsi:nil="true"/>'
+        '<q1:Regony9zn xsi:nil="true"/>'
+        '</ns:pParametryWyszukiwania>'
+        '</ns:DaneSzukajPodmioty>',
+        extra_ns=(
+            ' xmlns:q1="http://CIS/BIR/PUBL/2014/07/DataContract"'
+            ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"'
+        ),
+    )
+
+
+def build_search_envelope(bir_host: str, nip: str) -> str:
+    """Envelope metody DaneSzukajPodmioty dla jednego NIP."""
+    return _search_envelope(bir_host, f'<q1:Nip>{escape_xml(nip)}</q1:Nip>', '<q1:Nipy xsi:nil="true"/>')
+
+
+def build_search_nips_envelope(bir_host: str, nips: list) -> str:
+    """Envelope DaneSzukajPodmioty dla wielu NIP naraz (parametr Nipy, maks. 20)."""
+    if not nips or len(nips) > BIR_MAX_NIPS_PER_SEARCH:
+        raise ValueError(f'Nipy: od 1 do {BIR_MAX_NIPS_PER_SEARCH} identyfikatorów, podano {len(nips)}')
+    if len(nips) == 1:
+        return build_search_envelope(bir_host, nips[0])
+    return _search_envelope(
+        bir_host,
+        '<q1:Nip xsi:nil="true"/>',
+        f'<q1:Nipy>{escape_xml(",".join(nips))}</q1:Nipy>',
+    )
+
+
+def soap_action(envelope: str) -> str:
+    """Nazwa metody z nagłówka wsa:Action envelope (np. Zaloguj, DaneSzukajPodmioty) - do metryk."""
+    match = re.search(r'<wsa:Action>[^<]*/([^/<]+)</wsa:Action>', envelope or '')
+    return match.group(1) if match else 'unknown'
+
+
+_EMPTY_SEARCH_RESULT = r'<DaneSzukajPodmiotyResult\s*/>|<DaneSzukajPodmiotyResult>\s*</DaneSzukajPodmiotyResult>'
+_EMPTY_SEARCH_RESULT_STR = re.compile(_EMPTY_SEARCH_RESULT)
+_EMPTY_SEARCH_RESULT_BYTES = re.compile(_EMPTY_SEARCH_RESULT.encode('ascii'))
+
+
+def is_empty_search_result(soap_part) -> bool:
+    """Pusta odpowiedź DaneSzukajPodmioty - wg dokumentacji BIR trzeba sprawdzić GetValue (str lub surowe bajty)."""
+    if isinstance(soap_part, (bytes, bytearray)):
+        return bool(_EMPTY_SEARCH_RESULT_BYTES.search(soap_part))
+    return bool(_EMPTY_SEARCH_RESULT_STR.search(soap_part or ''))
+
+
+BIR_PARSE_CHUNK = 64 * 1024  # porcja odpowiedzi podawana parserowi
+
+_MTOM_SOAP_HEADER = re.compile(rb'Content-Type: application/xop\+xml[^\r\n]*\r?\n\r?\n')
+
+
+class BirResponseError(ValueError):
+    """Odpowiedź BIR bez wyniku (brak / pusty element *Result) albo z niepoprawnym XML."""
+
+
+def _soap_span(content: bytes) -> Tuple[int, int]:
+    """Zakres envelope SOAP w odpowiedzi (MTOM: część application/xop+xml) - bez kopiowania treści."""
+    match = _MTOM_SOAP_HEADER.search(content)
+    if not match:
+        return 0, len(content)
+    start = match.end()
+    end = content.find(b'\n--uuid:', start)
+    if end < 0:
+        return start, len(content)
+    return start, end - 1 if content[end - 1:end] == b'\r' else end
+
+
+class _BirRecordReader:
+    """
+    Dwa parsery w jednym przebiegu: expat czyta envelope SOAP i oddaje tekst elementu
+    *Result już odkodowany z encji, który od razu trafia do parsera przyrostowego
+    wewnętrznego XML. Gotowe rekordy <dane> są zbierane, a drzewo czyszczone na bieżąco.
+    """
+
+    def __init__(self, result_tag: str, record_tag: str):
+        self.result_tag = result_tag
+        self.record_tag = record_tag
+        self.inside = False
+        self.found = False
+        self.has_data = False
+        self.records = []
+        self.root = None
+        self.inner = ET.XMLPullParser(events=('start', 'end'))
+        self.outer = expat.ParserCreate()
+        self.outer.buffer_text = True
+        self.outer.StartElementHandler = self._start
+        self.outer.EndElementHandler = self._end
+        self.outer.CharacterDataHandler = self._data
+
+    def _start(self, name: str, attrs: dict) -> None:
+        if name.rpartition(':')[2] == self.result_tag:
+            self.inside = self.found = True
+
+    def _end(self, name: str) -> None:
+        if self.inside and name.rpartition(':')[2] == self.result_tag:
+            self.inside = False
+
+    def _data(self, text: str) -> None:
+        if not self.inside:
+            return
+        if not self.has_data:
+            text = text.lstrip('\ufeff \t\r\n')
+            if not text:
+                return
+            self.has_data = True
+        self.inner.feed(text)
+        self._drain()
+
+    def _drain(self) -> None:
+        for event, elem in self.inner.read_events():
+            if event == 'start':
+                if self.root is None:
+                    self.root = elem
+            elif elem.tag == self.record_tag:
+                self.records.append({child.tag: child.text for child in elem})
+                self.root.clear()
+
+    def close(self) -> None:
+        self.outer.Parse(b'', True)
+        if self.has_data:
+            self.inner.close()
+            self._drain()
+
+    def take(self) -> list:
+        records, self.records = self.records, []
+        return records
+
+
+def iter_bir_records(content, result_tag: str = 'DaneSzukajPodmiotyResult', record_tag: str = 'dane',
+                     chunk_size: int = BIR_PARSE_CHUNK) -> Iterator[Dict[str, Optional[str]]]:
+    """
+    Rekordy <dane> z odpowiedzi BIR (surowe bajty odpowiedzi, także MTOM) jako słowniki pole -> tekst
+    (pusty element -> None). Jeden przebieg bez kopii całej odpowiedzi - pamięć nie rośnie z liczbą
+    rekordów (paczki Nipy, raporty zbiorcze). Rekordy z ErrorCode są zwracane jak pozostałe.
+
+    Raises:
+        BirResponseError: brak / pusty element result_tag albo niepoprawny XML
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    reader = _BirRecordReader(result_tag, record_tag)
+    start, end = _soap_span(content or b'')
+    view = memoryview(content or b'')
+    try:
+        for offset in range(start, end, chunk_size):
+            reader.outer.Parse(view[offset:min(offset + chunk_size, end)], False)
+            yield from reader.take()
+        reader.close()
+        yield from reader.take()
+    except (expat.ExpatError, ET.ParseError) as e:
+        if not reader.found:
+            raise BirResponseError(f'Brak danych w odpowiedzi GUS ({result_tag} pusty)') from e
+        raise BirResponseError(f'Nie udało się sparsować danych GUS: {e}') from e
+    if not reader.has_data:
+        raise BirResponseError(f'Brak danych w odpowiedzi GUS ({result_tag} pusty)')
+
+
+class GusLoginError(Exception):
+    """Nie udało się zalogować do BIR (brak SID albo błąd komunikacji)."""
+
+    def __init__(self, message: str, debug: str = '', cause: Optional[Exception] = None):
+        super().__init__(message if cause is None else f'{message}: {cause}')
+        self.message = message
+        self.debug = debug
+        self.cause = cause
+
+
+class GusSessionManager:
+    """
+    Pula sesji BIR: jeden SID per (klucz API, host). Bezpieczna wątkowo.
+
+    - SID używany w ciągu ostatnich check_interval sekund: bez sprawdzania,
+    - dłużej nieużywany: tanie GetValue(StatusSesji) przed użyciem,
+    - starszy niż max_age: od razu nowe Zaloguj (BIR kończy sesję po 60 min),
+    - pusta odpowiedź + GetValue(KomunikatKod) 7/pusty albo błąd HTTP:
+      ponowne logowanie i jedna powtórka wyszukiwania.
+
+    Args:
+        post: Funkcja (bir_host, envelope, sid, timeout) -> requests.Response
+        check_interval: Po ilu sekundach bezczynności sprawdzamy StatusSesji
+        max_age: Maksymalny wiek SID w sekundach
+        timeout: Timeout pojedynczego wywołania SOAP
+    """
+
+    def __init__(self, post: Callable[..., requests.Response], check_interval: float = 300,
+                 max_age: float = 55 * 60, timeout: float = 10):
+        self.post = post
+        self.check_interval = check_interval
+        self.max_age = max_age
+        self.timeout = timeout
+        self._sessions: Dict[Tuple[str, str], dict] = {}  # klucz -> {'sid', 'created_at', 'used_at'}
+        self._key_locks: Dict[Tuple[str, str], threading.Lock] = {}
+        self._lock = threading.Lock()
+        self.logins = 0
+        self.reuses = 0
+        self.status_checks = 0
+        self.relogins = 0
+
+    def _key_lock(self, key: Tuple[str, str]) -> threading.Lock:
+        with self._lock:
+            lock = self._key_locks.get(key)
+            if lock is None:
+                lock = self._key_locks[key] = threading.Lock()
+            return lock
+
+    def _login(self, api_key: str, bir_host: str) -> str:
+        try:
+            resp = self.post(bir_host, build_login_envelope(bir_host, api_key), sid=None, timeout=self.timeout)
+        except Exception as e:
+            raise GusLoginError('Błąd komunikacji z GUS podczas logowania', cause=e)
+        sid_match = re.search(r'<ZalogujResult>([^<]*)</ZalogujResult>', resp.text or '')
+        sid = sid_match.group(1).strip() if sid_match else ''
+        with self._lock:
+            self.logins += 1
+        log.info("Zaloguj host=%s status=%s SID=%s", bir_host, resp.status_code, '[JEST]' if sid else '[BRAK]')
+        if not sid:
+            raise GusLoginError('Logowanie do GUS nie powiodło się (brak SID)', debug=(resp.text or '')[:300])
+        return sid
+
+    def get_value(self, bir_host: str, sid: str, parameter: str) -> Optional[str]:
+        """GetValue dla sesji; None gdy wywołanie się nie powiodło."""
+        try:
+            resp = self.post(bir_host, build_get_value_envelope(bir_host, parameter), sid=sid, timeout=self.timeout)
+        except Exception as e:
+            log.warning("GetValue(%s) błąd: %s", parameter, e)
+            return None
+        if resp.status_code != 200:
+            return None
+        match = re.search(r'<GetValueResult>([^<]*)</GetValueResult>', resp.text or '')
+        return match.group(1).strip() if match else ''
+
+    def _session_alive(self, bir_host: str, session: dict, now: float) -> bool:
+        if now - session['created_at'] > self.max_age:
+            return False
+        if now - session['used_at'] <= self.check_interval:
+            return True
+        with self._lock:
+            self.status_checks += 1
+        return self.get_value(bir_host, session['sid'], 'StatusSesji') == '1'
+
+    def get_sid(self, api_key: str, bir_host: str, force_new: bool = False) -> str:
+        """Zwróć działający SID (loguje się tylko gdy trzeba; jeden login naraz per klucz)."""
+        key = (api_key, bir_host)
+        with self._key_lock(key):
+            now = time.time()
+            session = self._sessions.get(key)
+            if session is not None and not force_new and self._session_alive(bir_host, session, now):
+                session['used_at'] = now
+                with self._lock:
+                    self.reuses += 1
+                return session['sid']
+            if session is not None:
+                with self._lock:
+                    self.relogins += 1
+            sid = self._login(api_key, bir_host)
+            self._sessions[key] = {'sid': sid, 'created_at': now, 'used_at': now}
+            return sid
+
+    def invalidate(self, api_key: str, bir_host: str, sid: Optional[str] = None) -> None:
+        """Zapomnij SID (tylko jeśli nadal jest aktualny - inny wątek mógł już odnowić)."""
+        key = (api_key, bir_host)
+        with self._key_lock(key):
+            session = self._sessions.get(key)
+            if session is not None and (sid is None or session['sid'] == sid):
+                del self._sessions[key]
+
+    def _session_lost(self, bir_host: str, sid: str, resp: requests.Response) -> bool:
+        if resp.status_code != 200:
+            return True
+        if not is_empty_search_result(resp.content):
+            return False
+        # Pusta odpowiedź: KomunikatKod 7 / pusty = brak sesji, 4 = nie znaleziono
+        return self.get_value(bir_host, sid, 'KomunikatKod') in ('', '7', None)
+
+    def call(self, api_key: str, bir_host: str, envelope: str) -> requests.Response:
+        """
+        Wyślij envelope z SID z puli. Przy utracie sesji loguje się ponownie
+        i powtarza wywołanie raz. GusLoginError gdy logowanie się nie powiedzie.
+        """
+        sid = self.get_sid(api_key, bir_host)
+        resp = self.post(bir_host, envelope, sid=sid, timeout=self.timeout)
+        if not self._session_lost(bir_host, sid, resp):
+            return resp
+        log.info("Sesja BIR nieaktualna (status=%s) - ponowne logowanie", resp.status_code)
+        self.invalidate(api_key, bir_host, sid)
+        with self._lock:
+            self.relogins += 1
+        sid = self.get_sid(api_key, bir_host)
+        return self.post(bir_host, envelope, sid=sid, timeout=self.timeout)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            return {
+                'name': 'gus_sessions',
+                'check_interval_seconds': self.check_interval,
+                'max_age_seconds': self.max_age,
+                'sessions': [
+                    {
+                        'host': host,
+                        # Klucz API tylko jako skrót - nie ujawniamy go w diagnostyce
+                        'key': hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:8],
+                        'age_seconds': int(now - session['created_at']),
+                        'idle_seconds': int(now - session['used_at']),
+                    }
+                    for (api_key, host), session in self._sessions.items()
+                ],
+                'logins': self.logins,
+                'reuses': self.reuses,
+                'status_checks': self.status_checks,
+                'relogins': self.relogins,
+            }
+
+
+class GusResultCache:
+    """
+    Cache wyników wyszukiwania GUS (host, NIP) -> lista rekordów w SQLite.
+
+    Osobne TTL dla znalezionych podmiotów i dla odpowiedzi "nie znaleziono"
+    (pusta lista) - nowa firma może pojawić się w REGON wcześniej niż zmienią
+    się dane istniejącej. Błędy komunikacji nie są cache'owane.
+    Plik bazy przetrwa restart i jest współdzielony przez workery (tryb WAL).
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+        ttl: Czas życia znalezionego wyniku (sekundy)
+        negative_ttl: Czas życia wyniku "nie znaleziono" (sekundy)
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 60 * 60, negative_ttl: float = 6 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.writes = 0
+        open_db(path, (
+            'CREATE TABLE IF NOT EXISTS gus_results ('
+            ' host TEXT NOT NULL,'
+            ' nip TEXT NOT NULL,'
+            ' records TEXT NOT NULL,'
+            ' found INTEGER NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' PRIMARY KEY (host, nip))',
+        ))
+
+    def get(self, bir_host: str, nip: str) -> Optional[list]:
+        """Lista rekordów ([] = "nie znaleziono") albo None gdy brak ważnego wpisu."""
+        with connect(self.path) as conn:
+            row = conn.execute(
+                'SELECT records, found FROM gus_results WHERE host = ? AND nip = ? AND expires_at > ?',
+                (bir_host, nip, time.time()),
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            if row[1]:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+        return json.loads(row[0])
+
+    def put(self, bir_host: str, nip: str, records: list) -> None:
+        """Zapisz wynik (pusta lista = negatywny wynik z krótszym TTL)."""
+        now = time.time()
+        found = bool(records)
+        expires_at = now + (self.ttl if found else self.negative_ttl)
+        with connect(self.path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO gus_results (host, nip, records, found, expires_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (bir_host, nip, json.dumps(records, ensure_ascii=False), int(found), expires_at),
+            )
+            conn.execute('DELETE FROM gus_results WHERE expires_at <= ?', (now,))
+        with self._lock:
+            self.writes += 1
+
+    def invalidate(self, nip: Optional[str] = None) -> int:
+        """Usuń wpisy dla NIP (we wszystkich środowiskach) albo wszystkie."""
+        with connect(self.path) as conn:
+            if nip:
+                cur = conn.execute('DELETE FROM gus_results WHERE nip = ?', (nip,))
+            else:
+                cur = conn.execute('DELETE FROM gus_results')
+            return cur.rowcount
+
+    def stats(self) -> dict:
+        with connect(self.path) as conn:
+            found, negative = conn.execute(
+                'SELECT COALESCE(SUM(found), 0), COALESCE(SUM(1 - found), 0)'
+                ' FROM gus_results WHERE expires_at > ?',
+                (time.time(),),
+            ).fetchone()
+        with self._lock:
+            total = self.hits + self.negative_hits + self.misses
+            return {
+                'name': 'gus_results',
+                'path': self.path,
+                'ttl_seconds': self.ttl,
+                'negative_ttl_seconds': self.negative_ttl,
+                'entries': found,
+                'negative_entries': negative,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'hit_ratio': round((self.hits + self.negative_hits) / total, 3) if total else None,
+                'writes': self.writes,
+            }
@@ -0,0 +1,212 @@
+"""
+Pamięć podręczna (in-process) dla danych wFirma, które praktycznie się nie zmieniają.
+
+TTLCache - prosty, bezpieczny wątkowo słownik z czasem życia wpisów
+i licznikami trafień (hit/miss) do diagnostyki.
+SeriesIndex - indeks serii faktur (nazwa -> id) odświeżany w tle.
+"""
+
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from wfirma_log import get_logger
+
+log = get_logger('CACHE')
+
+
+class TTLCache:
+    """
+    Słownik z TTL i licznikami hit/miss.
+
+    Args:
+        ttl: Czas życia wpisu w sekundach
+        name: Nazwa cache (do logów i statystyk)
+    """
+
+    def __init__(self, ttl: float, name: str = 'cache'):
+        self.ttl = ttl
+        self.name = name
+        self._data: Dict[Hashable, Tuple[Any, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Zwróć wartość lub None (brak / wygasła). Aktualizuje liczniki."""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] > now:
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        """Zapisz wartość (opcjonalnie z innym TTL niż domyślny)."""
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """
+        Usuń wpisy pasujące do predykatu (albo wszystkie, gdy predicate=None).
+        Zwraca liczbę usuniętych wpisów.
+        """
+        with self._lock:
+            keys = [k for k in self._data if predicate is None or predicate(k)]
+            for k in keys:
+                del self._data[k]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def stats(self) -> dict:
+        """Liczniki i rozmiar cache (do endpointu diagnostycznego)."""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': self.name,
+                'ttl_seconds': self.ttl,
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else None,
+                'invalidations': self.invalidations,
+            }
+
+
+class SeriesIndex:
+    """
+    Indeks serii faktur per firma: nazwa (bez rozróżniania wielkości liter) -> seria.
+
+    - pierwsze użycie: synchroniczne załadowanie listy serii,
+    - po upływie TTL: zwracamy dotychczasowe dane i odświeżamy w tle,
+    - brak nazwy w indeksie: jedno odświeżenie na żądanie (nie częściej niż
+      co miss_refresh_interval sekund, żeby błędna nazwa nie spamowała API).
+
+    Args:
+        loader: Funkcja (token, company_id, company) -> lista serii
+                [{'id', 'name', 'template', 'module'}, ...]
+        ttl: Po ilu sekundach indeks jest odświeżany w tle
+        miss_refresh_interval: Minimalny odstęp odświeżeń wywołanych brakiem nazwy
+    """
+
+    def __init__(self, loader: Callable[[str, Optional[str], Optional[str]], list],
+                 ttl: float = 3600, miss_refresh_interval: float = 60):
+        self.loader = loader
+        self.ttl = ttl
+        self.miss_refresh_interval = miss_refresh_interval
+        self._entries: Dict[str, dict] = {}  # company -> {'by_name', 'series', 'loaded_at'}
+        self._lock = threading.Lock()
+        self._refreshing: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.background_refreshes = 0
+
+    def store(self, company: str, series_list: list) -> None:
+        """Zapisz świeżą listę serii dla firmy (np. z endpointu /api/series/list)."""
+        by_name = {}
+        for series in series_list:
+            name = (series.get('name') or '').lower().strip()
+            if name and name not in by_name:
+                by_name[name] = series
+        with self._lock:
+            self._entries[company] = {
+                'by_name': by_name,
+                'series': list(series_list),
+                'loaded_at': time.time(),
+            }
+
+    def _load(self, company: str, token: str, company_id: Optional[str]) -> bool:
+        series_list = self.loader(token, company_id, company)
+        with self._lock:
+            self.loads += 1
+        if not series_list:
+            # Błąd / pusta odpowiedź - nie nadpisujemy dobrego indeksu
+            return False
+        self.store(company, series_list)
+        return True
+
+    def _refresh_in_background(self, company: str, token: str, company_id: Optional[str]) -> None:
+        with self._lock:
+            if company in self._refreshing:
+                return
+            self._refreshing.add(company)
+            self.background_refreshes += 1
+
+        def run():
+            try:
+                self._load(company, token, company_id)
+            except Exception as e:
+                log.warning("Odświeżanie indeksu serii (%s) nie powiodło się: %s", company, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(company)
+
+        threading.Thread(target=run, name=f'series-refresh-{company}', daemon=True).start()
+
+    def lookup(self, company: str, series_name: str, token: str, company_id: Optional[str] = None) -> Optional[dict]:
+        """Znajdź serię po nazwie; ładuje/odświeża indeks tylko gdy trzeba."""
+        name = (series_name or '').lower().strip()
+        with self._lock:
+            entry = self._entries.get(company)
+
+        if entry is None:
+            self._load(company, token, company_id)
+            with self._lock:
+                entry = self._entries.get(company)
+                if entry is None:
+                    self.misses += 1
+                    return None
+        elif time.time() - entry['loaded_at'] > self.ttl:
+            self._refresh_in_background(company, token, company_id)
+
+        series = entry['by_name'].get(name)
+        if series is None and time.time() - entry['loaded_at'] > self.miss_refresh_interval:
+            # Może seria została właśnie dodana w wFirma - jedno odświeżenie na żądanie
+            if self._load(company, token, company_id):
+                with self._lock:
+                    entry = self._entries[company]
+                series = entry['by_name'].get(name)
+
+        with self._lock:
+            if series is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return series
+
+    def all(self, company: str) -> list:
+        """Wszystkie serie z indeksu (bez wywołania API)."""
+        with self._lock:
+            entry = self._entries.get(company)
+            return list(entry['series']) if entry else []
+
+    def invalidate(self, company: Optional[str] = None) -> int:
+        """Usuń indeks danej firmy (albo wszystkich)."""
+        with self._lock:
+            keys = [company] if company else list(self._entries.keys())
+            return sum(1 for k in keys if self._entries.pop(k, None) is not None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'name': 'series_index',
+                'ttl_seconds': self.ttl,
+                'companies': {
+                    company: {
+                        'series_count': len(entry['series']),
+                        'age_seconds': int(time.time() - entry['loaded_at']),
+                    }
+                    for company, entry in self._entries.items()
+                },
+                'hits': self.hits,
+                'misses': self.misses,
+                'loads': self.loads,
+                'background_refreshes': self.background_refreshes,
+            }
@@ -0,0 +1,122 @@
+"""
+Trwały (SQLite) indeks kontrahentów wFirma: NIP -> kontrahent, osobno dla każdej firmy.
+
+Wypełniany wynikami contractors/find i contractors/add oraz hurtowo (warm-up),
+dzięki czemu faktura dla stałego klienta nie wymaga wywołania contractors/find.
+Plik bazy jest współdzielony przez wszystkie workery gunicorna (tryb WAL).
+"""
+
+import json
+import re
+import threading
+import time
+from typing import Dict, Iterable, Optional
+
+from wfirma_sqlite import connect, open_db
+
+
+class ContractorIndex:
+    """
+    Indeks NIP -> kontrahent w SQLite.
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+        max_age: Wiek wpisu (sekundy), po którym traktujemy go jako nieaktualny
+                 i kontrahent jest ponownie wyszukiwany w wFirma
+    """
+
+    def __init__(self, path: str, max_age: float = 7 * 24 * 60 * 60):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.writes = 0
+        open_db(path, (
+            'CREATE TABLE IF NOT EXISTS contractors ('
+            ' company TEXT NOT NULL,'
+            ' nip TEXT NOT NULL,'
+            ' contractor_id TEXT NOT NULL,'
+            ' name TEXT,'
+            ' data TEXT NOT NULL,'
+            ' updated_at REAL NOT NULL,'
+            ' PRIMARY KEY (company, nip))',
+        ))
+
+    @staticmethod
+    def normalize_nip(nip) -> str:
+        return re.sub(r'[^0-9]', '', str(nip or ''))
+
+    def get(self, company: str, nip: str) -> Optional[dict]:
+        """Zwróć kontrahenta z indeksu albo None (brak lub wpis nieaktualny)."""
+        clean_nip = self.normalize_nip(nip)
+        with connect(self.path) as conn:
+            row = conn.execute(
+                'SELECT data, updated_at FROM contractors WHERE company = ? AND nip = ?',
+                (company, clean_nip),
+            ).fetchone()
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            if time.time() - row[1] > self.max_age:
+                self.stale += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, company: str, contractor: dict, nip: str = None) -> bool:
+        """Zapisz kontrahenta (wymaga id i NIP - z obiektu albo parametru nip)."""
+        return self.put_many(company, [contractor], nip=nip) == 1
+
+    def put_many(self, company: str, contractors: Iterable[dict], nip: str = None) -> int:
+        """Zapisz wielu kontrahentów w jednej transakcji. Zwraca liczbę zapisanych."""
+        now = time.time()
+        rows = []
+        for contractor in contractors:
+            if not isinstance(contractor, dict) or not contractor.get('id'):
+                continue
+            clean_nip = self.normalize_nip(contractor.get('nip') or nip)
+            if len(clean_nip) != 10:
+                continue
+            rows.append((
+                company, clean_nip, str(contractor.get('id')), contractor.get('name'),
+                json.dumps(contractor, ensure_ascii=False), now,
+            ))
+        if not rows:
+            return 0
+        with connect(self.path) as conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO contractors (company, nip, contractor_id, name, data, updated_at)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+        with self._lock:
+            self.writes += len(rows)
+        return len(rows)
+
+    def delete(self, company: str, nip: str) -> None:
+        """Usuń wpis (np. gdy wFirma odrzuciła kontrahenta z indeksu)."""
+        with connect(self.path) as conn:
+            conn.execute(
+                'DELETE FROM contractors WHERE company = ? AND nip = ?',
+                (company, self.normalize_nip(nip)),
+            )
+
+    def stats(self) -> dict:
+        with connect(self.path) as conn:
+            counts: Dict[str, int] = dict(conn.execute(
+                'SELECT company, COUNT(*) FROM contractors GROUP BY company'
+            ).fetchall())
+        with self._lock:
+            return {
+                'name': 'contractor_index',
+                'path': self.path,
+                'max_age_seconds': self.max_age,
+                'entries': counts,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'writes': self.writes,
+            }
@@ -0,0 +1,114 @@
+"""
+Współdzielone sesje HTTP (keep-alive + pula połączeń) dla wywołań wFirma.
+
+Każdy klucz (np. firma md / test / md_test) dostaje własną requests.Session
+z adapterem trzymającym pulę połączeń - kolejne wywołania w jednym workflow
+używają tego samego połączenia TCP+TLS zamiast robić nowy handshake.
+"""
+
+import threading
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from wfirma_log import get_logger
+
+log = get_logger('HTTP')
+
+
+Timeout = Union[float, Tuple[float, float]]
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter z domyślnym timeoutem.
+    requests nie ma timeoutu na poziomie sesji - ustawiamy go tutaj,
+    chyba że wywołanie poda własny timeout.
+    """
+
+    def __init__(self, *args, timeout: Optional[Timeout] = None, **kwargs):
+        self.timeout = timeout
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
+
+class SessionRegistry:
+    """
+    Rejestr sesji HTTP per klucz (firma). Bezpieczny wątkowo.
+
+    Args:
+        pool_connections: Liczba pul (hostów) trzymanych przez adapter
+        pool_maxsize: Maksymalna liczba połączeń keep-alive do jednego hosta
+        timeout: Domyślny timeout (connect, read) dla każdego wywołania
+        enabled: False = każde wywołanie przez goły requests.request (bez puli)
+    """
+
+    def __init__(self, pool_connections: int = 4, pool_maxsize: int = 10,
+                 timeout: Optional[Timeout] = (5, 60), enabled: bool = True):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.enabled = enabled
+        self._sessions: Dict[str, requests.Session] = {}
+        self._lock = threading.Lock()
+        self._request_counts: Dict[str, int] = {}
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = TimeoutHTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize,
+            timeout=self.timeout,
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def get(self, key: str) -> requests.Session:
+        """Zwróć sesję dla klucza (tworzy ją przy pierwszym użyciu)."""
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._create_session()
+                self._sessions[key] = session
+                log.info("Nowa sesja keep-alive dla '%s' (pool_maxsize=%s)", key, self.pool_maxsize)
+            return session
+
+    def request(self, key: str, method: str, url: str, **kwargs) -> requests.Response:
+        """Wykonaj żądanie przez sesję danego klucza (z domyślnym timeoutem)."""
+        with self._lock:
+            self._request_counts[key] = self._request_counts.get(key, 0) + 1
+        if not self.enabled:
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = self.timeout
+            return requests.request(method, url, **kwargs)
+        return self.get(key).request(method, url, **kwargs)
+
+    def close(self, key: Optional[str] = None) -> None:
+        """Zamknij sesję danego klucza albo wszystkie (key=None)."""
+        with self._lock:
+            keys = [key] if key else list(self._sessions.keys())
+            for k in keys:
+                session = self._sessions.pop(k, None)
+                if session is not None:
+                    session.close()
+
+    def stats(self) -> dict:
+        """Podsumowanie rejestru (do diagnostyki)."""
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'pool_connections': self.pool_connections,
+                'pool_maxsize': self.pool_maxsize,
+                'timeout': self.timeout,
+                'sessions': sorted(self._sessions.keys()),
+                'requests': dict(self._request_counts),
+            }
@@ -0,0 +1,167 @@
+"""
+Trwały (SQLite) magazyn kluczy idempotencji dla endpointów tworzących dokumenty.
+
+Ponowione wywołanie z tym samym kluczem (nagłówek Idempotency-Key) nie wykonuje
+łańcucha wywołań wFirma drugi raz:
+    - gdy pierwsze wykonanie się zakończyło - dostaje zapisaną odpowiedź od razu,
+    - gdy pierwsze wykonanie trwa - czeka na jego wynik (także z innego workera gunicorna,
+      przez odpytywanie bazy; w obrębie procesu budzone od razu po zakończeniu),
+    - gdy ten sam klucz przyszedł z innym body - błąd (fingerprint się nie zgadza).
+
+Klucz zajęty dłużej niż lock_timeout (np. worker zabity w trakcie) może zostać przejęty.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from wfirma_sqlite import PeriodicPurge, connect, open_db
+
+
+class IdempotencyStore:
+    """
+    Klucze idempotencji i zapisane odpowiedzi w SQLite.
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+        ttl: Czas przechowywania zapisanej odpowiedzi (sekundy)
+        lock_timeout: Czas (sekundy), po którym niezakończone wykonanie uznajemy za porzucone
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 60 * 60, lock_timeout: float = 600):
+        self.path = path
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._purge = PeriodicPurge(path)
+        self.acquired = 0
+        self.replayed = 0
+        self.waited = 0
+        self.mismatches = 0
+        self.timeouts = 0
+        open_db(path, (
+            'CREATE TABLE IF NOT EXISTS idempotency ('
+            ' scope TEXT NOT NULL,'
+            ' key TEXT NOT NULL,'
+            ' fingerprint TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' http_status INTEGER,'
+            ' headers TEXT,'
+            ' body BLOB,'
+            ' PRIMARY KEY (scope, key))',
+        ))
+
+    def _try_acquire(self, scope: str, key: str, fingerprint: str) -> Tuple[str, Optional[dict]]:
+        """Jedna próba: ('acquired' | 'done' | 'pending' | 'mismatch', zapisana odpowiedź dla 'done')."""
+        now = time.time()
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT fingerprint, status, created_at, http_status, headers, body FROM idempotency'
+                ' WHERE scope = ? AND key = ?',
+                (scope, key),
+            ).fetchone()
+            if row is not None:
+                stored_fingerprint, status, created_at, http_status, headers, body = row
+                expired = now - created_at > (self.ttl if status == 'done' else self.lock_timeout)
+                if not expired:
+                    conn.execute('COMMIT')
+                    if stored_fingerprint != fingerprint:
+                        return 'mismatch', None
+                    if status == 'done':
+                        return 'done', {'status': http_status, 'headers': json.loads(headers or '{}'),
+                                        'body': bytes(body or b'')}
+                    return 'pending', None
+            conn.execute(
+                'INSERT OR REPLACE INTO idempotency (scope, key, fingerprint, status, created_at)'
+                " VALUES (?, ?, ?, 'pending', ?)",
+                (scope, key, fingerprint, now),
+            )
+            conn.execute('COMMIT')
+            return 'acquired', None
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            raise
+        finally:
+            conn.close()
+
+    def acquire(self, scope: str, key: str, fingerprint: str, wait: float = 0,
+                poll_interval: float = 0.25) -> Tuple[str, Optional[dict]]:
+        """
+        Zajmij klucz albo odczytaj wynik wcześniejszego wykonania.
+
+        Zwraca ('acquired', None) - wykonaj żądanie i wywołaj complete()/release(),
+        ('done', {'status', 'headers', 'body'}) - odpowiedź do odtworzenia,
+        ('mismatch', None) - ten sam klucz z innym żądaniem,
+        ('pending', None) - wykonanie nadal trwa po `wait` sekundach oczekiwania.
+        """
+        self._maybe_purge()
+        deadline = time.monotonic() + wait
+        state, record = self._try_acquire(scope, key, fingerprint)
+        if state == 'pending':
+            with self._lock:
+                self.waited += 1
+        while state == 'pending' and time.monotonic() < deadline:
+            with self._changed:
+                self._changed.wait(min(poll_interval, max(0.0, deadline - time.monotonic())))
+            state, record = self._try_acquire(scope, key, fingerprint)
+        with self._lock:
+            if state == 'acquired':
+                self.acquired += 1
+            elif state == 'done':
+                self.replayed += 1
+            elif state == 'mismatch':
+                self.mismatches += 1
+            else:
+                self.timeouts += 1
+        return state, record
+
+    def complete(self, scope: str, key: str, http_status: int, headers: Dict[str, str], body: bytes) -> None:
+        """Zapisz odpowiedź zakończonego wykonania (od teraz odtwarzana dla tego klucza)."""
+        with connect(self.path) as conn:
+            conn.execute(
+                "UPDATE idempotency SET status = 'done', created_at = ?, http_status = ?, headers = ?, body = ?"
+                ' WHERE scope = ? AND key = ?',
+                (time.time(), http_status, json.dumps(headers), sqlite3.Binary(body), scope, key),
+            )
+        with self._changed:
+            self._changed.notify_all()
+
+    def release(self, scope: str, key: str) -> None:
+        """Zwolnij klucz bez zapisu odpowiedzi (wyjątek w trakcie) - kolejna próba wykona żądanie od nowa."""
+        with connect(self.path) as conn:
+            conn.execute("DELETE FROM idempotency WHERE scope = ? AND key = ? AND status = 'pending'", (scope, key))
+        with self._changed:
+            self._changed.notify_all()
+
+    def _maybe_purge(self) -> None:
+        """Usuń wygasłe wpisy (najwyżej raz na godzinę)."""
+        now = time.time()
+        self._purge.run((
+            ("DELETE FROM idempotency WHERE (status = 'done' AND created_at < ?)"
+             " OR (status = 'pending' AND created_at < ?)", (now - self.ttl, now - self.lock_timeout)),
+        ), now)
+
+    def stats(self) -> dict:
+        with connect(self.path) as conn:
+            counts: Dict[str, int] = dict(conn.execute(
+                'SELECT status, COUNT(*) FROM idempotency GROUP BY status'
+            ).fetchall())
+        with self._lock:
+            return {
+                'name': 'idempotency',
+                'path': self.path,
+                'ttl_seconds': self.ttl,
+                'entries': counts,
+                'acquired': self.acquired,
+                'replayed': self.replayed,
+                'waited': self.waited,
+                'mismatches': self.mismatches,
+                'timeouts': self.timeouts,
+            }
@@ -0,0 +1,197 @@
+"""
+Trwały (SQLite) magazyn zadań asynchronicznych (np. workflow faktury z ?async=1).
+
+Zadanie przechodzi przez stany queued -> running -> succeeded / failed; postęp
+zapisywany jest per krok (contractor, invoice, pdf, ...), a na końcu gotowa
+odpowiedź JSON i status HTTP, jakie zwróciłby endpoint synchroniczny.
+Plik bazy jest współdzielony przez wszystkie workery gunicorna (tryb WAL), więc
+status można odczytać w dowolnym workerze. Zadanie wykonuje jednak worker, który
+je przyjął - po jego restarcie zadanie w toku (running) bez postępu przez
+stale_after sekund jest raportowane jako 'interrupted'. To tylko ocena przy
+odczycie: zadanie, które jednak się zakończy, dostaje swój końcowy status.
+"""
+
+import json
+import threading
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from wfirma_sqlite import PeriodicPurge, connect, open_db
+
+JOB_STATUSES = ('queued', 'running', 'succeeded', 'failed', 'interrupted')
+
+
+class JobStore:
+    """
+    Zadania asynchroniczne i ich postęp w SQLite.
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+        ttl: Czas przechowywania zakończonych zadań (sekundy)
+        stale_after: Brak postępu (sekundy), po którym zadanie w toku (running) raportujemy jako przerwane
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 60 * 60, stale_after: float = 600):
+        self.path = path
+        self.ttl = ttl
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._purge = PeriodicPurge(path)
+        self.created = 0
+        self.finished = 0
+        open_db(path, (
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            ' id TEXT PRIMARY KEY,'
+            ' kind TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' created_at REAL NOT NULL,'
+            ' started_at REAL,'
+            ' finished_at REAL,'
+            ' updated_at REAL NOT NULL,'
+            ' http_status INTEGER,'
+            ' result TEXT,'
+            ' error TEXT,'
+            ' webhook_url TEXT,'
+            ' webhook_status TEXT,'
+            ' webhook_attempts INTEGER NOT NULL DEFAULT 0)',
+            'CREATE TABLE IF NOT EXISTS job_steps ('
+            ' job_id TEXT NOT NULL,'
+            ' step TEXT NOT NULL,'
+            ' status TEXT NOT NULL,'
+            ' started_at REAL,'
+            ' finished_at REAL,'
+            ' PRIMARY KEY (job_id, step))',
+            'CREATE INDEX IF NOT EXISTS jobs_updated_at ON jobs (updated_at)',
+        ))
+
+    def create(self, kind: str, webhook_url: Optional[str] = None) -> str:
+        """Zarejestruj nowe zadanie (status queued). Zwraca jego ID."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._maybe_purge(now)
+        with connect(self.path) as conn:
+            conn.execute(
+                'INSERT INTO jobs (id, kind, status, created_at, updated_at, webhook_url) VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, kind, 'queued', now, now, webhook_url),
+            )
+        with self._lock:
+            self.created += 1
+        return job_id
+
+    def start(self, job_id: str) -> None:
+        now = time.time()
+        with connect(self.path) as conn:
+            conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, updated_at = ? WHERE id = ?",
+                (now, now, job_id),
+            )
+
+    def step(self, job_id: str, step: str, status: str) -> None:
+        """Zapisz postęp kroku: status 'running' = start, każdy inny ('ok', 'error', 'skipped') = koniec."""
+        now = time.time()
+        with connect(self.path) as conn:
+            if status == 'running':
+                conn.execute(
+                    'INSERT OR REPLACE INTO job_steps (job_id, step, status, started_at) VALUES (?, ?, ?, ?)',
+                    (job_id, step, status, now),
+                )
+            else:
+                conn.execute(
+                    'INSERT INTO job_steps (job_id, step, status, finished_at) VALUES (?, ?, ?, ?)'
+                    ' ON CONFLICT (job_id, step) DO UPDATE SET status = excluded.status,'
+                    ' finished_at = excluded.finished_at',
+                    (job_id, step, status, now),
+                )
+            conn.execute('UPDATE jobs SET updated_at = ? WHERE id = ?', (now, job_id))
+
+    def finish(self, job_id: str, status: str, http_status: Optional[int], result: Any = None,
+               error: Optional[str] = None) -> None:
+        """Zakończ zadanie (succeeded / failed) z odpowiedzią endpointu."""
+        now = time.time()
+        with connect(self.path) as conn:
+            conn.execute(
+                'UPDATE jobs SET status = ?, finished_at = ?, updated_at = ?, http_status = ?, result = ?, error = ?'
+                ' WHERE id = ?',
+                (status, now, now, http_status,
+                 json.dumps(result, ensure_ascii=False) if result is not None else None, error, job_id),
+            )
+        with self._lock:
+            self.finished += 1
+
+    def webhook_result(self, job_id: str, status: str, attempts: int) -> None:
+        """Zapisz wynik dostarczenia webhooka (np. 'delivered', 'http_500', 'ConnectTimeout')."""
+        with connect(self.path) as conn:
+            conn.execute(
+                'UPDATE jobs SET webhook_status = ?, webhook_attempts = ? WHERE id = ?',
+                (status, attempts, job_id),
+            )
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Stan zadania z postępem kroków albo None (brak lub usunięte po TTL)."""
+        with connect(self.path) as conn:
+            row = conn.execute(
+                'SELECT id, kind, status, created_at, started_at, finished_at, updated_at, http_status, result,'
+                ' error, webhook_url, webhook_status, webhook_attempts FROM jobs WHERE id = ?',
+                (job_id,),
+            ).fetchone()
+            if row is None:
+                return None
+            steps = conn.execute(
+                'SELECT step, status, started_at, finished_at FROM job_steps WHERE job_id = ?'
+                ' ORDER BY COALESCE(started_at, finished_at)',
+                (job_id,),
+            ).fetchall()
+            (job_id, kind, status, created_at, started_at, finished_at, updated_at, http_status, result,
+             error, webhook_url, webhook_status, webhook_attempts) = row
+        # queued czeka na wolny wątek puli (może długo przy kolejce) - przerwanie oceniamy tylko dla running
+        if status == 'running' and time.time() - updated_at > self.stale_after:
+            status, error = 'interrupted', 'Brak postępu zadania - worker został zatrzymany?'
+
+        job: Dict[str, Any] = {
+            'job_id': job_id,
+            'kind': kind,
+            'status': status,
+            'created_at': created_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+            'duration_ms': round((finished_at - started_at) * 1000, 1) if started_at and finished_at else None,
+            'steps': [
+                {
+                    'step': step,
+                    'status': step_status,
+                    'duration_ms': round((step_finished - step_started) * 1000, 1)
+                    if step_started and step_finished else None,
+                }
+                for step, step_status, step_started, step_finished in steps
+            ],
+            'http_status': http_status,
+            'result': json.loads(result) if result else None,
+            'error': error,
+        }
+        if webhook_url:
+            job['webhook'] = {'url': webhook_url, 'status': webhook_status, 'attempts': webhook_attempts}
+        return job
+
+    def _maybe_purge(self, now: float) -> None:
+        """Usuń zadania starsze niż TTL (najwyżej raz na godzinę)."""
+        cutoff = now - self.ttl
+        self._purge.run((
+            ('DELETE FROM job_steps WHERE job_id IN (SELECT id FROM jobs WHERE updated_at < ?)', (cutoff,)),
+            ('DELETE FROM jobs WHERE updated_at < ?', (cutoff,)),
+        ), now)
+
+    def stats(self) -> dict:
+        with connect(self.path) as conn:
+            counts: Dict[str, int] = dict(conn.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status'
+            ).fetchall())
+        with self._lock:
+            return {
+                'name': 'jobs',
+                'path': self.path,
+                'ttl_seconds': self.ttl,
+                'statuses': counts,
+                'created': self.created,
+                'finished': self.finished,
+            }
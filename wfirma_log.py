@@ -0,0 +1,163 @@
+"""
+Logowanie aplikacji: poziomy, kategorie, próbkowanie i maskowanie sekretów.
+
+Nakładka na standardowy moduł logging. Każda kategoria (WFIRMA, GUS, TOKEN,
+STOPKA, ...) to logger 'wfirma.<KATEGORIA>' z własnym progiem poziomu. Format
+linii jest taki jak dotychczasowych printów: "[GUS] ..." dla INFO,
+"[WFIRMA DEBUG] ..." / "[TOKEN WARNING] ..." dla pozostałych poziomów.
+
+Komunikaty są formatowane leniwie - argumenty w stylu %s (oraz lazy / lazy_json)
+są zamieniane na tekst tylko wtedy, gdy wpis faktycznie zostanie wypisany.
+
+Użycie:
+    log = get_logger('WFIRMA')
+    log.debug("invoice body: %s", lazy_json(body))
+    log.info("Faktura %s utworzona", number, extra=SAMPLED)  # próbkowane (ścieżka sukcesu)
+"""
+
+import json
+import logging
+import random
+import re
+import sys
+from typing import Iterable
+
+LOGGER_ROOT = 'wfirma'
+
+# extra= dla wpisów ze ścieżki sukcesu - wypisywane z prawdopodobieństwem LOG_SAMPLE_RATE
+SAMPLED = {'sampled': True}
+
+OFF = logging.CRITICAL + 10
+
+_SECRET_FIELDS = r'access_token|refresh_token|client_secret|password|api_key|pKluczUzytkownika|sid'
+_REDACT_PATTERNS = [
+    # "access_token": "abc...", access_token=abc..., 'client_secret': 'abc...'
+    (re.compile(r'''(["']?(?:%s)["']?\s*[:=]\s*["']?)([^"'&\s,}<]{4})[^"'&\s,}<]*''' % _SECRET_FIELDS, re.IGNORECASE),
+     r'\1\2***'),
+    (re.compile(r'(<(?:pKluczUzytkownika|sid)>)[^<]*', re.IGNORECASE), r'\1***'),
+    (re.compile(r'(Bearer\s+)[A-Za-z0-9._~+/=-]+'), r'\1***'),
+]
+
+
+class lazy_json:
+    """Argument logu serializowany do JSON dopiero przy wypisaniu wpisu."""
+
+    __slots__ = ('value', 'kwargs')
+
+    def __init__(self, value, **kwargs):
+        self.value = value
+        self.kwargs = kwargs
+
+    def __str__(self) -> str:
+        try:
+            return json.dumps(self.value, ensure_ascii=False, default=str, **self.kwargs)
+        except (TypeError, ValueError):
+            return repr(self.value)
+
+
+class lazy:
+    """Argument logu wyliczany (fn()) dopiero przy wypisaniu wpisu, np. lazy(lambda: resp.text)."""
+
+    __slots__ = ('fn',)
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __str__(self) -> str:
+        return str(self.fn())
+
+
+class _RedactingFormatter(logging.Formatter):
+    """[KATEGORIA] / [KATEGORIA POZIOM] + treść z zamaskowanymi sekretami."""
+
+    def __init__(self, secrets: Iterable[str] = ()):
+        super().__init__()
+        self.secrets = sorted({s for s in secrets if s and len(s) >= 6}, key=len, reverse=True)
+
+    def redact(self, text: str) -> str:
+        for secret in self.secrets:
+            if secret in text:
+                text = text.replace(secret, secret[:4] + '***')
+        for pattern, replacement in _REDACT_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def format(self, record: logging.LogRecord) -> str:
+        category = record.name[len(LOGGER_ROOT) + 1:] or LOGGER_ROOT.upper()
+        tag = category if record.levelno == logging.INFO else f'{category} {record.levelname}'
+        message = record.getMessage()
+        if record.exc_info:
+            message = f'{message}\n{self.formatException(record.exc_info)}'
+        return f'[{tag}] {self.redact(message)}'
+
+
+class _SamplingFilter(logging.Filter):
+    """Przepuszcza wpisy oznaczone SAMPLED z prawdopodobieństwem rate."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, 'sampled', False) and self.rate < 1:
+            return random.random() < self.rate
+        return True
+
+
+class _StdoutHandler(logging.StreamHandler):
+    """Zawsze bieżący sys.stdout (jak print - działa z contextlib.redirect_stdout)."""
+
+    def __init__(self):
+        super().__init__(sys.stdout)
+
+    @property
+    def stream(self):
+        return sys.stdout
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+def _parse_level(name: str) -> int:
+    name = (name or '').strip().upper()
+    if name in ('OFF', 'NONE', 'FALSE', '0'):
+        return OFF
+    level = logging.getLevelName(name)
+    return level if isinstance(level, int) else logging.INFO
+
+
+def configure_logging(level: str = 'INFO', categories: str = '', sample_rate: float = 1.0,
+                      secrets: Iterable[str] = (), stream=None) -> logging.Logger:
+    """
+    Skonfiguruj logger aplikacji.
+
+    Args:
+        level: Domyślny poziom (DEBUG, INFO, WARNING, ERROR, OFF)
+        categories: Progi per kategoria, np. "WFIRMA=DEBUG,GUS=WARNING,STOPKA=OFF"
+        sample_rate: Odsetek wypisywanych wpisów SAMPLED (0-1)
+        secrets: Wartości (klucze API, sekrety) maskowane w każdym wpisie
+        stream: Strumień wyjścia (domyślnie stdout - jak dotychczasowe printy)
+    """
+    root = logging.getLogger(LOGGER_ROOT)
+    root.setLevel(_parse_level(level))
+    root.propagate = False
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    handler = logging.StreamHandler(stream) if stream else _StdoutHandler()
+    handler.setFormatter(_RedactingFormatter(secrets))
+    handler.addFilter(_SamplingFilter(sample_rate))
+    root.addHandler(handler)
+
+    for item in (categories or '').split(','):
+        if '=' not in item:
+            continue
+        category, category_level = item.split('=', 1)
+        logging.getLogger(f'{LOGGER_ROOT}.{category.strip().upper()}').setLevel(_parse_level(category_level))
+    return root
+
+
+def get_logger(category: str) -> logging.Logger:
+    """Logger kategorii (bez configure_logging wpisy WARNING+ idą na stderr - logging.lastResort)."""
+    return logging.getLogger(f'{LOGGER_ROOT}.{category}')
+
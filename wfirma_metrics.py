@@ -0,0 +1,307 @@
+"""
+Pomiary czasu: nagłówek Server-Timing per request i metryki Prometheus (/metrics).
+
+Każde wywołanie zewnętrznego API (wFirma, GUS/BIR) przechodzi przez
+Metrics.timed(upstream, step), które:
+    - dopisuje czas kroku do pomiarów bieżącego requestu (nagłówek Server-Timing),
+    - aktualizuje histogram czasu, liczniki błędów i przesłanych bajtów.
+
+Endpointy aplikacji mierzy observe_endpoint() (hooki Flask w app.py).
+Metryki są trzymane w pamięci procesu - przy kilku workerach gunicorna
+każdy worker ma własne liczniki (Prometheus sumuje je po scrape'ach).
+"""
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Progi histogramów w sekundach (od odczytu z cache do invoices/add ze zrzutem PDF)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Maksymalna liczba pozycji w nagłówku Server-Timing (reszta sumowana jako "other")
+SERVER_TIMING_MAX_ENTRIES = 30
+
+
+class _Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, buckets: Sequence[float], value: float) -> None:
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+class UpstreamCall:
+    """Wynik jednego wywołania w Metrics.timed() - wywołujący uzupełnia bajty i błąd."""
+
+    __slots__ = ('sent', 'received', 'error')
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.error: Optional[str] = None
+
+
+class RequestTimings:
+    """Czasy kroków jednego requestu (Server-Timing). Bezpieczne wątkowo (paczki GUS w puli)."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self._steps: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, duration: float) -> None:
+        with self._lock:
+            step = self._steps.setdefault(name, [0, 0.0])
+            step[0] += 1
+            step[1] += duration
+
+    def header_value(self, total: Optional[float] = None) -> str:
+        """Wartość nagłówka Server-Timing: kroki w kolejności pierwszego wywołania + total."""
+        with self._lock:
+            steps = list(self._steps.items())
+        entries = []
+        other = 0.0
+        for index, (name, (count, duration)) in enumerate(steps):
+            if index >= SERVER_TIMING_MAX_ENTRIES:
+                other += duration
+                continue
+            token = ''.join(c if c.isalnum() or c in '-_.' else '-' for c in name)
+            desc = f'{name} x{count}' if count > 1 else name
+            entries.append(f'{token};desc="{desc}";dur={duration * 1000:.1f}')
+        if other:
+            entries.append(f'other;dur={other * 1000:.1f}')
+        if total is None:
+            total = time.perf_counter() - self.started
+        entries.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_current_timings: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar(
+    'wfirma_request_timings', default=None)
+
+
+def start_request_timings() -> RequestTimings:
+    """Rozpocznij pomiary bieżącego requestu (before_request)."""
+    timings = RequestTimings()
+    _current_timings.set(timings)
+    return timings
+
+
+def current_request_timings() -> Optional[RequestTimings]:
+    return _current_timings.get()
+
+
+def end_request_timings() -> None:
+    """Zakończ pomiary bieżącego requestu (teardown_request)."""
+    _current_timings.set(None)
+
+
+def bind_request_timings(fn: Callable) -> Callable:
+    """Opakuj fn tak, by w wątku puli (ThreadPoolExecutor) zapisywała czasy do bieżącego requestu."""
+    timings = _current_timings.get()
+
+    def wrapper(*args, **kwargs):
+        token = _current_timings.set(timings)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current_timings.reset(token)
+    return wrapper
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    parts = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+def _format_float(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metrics:
+    """
+    Liczniki i histogramy czasu endpointów aplikacji oraz wywołań zewnętrznych API.
+
+    Args:
+        prefix: Prefix nazw metryk Prometheus
+        buckets: Progi histogramów (sekundy, rosnąco)
+        enabled: False = timed() tylko przepuszcza wywołanie (bez pomiarów)
+    """
+
+    def __init__(self, prefix: str = 'wfirma_api', buckets: Sequence[float] = DEFAULT_BUCKETS, enabled: bool = True):
+        self.prefix = prefix
+        self.buckets = tuple(sorted(buckets))
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._endpoint_duration: Dict[Tuple[str, str], _Histogram] = {}
+        self._endpoint_requests: Dict[Tuple[str, str, str], int] = {}
+        self._endpoint_errors: Dict[Tuple[str, str], int] = {}
+        self._endpoint_bytes: Dict[Tuple[str, str], int] = {}
+        self._upstream_duration: Dict[Tuple[str, str], _Histogram] = {}
+        self._upstream_errors: Dict[Tuple[str, str, str], int] = {}
+        self._upstream_sent: Dict[Tuple[str, str], int] = {}
+        self._upstream_received: Dict[Tuple[str, str], int] = {}
+        self._speculative: Dict[Tuple[str, str], int] = {}
+        self._speculative_seconds: Dict[Tuple[str, str], float] = {}
+
+    def _histogram(self, table: dict, key: tuple) -> _Histogram:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = _Histogram(len(self.buckets))
+        return histogram
+
+    def observe_endpoint(self, endpoint: str, method: str, status: int, duration: float, response_bytes: int = 0) -> None:
+        """Zapisz jeden request do endpointu aplikacji (endpoint = reguła URL, np. /api/invoice/<invoice_id>/pdf)."""
+        if not self.enabled:
+            return
+        key = (endpoint, method)
+        with self._lock:
+            self._histogram(self._endpoint_duration, key).observe(self.buckets, duration)
+            status_key = (endpoint, method, str(status))
+            self._endpoint_requests[status_key] = self._endpoint_requests.get(status_key, 0) + 1
+            if status >= 500:
+                self._endpoint_errors[key] = self._endpoint_errors.get(key, 0) + 1
+            self._endpoint_bytes[key] = self._endpoint_bytes.get(key, 0) + (response_bytes or 0)
+
+    def observe_upstream(self, upstream: str, step: str, duration: float, sent: int = 0, received: int = 0,
+                         error: Optional[str] = None) -> None:
+        """Zapisz jedno wywołanie zewnętrznego API (error = rodzaj błędu, np. 'http_500', 'timeout')."""
+        timings = _current_timings.get()
+        if timings is not None:
+            timings.add(f'{upstream}-{step}', duration)
+        if not self.enabled:
+            return
+        key = (upstream, step)
+        with self._lock:
+            self._histogram(self._upstream_duration, key).observe(self.buckets, duration)
+            if error:
+                error_key = (upstream, step, error)
+                self._upstream_errors[error_key] = self._upstream_errors.get(error_key, 0) + 1
+            self._upstream_sent[key] = self._upstream_sent.get(key, 0) + (sent or 0)
+            self._upstream_received[key] = self._upstream_received.get(key, 0) + (received or 0)
+
+    def observe_speculative(self, kind: str, outcome: str, seconds: float = 0.0) -> None:
+        """
+        Zapisz wynik spekulatywnego wywołania (np. kind='gus_lookup').
+
+        outcome: 'used' (seconds = czas ukryty za innym krokiem), 'wasted' (seconds = czas
+        niepotrzebnego wywołania) lub 'cancelled' (anulowane przed startem, bez kosztu).
+        """
+        if not self.enabled:
+            return
+        key = (kind, outcome)
+        with self._lock:
+            self._speculative[key] = self._speculative.get(key, 0) + 1
+            self._speculative_seconds[key] = self._speculative_seconds.get(key, 0.0) + max(0.0, seconds)
+
+    @contextmanager
+    def timed(self, upstream: str, step: str):
+        """
+        Zmierz krok (wywołanie API). Wyjątek w bloku liczony jest jako błąd i przekazywany dalej.
+
+        with metrics.timed('wfirma', 'invoices/add') as call:
+            resp = ...
+            call.received = len(resp.content)
+        """
+        call = UpstreamCall()
+        started = time.perf_counter()
+        try:
+            yield call
+        except Exception as e:
+            call.error = call.error or type(e).__name__
+            raise
+        finally:
+            self.observe_upstream(upstream, step, time.perf_counter() - started,
+                                  sent=call.sent, received=call.received, error=call.error)
+
+    def render(self) -> str:
+        """Metryki w formacie tekstowym Prometheus (text/plain; version=0.0.4)."""
+        p = self.prefix
+        lines: List[str] = []
+        with self._lock:
+            self._render_histogram(lines, f'{p}_request_duration_seconds',
+                                   'Czas obsługi requestu przez endpoint aplikacji',
+                                   ('endpoint', 'method'), self._endpoint_duration)
+            self._render_counter(lines, f'{p}_requests_total', 'Liczba requestów do endpointu wg statusu HTTP',
+                                 ('endpoint', 'method', 'status'), self._endpoint_requests)
+            self._render_counter(lines, f'{p}_request_errors_total', 'Requesty zakończone statusem 5xx',
+                                 ('endpoint', 'method'), self._endpoint_errors)
+            self._render_counter(lines, f'{p}_response_bytes_total', 'Bajty odpowiedzi endpointu (bez strumieni)',
+                                 ('endpoint', 'method'), self._endpoint_bytes)
+            self._render_histogram(lines, f'{p}_upstream_duration_seconds',
+                                   'Czas wywołania zewnętrznego API (do otrzymania odpowiedzi)',
+                                   ('upstream', 'step'), self._upstream_duration)
+            self._render_counter(lines, f'{p}_upstream_errors_total',
+                                 'Nieudane wywołania zewnętrznego API (status >= 400 lub wyjątek)',
+                                 ('upstream', 'step', 'reason'), self._upstream_errors)
+            self._render_counter(lines, f'{p}_upstream_sent_bytes_total', 'Bajty wysłane do zewnętrznego API',
+                                 ('upstream', 'step'), self._upstream_sent)
+            self._render_counter(lines, f'{p}_upstream_received_bytes_total', 'Bajty odebrane z zewnętrznego API',
+                                 ('upstream', 'step'), self._upstream_received)
+            self._render_counter(lines, f'{p}_speculative_total',
+                                 'Spekulatywne wywołania wg wyniku (used / wasted / cancelled)',
+                                 ('kind', 'outcome'), self._speculative)
+            self._render_counter(lines, f'{p}_speculative_seconds_total',
+                                 'Czas zaoszczędzony (outcome=used) lub zmarnowany (outcome=wasted) przez spekulację',
+                                 ('kind', 'outcome'), self._speculative_seconds)
+        return '\n'.join(lines) + '\n'
+
+    def _render_counter(self, lines: List[str], name: str, help_text: str, label_names: Tuple[str, ...],
+                        table: Dict[tuple, float]) -> None:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for key in sorted(table):
+            value = table[key]
+            value = f'{value:.6f}' if isinstance(value, float) else value
+            lines.append(f'{name}{_labels(label_names, key)} {value}')
+
+    def _render_histogram(self, lines: List[str], name: str, help_text: str, label_names: Tuple[str, ...],
+                          table: Dict[tuple, _Histogram]) -> None:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for key in sorted(table):
+            histogram = table[key]
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                bucket_labels = _labels(label_names, key, 'le="%s"' % _format_float(bound))
+                lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+            inf_labels = _labels(label_names, key, 'le="+Inf"')
+            lines.append(f'{name}_bucket{inf_labels} {histogram.count}')
+            lines.append(f'{name}_sum{_labels(label_names, key)} {histogram.sum:.6f}')
+            lines.append(f'{name}_count{_labels(label_names, key)} {histogram.count}')
+
+    def stats(self) -> dict:
+        """Podsumowanie wywołań zewnętrznych API (liczba, średni czas, błędy) - do /api/cache/stats."""
+        with self._lock:
+            upstream = {}
+            for (name, step), histogram in sorted(self._upstream_duration.items()):
+                errors = sum(count for (u, s, _), count in self._upstream_errors.items() if (u, s) == (name, step))
+                upstream[f'{name} {step}'] = {
+                    'calls': histogram.count,
+                    'avg_ms': round(histogram.sum / histogram.count * 1000, 1) if histogram.count else None,
+                    'errors': errors,
+                }
+            speculative = {
+                f'{kind} {outcome}': {'count': count,
+                                      'seconds': round(self._speculative_seconds.get((kind, outcome), 0.0), 3)}
+                for (kind, outcome), count in sorted(self._speculative.items())
+            }
+            return {'enabled': self.enabled, 'upstream': upstream, 'speculative': speculative}
@@ -0,0 +1,160 @@
+"""
+Dyskowy cache PDF faktur (invoices/faktura_{id}.pdf).
+
+Wystawiona faktura się nie zmienia, więc raz pobrany PDF może być serwowany
+z dysku bez wywołania wFirma. Zapis jest atomowy (plik tymczasowy + os.replace),
+a rozmiar katalogu ograniczony - najdawniej używane pliki (mtime) są usuwane.
+"""
+
+import os
+import re
+import tempfile
+import threading
+from typing import Iterable, Iterator, Optional
+
+from wfirma_log import get_logger
+
+log = get_logger('CACHE')
+
+
+class PdfCache:
+    """
+    Cache PDF faktur na dysku z limitem rozmiaru (LRU po mtime).
+
+    Args:
+        directory: Katalog z plikami PDF
+        max_bytes: Maksymalny łączny rozmiar plików w katalogu (0 = bez limitu)
+    """
+
+    def __init__(self, directory: str = 'invoices', max_bytes: int = 500 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def path(self, invoice_id: str) -> str:
+        """Ścieżka pliku faktury (ID tylko z bezpiecznych znaków - ochrona przed path traversal)."""
+        if not re.fullmatch(r'[0-9A-Za-z_-]+', str(invoice_id or '')):
+            raise ValueError(f'Niepoprawne ID faktury: {invoice_id!r}')
+        return os.path.join(self.directory, f'faktura_{invoice_id}.pdf')
+
+    def get(self, invoice_id: str) -> Optional[str]:
+        """Ścieżka PDF z cache albo None. Trafienie odświeża mtime (kolejność LRU)."""
+        try:
+            path = self.path(invoice_id)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def _open_temp(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp_', suffix='.pdf')
+        return os.fdopen(fd, 'wb'), tmp_path
+
+    def _commit(self, tmp_path: str, invoice_id: str) -> str:
+        path = self.path(invoice_id)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.writes += 1
+        self.evict()
+        return path
+
+    def put(self, invoice_id: str, data: bytes) -> str:
+        """Zapisz PDF atomowo i zwróć ścieżkę pliku."""
+        self.path(invoice_id)  # walidacja ID zanim cokolwiek zapiszemy
+        f, tmp_path = self._open_temp()
+        try:
+            with f:
+                f.write(data)
+            return self._commit(tmp_path, invoice_id)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+    def tee(self, invoice_id: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Przepuść strumień bloków PDF dalej, równolegle zapisując go do cache.
+        Plik trafia do cache tylko gdy strumień dojdzie do końca (przerwany = usunięty).
+        """
+        self.path(invoice_id)
+        f, tmp_path = self._open_temp()
+        completed = False
+        try:
+            with f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed:
+                try:
+                    self._commit(tmp_path, invoice_id)
+                except OSError as e:
+                    log.warning("Nie udało się zapisać faktury %s: %s", invoice_id, e)
+                    _remove_quietly(tmp_path)
+            else:
+                _remove_quietly(tmp_path)
+
+    def _entries(self) -> list:
+        entries = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.is_file() and entry.name.startswith('faktura_') and entry.name.endswith('.pdf'):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def evict(self) -> int:
+        """Usuń najdawniej używane pliki, aż łączny rozmiar zmieści się w max_bytes."""
+        if not self.max_bytes:
+            return 0
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if _remove_quietly(path):
+                total -= size
+                removed += 1
+        if removed:
+            with self._lock:
+                self.evictions += removed
+            log.info("Usunięto %s najstarszych PDF (rozmiar katalogu %s B)", removed, total)
+        return removed
+
+    def stats(self) -> dict:
+        entries = self._entries()
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'name': 'pdf_cache',
+                'directory': self.directory,
+                'max_bytes': self.max_bytes,
+                'files': len(entries),
+                'bytes': sum(size for _, size, _ in entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 3) if total else None,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+
+def _remove_quietly(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,163 @@
+"""
+Zapis zmiennych środowiskowych do Render API w tle (write-behind).
+
+Render API pozwala zapisać tylko CAŁĄ listę zmiennych (GET wszystkich + PUT
+wszystkich), więc każda zmiana jednej zmiennej to dwa wywołania. RenderEnvWriter
+zbiera zmienione klucze i zapisuje je razem jednym GET+PUT w wątku w tle,
+ponawiając nieudane zapisy - request, który zmienił token, nie czeka na Render.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+from wfirma_log import get_logger
+
+log = get_logger('RENDER')
+
+
+class RenderEnvWriter:
+    """
+    Kolejka zmian zmiennych środowiskowych usługi Render, zapisywana w tle.
+
+    Args:
+        api_key: RENDER_API_KEY (brak = zapis wyłączony)
+        service_id: RENDER_SERVICE_ID (brak = zapis wyłączony)
+        coalesce_delay: Ile sekund wątek czeka na kolejne zmiany przed zapisem
+        retry_interval: Odstęp pierwszej ponownej próby (podwajany do max_retry_interval)
+        max_retry_interval: Maksymalny odstęp między próbami
+        timeout: Timeout wywołań Render API
+    """
+
+    def __init__(self, api_key: Optional[str], service_id: Optional[str], coalesce_delay: float = 0.5,
+                 retry_interval: float = 5, max_retry_interval: float = 300, timeout: float = 15):
+        self.api_key = api_key
+        self.service_id = service_id
+        self.coalesce_delay = coalesce_delay
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.timeout = timeout
+        self._pending: Dict[str, str] = {}
+        self._in_flight = False
+        self._cond = threading.Condition()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_pid: Optional[int] = None
+        self.submitted = 0
+        self.writes = 0
+        self.failures = 0
+        self.api_calls = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.api_key and self.service_id)
+
+    def submit(self, values: Dict[str, str]) -> None:
+        """Dodaj zmiany do kolejki (nowsza wartość klucza zastępuje starszą) i wróć od razu."""
+        if not self.enabled or not values:
+            return
+        self._ensure_writer()
+        with self._cond:
+            self._pending.update(values)
+            self.submitted += len(values)
+            self._cond.notify_all()
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Poczekaj aż kolejka zostanie zapisana (np. przy zamykaniu procesu). True = pusto."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def _ensure_writer(self) -> None:
+        """Uruchom wątek zapisujący (także w procesie po fork() workera gunicorna)."""
+        pid = os.getpid()
+        with self._cond:
+            if self._writer is not None and self._writer_pid == pid and self._writer.is_alive():
+                return
+            self._writer_pid = pid
+            self._writer = threading.Thread(target=self._run, name='render-env-writer', daemon=True)
+            self._writer.start()
+
+    def _run(self) -> None:
+        delay = self.retry_interval
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            time.sleep(self.coalesce_delay)  # zbierz zmiany z tego samego zapisu tokenów
+            with self._cond:
+                batch = dict(self._pending)
+                self._pending.clear()
+                self._in_flight = True
+            ok = False
+            try:
+                ok = self._persist(batch)
+            except Exception as e:
+                self.last_error = str(e)
+            with self._cond:
+                self._in_flight = False
+                if ok:
+                    self.writes += 1
+                    self.last_error = None
+                else:
+                    self.failures += 1
+                    # Nowsze wartości z kolejki mają pierwszeństwo przed nieudaną paczką
+                    self._pending = {**batch, **self._pending}
+                self._cond.notify_all()
+            if ok:
+                delay = self.retry_interval
+                log.info("Zapisano %s zmiennych: %s", len(batch), ', '.join(sorted(batch)))
+            else:
+                log.warning("Zapis nieudany (%s) - ponowna próba za %gs", self.last_error, delay)
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_retry_interval)
+
+    def _persist(self, values: Dict[str, str]) -> bool:
+        """Jeden GET + jeden PUT całej listy zmiennych ze zmienionymi kluczami."""
+        url = f"https://api.render.com/v1/services/{self.service_id}/env-vars"
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+        self.api_calls += 1
+        get_resp = requests.get(url, headers=headers, timeout=self.timeout)
+        if get_resp.status_code != 200:
+            self.last_error = f"GET {get_resp.status_code} {get_resp.text[:200]}"
+            return False
+
+        env_list = []
+        remaining = dict(values)
+        for item in get_resp.json():  # [{"envVar": {"key": "X", "value": "Y"}}, ...]
+            env_var = item.get('envVar', {})
+            key = env_var.get('key')
+            env_list.append({"key": key, "value": remaining.pop(key, env_var.get('value'))})
+        env_list.extend({"key": key, "value": value} for key, value in remaining.items())
+
+        self.api_calls += 1
+        put_resp = requests.put(url, headers=headers, json=env_list, timeout=self.timeout)
+        if put_resp.status_code != 200:
+            self.last_error = f"PUT {put_resp.status_code} {put_resp.text[:200]}"
+            return False
+        return True
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'name': 'render_env',
+                'enabled': self.enabled,
+                'pending': sorted(self._pending),
+                'submitted': self.submitted,
+                'writes': self.writes,
+                'failures': self.failures,
+                'api_calls': self.api_calls,
+                'last_error': self.last_error,
+            }
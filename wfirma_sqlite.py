@@ -0,0 +1,63 @@
+"""
+Wspólne elementy magazynów SQLite (indeks kontrahentów, cache GUS, tokeny, zadania, idempotencja).
+
+Każdy magazyn to jeden plik bazy współdzielony przez workery gunicorna (tryb WAL),
+otwierany krótkim połączeniem na czas jednej operacji.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional, Sequence, Tuple
+
+
+@contextmanager
+def connect(path: str):
+    """Połączenie na czas jednej operacji (commit + zamknięcie na końcu)."""
+    conn = sqlite3.connect(path, timeout=10)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+def open_db(path: str, schema: Iterable[str]) -> None:
+    """Przygotuj plik bazy: katalog, tryb WAL i schemat (instrukcje CREATE ... IF NOT EXISTS)."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with connect(path) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        for statement in schema:
+            conn.execute(statement)
+
+
+class PeriodicPurge:
+    """
+    Usuwanie wygasłych wpisów najwyżej raz na interval sekund (w obrębie procesu).
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+        interval: Minimalny odstęp między kolejnymi czyszczeniami (sekundy)
+    """
+
+    def __init__(self, path: str, interval: float = 3600):
+        self.path = path
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._last_run = 0.0
+
+    def run(self, statements: Sequence[Tuple[str, tuple]], now: Optional[float] = None) -> bool:
+        """Wykonaj instrukcje (sql, parametry), jeśli minął interval od poprzedniego czyszczenia."""
+        now = time.time() if now is None else now
+        with self._lock:
+            if now - self._last_run < self.interval:
+                return False
+            self._last_run = now
+        with connect(self.path) as conn:
+            for sql, params in statements:
+                conn.execute(sql, params)
+        return True
@@ -0,0 +1,215 @@
+"""
+Graf zależności kroków jednego requestu (np. workflow faktury) wykonywany na wspólnej,
+ograniczonej puli wątków.
+
+Każdy krok to funkcja dostająca wyniki swoich zależności jako argumenty nazwane.
+Kroki bez wzajemnych zależności (np. contractors/find i series/find) wykonują się
+równolegle, więc czas requestu to w przybliżeniu ścieżka krytyczna, a nie suma
+wszystkich wywołań API. Jeden z gotowych kroków zawsze wykonuje wątek wywołujący
+(zamiast czekać bezczynnie) - ciąg zależnych kroków nie przechodzi przez pulę wcale.
+
+Wyjątek w kroku przerywa graf: nowe kroki nie są uruchamiane, trwające są dokańczane,
+a run() rzuca pierwszy wyjątek. Bez puli (executor=None) kroki wykonują się po kolei
+w kolejności dodania - jak kod sekwencyjny.
+
+    graph = TaskGraph(executor, wrap=bind_request_timings)
+    graph.add('company_id', get_company_id)
+    graph.add('contractor', find_contractor, deps=('company_id',))
+    graph.add('series', find_series, deps=('company_id',))
+    results = graph.run()
+    graph.timeline()  # [{'step': 'contractor', 'start_ms': 0.4, 'duration_ms': 51.2, ...}, ...]
+
+Speculative uruchamia wywołanie "na zapas" (np. GUS równolegle z contractors/find),
+zanim wiadomo, czy będzie potrzebne: use() czeka na wynik, discard() anuluje
+niewystartowane wywołanie albo porzuca wynik trwającego.
+"""
+
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+class _Step:
+    __slots__ = ('name', 'fn', 'deps', 'started', 'finished', 'thread', 'status')
+
+    def __init__(self, name: str, fn: Callable, deps: Sequence[str]):
+        self.name = name
+        self.fn = fn
+        self.deps = tuple(deps)
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.thread = ''
+        self.status = 'pending'
+
+
+class TaskGraph:
+    """
+    Args:
+        executor: Pula wątków (współdzielona między requestami) albo None = wykonanie sekwencyjne
+        wrap: Opakowanie funkcji wykonywanej w puli (np. bind_request_timings - Server-Timing z wątków)
+        on_step: Callback(krok, status) przy starcie ('running') i końcu kroku ('ok', 'error', 'skipped'),
+            np. zapis postępu zadania asynchronicznego; wyjątki z callbacku są ignorowane
+    """
+
+    def __init__(self, executor: Optional[Executor] = None, wrap: Optional[Callable[[Callable], Callable]] = None,
+                 on_step: Optional[Callable[[str, str], None]] = None):
+        self.executor = executor
+        self.wrap = wrap
+        self.on_step = on_step
+        self._steps: Dict[str, _Step] = {}
+        self._results: Dict[str, Any] = {}
+        self._started: Optional[float] = None
+
+    def add(self, name: str, fn: Callable[..., Any], deps: Sequence[str] = ()) -> None:
+        """Dodaj krok; fn(**{zależność: wynik}). Zależności muszą być dodane wcześniej."""
+        if name in self._steps:
+            raise ValueError(f'Krok {name} już istnieje')
+        missing = [dep for dep in deps if dep not in self._steps]
+        if missing:
+            raise ValueError(f'Krok {name}: nieznane zależności {missing}')
+        self._steps[name] = _Step(name, fn, deps)
+
+    def _notify(self, step: _Step) -> None:
+        if self.on_step is None:
+            return
+        try:
+            self.on_step(step.name, step.status)
+        except Exception:
+            pass  # postęp jest informacyjny - nie przerywa kroków
+
+    def _execute(self, step: _Step) -> Any:
+        step.thread = threading.current_thread().name
+        step.status = 'running'
+        self._notify(step)
+        step.started = time.perf_counter()
+        try:
+            result = step.fn(**{dep: self._results[dep] for dep in step.deps})
+            step.status = 'ok'
+            return result
+        except BaseException:
+            step.status = 'error'
+            raise
+        finally:
+            step.finished = time.perf_counter()
+            self._notify(step)
+
+    def run(self) -> Dict[str, Any]:
+        """Wykonaj wszystkie kroki; zwraca {krok: wynik}. Rzuca pierwszy wyjątek z kroków."""
+        self._started = time.perf_counter()
+        if self.executor is None:
+            steps = list(self._steps.values())
+            for index, step in enumerate(steps):
+                try:
+                    self._results[step.name] = self._execute(step)
+                except BaseException:
+                    for skipped in steps[index + 1:]:
+                        skipped.status = 'skipped'
+                        self._notify(skipped)
+                    raise
+            return dict(self._results)
+
+        pending = dict(self._steps)
+        running = {}  # future -> step
+        error: Optional[BaseException] = None
+        while pending or running:
+            ready = [] if error else [s for s in pending.values() if all(d in self._results for d in s.deps)]
+            for step in ready:
+                del pending[step.name]
+            # Wszystkie gotowe kroki poza pierwszym do puli, pierwszy w bieżącym wątku
+            for step in ready[1:]:
+                fn = self.wrap(self._execute) if self.wrap else self._execute
+                running[self.executor.submit(fn, step)] = step
+            if ready:
+                try:
+                    self._results[ready[0].name] = self._execute(ready[0])
+                except BaseException as e:
+                    error = error or e
+                continue
+            if not running:
+                break  # przerwany graf (pozostałe kroki pominięte)
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    self._results[step.name] = future.result()
+                except BaseException as e:
+                    error = error or e
+        for step in pending.values():
+            step.status = 'skipped'
+            self._notify(step)
+        if error is not None:
+            raise error
+        return dict(self._results)
+
+    def timeline(self) -> List[dict]:
+        """Przebieg kroków względem startu grafu (ms) - do logów i debugowania."""
+        origin = self._started or 0.0
+        items = []
+        for step in self._steps.values():
+            item = {'step': step.name, 'deps': list(step.deps), 'status': step.status}
+            if step.started is not None:
+                item['start_ms'] = round((step.started - origin) * 1000, 1)
+                item['duration_ms'] = round(((step.finished or step.started) - step.started) * 1000, 1)
+                item['thread'] = step.thread
+            items.append(item)
+        return sorted(items, key=lambda item: item.get('start_ms', float('inf')))
+
+
+class Speculative:
+    """
+    Wywołanie uruchomione przed decyzją, czy jego wynik będzie potrzebny.
+
+    Args:
+        executor: Pula, na której wykonuje się wywołanie (osobna niż kroki grafu - bez zakleszczeń)
+        fn: Funkcja bez argumentów
+        wrap: Opakowanie fn (np. bind_request_timings)
+        on_settle: Callback(outcome, seconds) wywoływany raz: ('used', czas ukryty za innym
+            krokiem), ('wasted', czas porzuconego wywołania) lub ('cancelled', 0.0)
+    """
+
+    def __init__(self, executor: Executor, fn: Callable[[], Any], wrap: Optional[Callable[[Callable], Callable]] = None,
+                 on_settle: Optional[Callable[[str, float], None]] = None):
+        self.on_settle = on_settle
+        self.submitted = time.perf_counter()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._settled = False
+
+        def run():
+            self.started = time.perf_counter()
+            try:
+                return fn()
+            finally:
+                self.finished = time.perf_counter()
+
+        self.future: Future = executor.submit(wrap(run) if wrap else run)
+
+    def _settle(self, outcome: str, seconds: float) -> None:
+        if self._settled:
+            return
+        self._settled = True
+        if self.on_settle:
+            self.on_settle(outcome, seconds)
+
+    def use(self) -> Any:
+        """Wynik wywołania (czeka, jeśli jeszcze trwa); wyjątek z fn jest rzucany dalej."""
+        needed_at = time.perf_counter()
+        try:
+            return self.future.result()
+        finally:
+            if self.started is not None:
+                hidden = min(needed_at, self.finished or needed_at) - self.started
+                self._settle('used', hidden)
+
+    def discard(self) -> None:
+        """Wynik niepotrzebny: anuluj, jeśli wywołanie nie wystartowało, inaczej policz je jako zmarnowane."""
+        if self.future.cancel():
+            self._settle('cancelled', 0.0)
+            return
+
+        def done(_future):
+            started = self.started or self.submitted
+            self._settle('wasted', (self.finished or time.perf_counter()) - started)
+
+        self.future.add_done_callback(done)
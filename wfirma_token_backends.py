@@ -0,0 +1,233 @@
+"""
+Trwały zapis tokenów OAuth wFirma (backendy dla TokenStore).
+
+Stan tokenów jednego zestawu danych (klucz = prefix ENV, np. WFIRMA_MD_) to słownik
+z polami TOKEN_FIELDS. TokenStore czyta i zapisuje synchronicznie tylko backend
+główny (lokalny, szybki), a pozostałe (ENV/Render, stary plik JSON) aktualizuje w tle.
+
+    - SqliteTokenBackend: plik SQLite (WAL) współdzielony przez workery gunicorna
+    - JsonFileTokenBackend: plik JSON jednego klucza (wfirma_token.json), blokada fcntl
+    - EnvTokenBackend: zmienne środowiskowe {prefix}ACCESS_TOKEN itd. (+ zapis do Render)
+    - MemoryTokenBackend: tylko pamięć procesu (testy, lokalny rozwój)
+"""
+
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, Mapping, Optional
+
+from wfirma_log import get_logger
+from wfirma_sqlite import connect, open_db
+
+try:
+    import fcntl
+except ImportError:  # Windows - bez blokady między procesami
+    fcntl = None
+
+log = get_logger('TOKEN')
+
+
+TOKEN_FIELDS = ('access_token', 'expires_at', 'refresh_token', 'refresh_expires_at')
+
+
+class TokenBackend:
+    """Interfejs backendu tokenów. load() zwraca słownik TOKEN_FIELDS albo None (brak danych)."""
+
+    name = 'backend'
+
+    def load(self, key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save(self, key: str, state: dict) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {'name': self.name}
+
+
+class MemoryTokenBackend(TokenBackend):
+    """Tokeny tylko w pamięci procesu (bez współdzielenia między workerami)."""
+
+    name = 'memory'
+
+    def __init__(self, initial: Optional[Dict[str, dict]] = None):
+        self._states: Dict[str, dict] = {key: dict(state) for key, state in (initial or {}).items()}
+        self._lock = threading.Lock()
+
+    def load(self, key: str) -> Optional[dict]:
+        with self._lock:
+            state = self._states.get(key)
+            return dict(state) if state else None
+
+    def save(self, key: str, state: dict) -> None:
+        with self._lock:
+            self._states[key] = {field: state.get(field) for field in TOKEN_FIELDS}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'name': self.name, 'keys': sorted(self._states)}
+
+
+class SqliteTokenBackend(TokenBackend):
+    """
+    Tokeny w SQLite - jeden plik dla wszystkich workerów (blokady zapewnia SQLite).
+
+    Args:
+        path: Ścieżka do pliku bazy SQLite
+    """
+
+    name = 'sqlite'
+
+    def __init__(self, path: str):
+        self.path = path
+        open_db(path, (
+            'CREATE TABLE IF NOT EXISTS tokens ('
+            ' key TEXT PRIMARY KEY,'
+            ' access_token TEXT,'
+            ' expires_at REAL,'
+            ' refresh_token TEXT,'
+            ' refresh_expires_at TEXT)',
+        ))
+        try:
+            os.chmod(path, 0o600)  # tokeny - tylko właściciel
+        except OSError:
+            pass
+
+    def load(self, key: str) -> Optional[dict]:
+        with connect(self.path) as conn:
+            row = conn.execute(
+                'SELECT access_token, expires_at, refresh_token, refresh_expires_at FROM tokens WHERE key = ?',
+                (key,),
+            ).fetchone()
+        return dict(zip(TOKEN_FIELDS, row)) if row else None
+
+    def save(self, key: str, state: dict) -> None:
+        refresh_expires_at = state.get('refresh_expires_at')
+        with connect(self.path) as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO tokens (key, access_token, expires_at, refresh_token, refresh_expires_at)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (key, state.get('access_token'), float(state.get('expires_at') or 0), state.get('refresh_token'),
+                 str(refresh_expires_at) if refresh_expires_at is not None else None),
+            )
+
+    def stats(self) -> dict:
+        with connect(self.path) as conn:
+            keys = [row[0] for row in conn.execute('SELECT key FROM tokens ORDER BY key')]
+        return {'name': self.name, 'path': self.path, 'keys': keys}
+
+
+class JsonFileTokenBackend(TokenBackend):
+    """
+    Tokeny jednego klucza w pliku JSON (format wfirma_token.json).
+    Zapis atomowy (plik tymczasowy + os.replace) pod blokadą fcntl pliku .lock.
+
+    Args:
+        path: Ścieżka pliku JSON
+        key: Klucz (prefix ENV), którego dotyczy plik - inne klucze są ignorowane
+    """
+
+    name = 'json'
+
+    def __init__(self, path: str, key: str):
+        self.path = path
+        self.key = key
+
+    @contextmanager
+    def _locked(self):
+        if fcntl is None:
+            yield
+            return
+        with open(self.path + '.lock', 'a+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def load(self, key: str) -> Optional[dict]:
+        if key != self.key:
+            return None
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning("Błąd wczytywania z pliku %s: %s", self.path, e)
+            return None
+        return {field: data.get(field) for field in TOKEN_FIELDS}
+
+    def save(self, key: str, state: dict) -> None:
+        if key != self.key:
+            return
+        data = {field: state.get(field) for field in TOKEN_FIELDS}
+        directory = os.path.dirname(self.path) or '.'
+        with self._locked():
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp_tokens_')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+
+    def stats(self) -> dict:
+        return {'name': self.name, 'path': self.path, 'key': self.key}
+
+
+class EnvTokenBackend(TokenBackend):
+    """
+    Tokeny w zmiennych środowiskowych {prefix}ACCESS_TOKEN, {prefix}TOKEN_EXPIRES,
+    {prefix}REFRESH_TOKEN, {prefix}REFRESH_TOKEN_EXPIRES.
+
+    Args:
+        update_env: Funkcja zapisująca słownik zmian (np. os.environ + Render API)
+        environ: Skąd czytać zmienne (domyślnie os.environ)
+    """
+
+    name = 'env'
+
+    def __init__(self, update_env: Callable[[Dict[str, str]], object], environ: Mapping[str, str] = os.environ):
+        self.update_env = update_env
+        self.environ = environ
+
+    def load(self, key: str) -> Optional[dict]:
+        state = {
+            'access_token': self.environ.get(f'{key}ACCESS_TOKEN') or None,
+            'expires_at': 0.0,
+            'refresh_token': self.environ.get(f'{key}REFRESH_TOKEN') or None,
+            # Fallback na starą zmienną (backward compatibility)
+            'refresh_expires_at': (self.environ.get(f'{key}REFRESH_TOKEN_EXPIRES')
+                                   or self.environ.get('WFIRMA_REFRESH_TOKEN_EXPIRES') or None),
+        }
+        try:
+            state['expires_at'] = float(self.environ.get(f'{key}TOKEN_EXPIRES') or 0)
+        except ValueError:
+            pass
+        if not state['access_token'] and not state['refresh_token']:
+            return None
+        return state
+
+    def save(self, key: str, state: dict) -> None:
+        values = {
+            f'{key}ACCESS_TOKEN': state.get('access_token'),
+            f'{key}TOKEN_EXPIRES': str(int(float(state.get('expires_at') or 0))),
+            f'{key}REFRESH_TOKEN': state.get('refresh_token'),
+        }
+        if state.get('refresh_expires_at') is not None:
+            values[f'{key}REFRESH_TOKEN_EXPIRES'] = str(state['refresh_expires_at'])
+        # Zapisujemy tylko zmienione wartości - każda zmiana to zapis do Render
+        changed = {name: value for name, value in values.items()
+                   if value is not None and self.environ.get(name) != value}
+        if changed:
+            self.update_env(changed)
+
+    def stats(self) -> dict:
+        return {'name': self.name}
@@ -0,0 +1,428 @@
+"""
+Tokeny OAuth wFirma trzymane w pamięci procesu.
+
+TokenStore trzyma access token, jego termin ważności i refresh token osobno
+dla każdego zestawu danych (prefix ENV, np. WFIRMA_MD_). Backendy trwałego zapisu
+(wfirma_token_backends) są czytane przy pierwszym użyciu klucza, a token
+jest odświeżany w tle przed wygaśnięciem - obsługa requestu z ważnym tokenem nie
+czeka na sprawdzanie ani odświeżanie tokenu. Backend główny jest czytany ponownie
+tylko przy braku / wygaśnięciu tokenu w pamięci oraz co check_interval w wątku w tle,
+więc token zapisany przez inny worker (np. po /callback) trafia do wszystkich workerów.
+
+Zapis: backend główny (lokalny, współdzielony przez workery - np. SQLite) synchronicznie,
+pozostałe (ENV/Render, stary plik JSON) w wątku w tle.
+
+Odświeżanie jest single-flight: w procesie blokada per klucz, między workerami
+gunicorna blokada pliku (fcntl). Odświeża dokładnie jeden wątek, pozostali
+czekają i dostają jego wynik - pozostałe workery czytają nowe tokeny z backendu głównego.
+"""
+
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Optional
+
+from wfirma_log import get_logger
+from wfirma_token_backends import TOKEN_FIELDS, MemoryTokenBackend, TokenBackend
+
+try:
+    import fcntl
+except ImportError:  # Windows - tylko blokada w procesie
+    fcntl = None
+
+log = get_logger('TOKEN')
+
+
+def _primary_version(data: dict) -> tuple:
+    """Porównywalna wersja stanu z backendu głównego (typy pól różnią się między backendami)."""
+    version = []
+    for field in TOKEN_FIELDS:
+        value = data.get(field)
+        if value in (None, '', 0):
+            version.append(None)
+        elif field == 'expires_at':
+            version.append(float(value))
+        else:
+            version.append(str(value))
+    return tuple(version)
+
+
+class TokenStore:
+    """
+    Stan tokenów per klucz (prefix ENV). Bezpieczny wątkowo.
+
+    Args:
+        refresh: Funkcja (key) -> nowy access token lub None; po sukcesie powinna
+                 zapisać nowy stan przez update()
+        primary: Backend główny - czytany przy starcie i przy odświeżaniu, zapisywany synchronicznie
+        secondary: Backendy synchronizowane w tle (przy starcie czytane jako źródło zapasowe)
+        refresh_margin: Ile sekund przed wygaśnięciem odświeżamy token w tle
+        check_interval: Co ile sekund wątek w tle sprawdza terminy ważności i zmiany w backendzie głównym
+        retry_interval: Odstęp kolejnej próby po nieudanym odświeżeniu
+        lock_dir: Katalog na blokady odświeżania między workerami
+                  (None = single-flight tylko w obrębie procesu)
+    """
+
+    def __init__(self, refresh: Callable[[str], Optional[str]], primary: Optional[TokenBackend] = None,
+                 secondary: Iterable[TokenBackend] = (), refresh_margin: float = 300,
+                 check_interval: float = 30, retry_interval: float = 60, lock_dir: Optional[str] = None):
+        self.refresh = refresh
+        self.primary = primary or MemoryTokenBackend()
+        self.secondary = list(secondary)
+        self.refresh_margin = refresh_margin
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.lock_dir = lock_dir
+        self._states: Dict[str, dict] = {}
+        self._flight_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        self._refresher: Optional[threading.Thread] = None
+        self._refresher_pid: Optional[int] = None
+        self._sync_pending: Dict[str, dict] = {}
+        self._sync_in_flight = False
+        self._sync_cond = threading.Condition()
+        self._syncer: Optional[threading.Thread] = None
+        self._syncer_pid: Optional[int] = None
+        self.seeds = 0
+        self.valid_reads = 0
+        self.expired_reads = 0
+        self.background_refreshes = 0
+        self.background_failures = 0
+        self.flights = 0
+        self.joined_flights = 0
+        self.primary_adoptions = 0
+        self.sync_writes = 0
+        self.sync_failures = 0
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def _state(self, key: str) -> dict:
+        """Stan dla klucza (przy pierwszym użyciu wczytany z backendów). Wywoływać pod self._lock."""
+        state = self._states.get(key)
+        if state is None:
+            state = self._seed(key)
+            state['next_attempt'] = 0.0
+            state['flights'] = 0
+            self._states[key] = state
+            self.seeds += 1
+        return state
+
+    def _seed(self, key: str) -> dict:
+        """
+        Najświeższy stan spośród backendów (najpóźniej wygasający access token).
+        Brakujące pola uzupełniane z pozostałych; wynik trafia do backendu głównego.
+        """
+        candidates = []
+        for backend in [self.primary] + self.secondary:
+            try:
+                loaded = backend.load(key)
+            except Exception as e:
+                log.warning("[%s] Błąd odczytu z backendu %s: %s", key, backend.name, e)
+                continue
+            if loaded:
+                loaded['expires_at'] = float(loaded.get('expires_at') or 0)
+                candidates.append((backend, loaded))
+
+        state = {field: None for field in TOKEN_FIELDS}
+        state['expires_at'] = 0.0
+        state['primary_seen'] = next((_primary_version(loaded) for backend, loaded in candidates
+                                      if backend is self.primary), None)
+        source = None
+        if candidates:
+            source, best = max(candidates, key=lambda c: (bool(c[1].get('access_token')), c[1]['expires_at']))
+            state.update({field: best.get(field) for field in TOKEN_FIELDS})
+            for _, loaded in candidates:
+                for field in TOKEN_FIELDS:
+                    if state[field] is None and loaded.get(field) is not None:
+                        state[field] = loaded[field]
+            if source is not self.primary:
+                self._save_primary(key, state, state)
+
+        log.info("[%s] Seed z %s: access=%s, refresh=%s", key, source.name if source else 'brak',
+                 bool(state['access_token']), bool(state['refresh_token']))
+        return state
+
+    def _save_primary(self, key: str, data: dict, state: dict) -> None:
+        """Zapisz data do backendu głównego; state['primary_seen'] = wersja, którą backend teraz zawiera."""
+        try:
+            self.primary.save(key, data)
+        except Exception as e:
+            log.warning("[%s] Błąd zapisu do backendu %s: %s", key, self.primary.name, e)
+            return
+        state['primary_seen'] = _primary_version(data)
+
+    def _adopt_primary(self, key: str, state: dict) -> bool:
+        """
+        Przejmij stan z backendu głównego, jeśli od ostatniego odczytu / zapisu tego procesu
+        zmienił go inny worker (odświeżenie, nowa autoryzacja /callback, unieważnienie).
+        Wywoływać pod self._lock.
+        """
+        try:
+            stored = self.primary.load(key)
+        except Exception as e:
+            log.warning("[%s] Błąd odczytu z backendu %s: %s", key, self.primary.name, e)
+            return False
+        if not stored:
+            return False  # brak wpisu (np. wyczyszczony katalog danych) - zostajemy przy stanie z pamięci
+        version = _primary_version(stored)
+        if version == state['primary_seen']:
+            return False
+        state['primary_seen'] = version
+        for field in TOKEN_FIELDS:
+            state[field] = stored.get(field)
+        state['expires_at'] = float(state['expires_at'] or 0)
+        state['next_attempt'] = 0.0
+        self.primary_adoptions += 1
+        log.info("[%s] Przejęto tokeny zapisane przez inny worker (access=%s, refresh=%s)",
+                 key, bool(state['access_token']), bool(state['refresh_token']))
+        return True
+
+    # ==== SYNCHRONIZACJA BACKENDÓW W TLE ====
+
+    def _schedule_sync(self, key: str, data: dict) -> None:
+        if not self.secondary:
+            return
+        self._ensure_syncer()
+        with self._sync_cond:
+            self._sync_pending[key] = data
+            self._sync_cond.notify_all()
+
+    def _ensure_syncer(self) -> None:
+        pid = os.getpid()
+        with self._sync_cond:
+            if self._syncer is not None and self._syncer_pid == pid and self._syncer.is_alive():
+                return
+            self._syncer_pid = pid
+            self._syncer = threading.Thread(target=self._sync_run, name='token-sync', daemon=True)
+            self._syncer.start()
+
+    def _sync_run(self) -> None:
+        while True:
+            with self._sync_cond:
+                while not self._sync_pending:
+                    self._sync_cond.wait()
+                batch = dict(self._sync_pending)
+                self._sync_pending.clear()
+                self._sync_in_flight = True
+            for key, data in batch.items():
+                for backend in self.secondary:
+                    try:
+                        backend.save(key, data)
+                        self.sync_writes += 1
+                    except Exception as e:
+                        self.sync_failures += 1
+                        log.warning("[%s] Błąd zapisu do backendu %s: %s", key, backend.name, e)
+            with self._sync_cond:
+                self._sync_in_flight = False
+                self._sync_cond.notify_all()
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Poczekaj na zapis do backendów w tle (np. przy zamykaniu procesu). True = zapisane."""
+        deadline = time.time() + timeout
+        with self._sync_cond:
+            while self._sync_pending or self._sync_in_flight:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._sync_cond.wait(remaining)
+            return True
+
+    # ==== ODŚWIEŻANIE (SINGLE-FLIGHT) ====
+
+    @contextmanager
+    def _file_lock(self, key: str):
+        """Blokada między procesami (fcntl.flock) - bez lock_dir / fcntl brak blokady."""
+        if not self.lock_dir or fcntl is None:
+            yield
+            return
+        path = os.path.join(self.lock_dir, 'tokens_' + re.sub(r'[^0-9A-Za-z_-]', '_', key) + '.lock')
+        with open(path, 'a+') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def refresh_single_flight(self, key: str, refresh: Callable[[], Optional[str]]) -> Optional[str]:
+        """
+        Odśwież token klucza tak, by naraz odświeżał tylko jeden wątek we wszystkich workerach.
+
+        Wątki, które czekały na blokadę, dostają wynik zakończonego właśnie odświeżenia
+        (także nieudanego - None) zamiast wywoływać refresh() ponownie.
+
+        Args:
+            key: Klucz (prefix ENV)
+            refresh: Funkcja wykonująca odświeżenie; po sukcesie zapisuje stan przez update()
+        """
+        with self._lock:
+            state = self._state(key)
+            seen_flights = state['flights']
+            seen_expires = state['expires_at']
+            flight_lock = self._flight_locks.setdefault(key, threading.Lock())
+
+        with flight_lock:
+            with self._lock:
+                state = self._state(key)
+                if state['flights'] != seen_flights:
+                    # Inny wątek tego procesu odświeżył, gdy czekaliśmy - bierzemy jego wynik
+                    self.joined_flights += 1
+                    valid = bool(state['access_token']) and time.time() < state['expires_at']
+                    return state['access_token'] if valid else None
+
+            with self._file_lock(key):
+                with self._lock:
+                    state = self._state(key)
+                    self._adopt_primary(key, state)
+                    if state['access_token'] and state['expires_at'] > max(seen_expires, time.time()):
+                        # Inny worker odświeżył - bez wywołania oauth2/token
+                        state['flights'] += 1
+                        self.joined_flights += 1
+                        return state['access_token']
+                    self.flights += 1
+                try:
+                    return refresh()
+                finally:
+                    with self._lock:
+                        self._state(key)['flights'] += 1
+
+    # ==== ODCZYT / ZAPIS ====
+
+    def snapshot(self, key: str) -> dict:
+        """Kopia stanu tokenów (access_token, expires_at, refresh_token, refresh_expires_at)."""
+        with self._lock:
+            state = self._state(key)
+            return {field: state[field] for field in TOKEN_FIELDS}
+
+    def access_token(self, key: str) -> Optional[str]:
+        """
+        Ważny access token albo None (brak / wygasł). Ważny token z pamięci - bez I/O; przy braku
+        lub wygaśnięciu sprawdzany jest backend główny (token mógł zapisać inny worker).
+        """
+        self.ensure_refresher()
+        with self._lock:
+            state = self._state(key)
+            valid = bool(state['access_token']) and time.time() < state['expires_at']
+            if not valid and self._adopt_primary(key, state):
+                valid = bool(state['access_token']) and time.time() < state['expires_at']
+            if valid:
+                self.valid_reads += 1
+                return state['access_token']
+            self.expired_reads += 1
+            return None
+
+    def is_valid(self, key: str) -> bool:
+        with self._lock:
+            state = self._state(key)
+            return bool(state['access_token']) and time.time() < state['expires_at']
+
+    def update(self, key: str, access_token: Optional[str] = None, expires_at: Optional[float] = None,
+               refresh_token: Optional[str] = None, refresh_expires_at: Optional[float] = None) -> None:
+        """Zapisz nowe wartości (None = bez zmian): pamięć + backend główny, pozostałe backendy w tle."""
+        with self._lock:
+            state = self._state(key)
+            if access_token is not None:
+                state['access_token'] = access_token
+            if expires_at is not None:
+                state['expires_at'] = float(expires_at)
+            if refresh_token is not None:
+                state['refresh_token'] = refresh_token
+            if refresh_expires_at is not None:
+                state['refresh_expires_at'] = refresh_expires_at
+            state['next_attempt'] = 0.0
+            data = {field: state[field] for field in TOKEN_FIELDS}
+            # Pod blokadą - kolejność zapisów do backendu głównego = kolejność aktualizacji
+            self._save_primary(key, data, state)
+        self._schedule_sync(key, data)
+
+    # ==== ODŚWIEŻANIE W TLE ====
+
+    def ensure_refresher(self) -> None:
+        """Uruchom wątek odświeżający (także w procesie po fork() workera gunicorna)."""
+        pid = os.getpid()
+        if self._refresher is not None and self._refresher_pid == pid and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher is not None and self._refresher_pid == pid and self._refresher.is_alive():
+                return
+            self._refresher_pid = pid
+            self._refresher = threading.Thread(target=self._run, name='token-refresher', daemon=True)
+            self._refresher.start()
+
+    def _due_keys(self) -> list:
+        now = time.time()
+        with self._lock:
+            return [
+                key for key, state in self._states.items()
+                if state['refresh_token']
+                and state['expires_at'] - now < self.refresh_margin
+                and now >= state['next_attempt']
+            ]
+
+    def refresh_due(self) -> None:
+        """Odśwież tokeny, którym zostało mniej niż refresh_margin sekund."""
+        for key in self._due_keys():
+            with self._lock:
+                self.background_refreshes += 1
+            try:
+                ok = bool(self.refresh(key))
+            except Exception as e:
+                log.warning("Odświeżanie w tle (%s) - wyjątek: %s", key, e)
+                ok = False
+            if not ok:
+                with self._lock:
+                    self.background_failures += 1
+                    self._states[key]['next_attempt'] = time.time() + self.retry_interval
+                log.warning("Odświeżanie w tle (%s) nieudane - kolejna próba za %ss", key, self.retry_interval)
+
+    def poll_primary(self) -> None:
+        """Przejmij zmiany, które inne workery zapisały w backendzie głównym (przed wygaśnięciem tokenu)."""
+        with self._lock:
+            for key, state in self._states.items():
+                self._adopt_primary(key, state)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.check_interval)
+            try:
+                self.poll_primary()
+                self.refresh_due()
+            except Exception as e:
+                log.warning("Wątek odświeżania - błąd: %s", e)
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            result = {
+                'name': 'token_store',
+                'refresh_margin_seconds': self.refresh_margin,
+                'check_interval_seconds': self.check_interval,
+                'keys': {
+                    key: {
+                        'valid': bool(state['access_token']) and now < state['expires_at'],
+                        'remaining_seconds': max(0, int(state['expires_at'] - now)),
+                        'refresh_token_exists': bool(state['refresh_token']),
+                    }
+                    for key, state in self._states.items()
+                },
+                'seeds': self.seeds,
+                'valid_reads': self.valid_reads,
+                'expired_reads': self.expired_reads,
+                'background_refreshes': self.background_refreshes,
+                'background_failures': self.background_failures,
+                'flights': self.flights,
+                'joined_flights': self.joined_flights,
+                'primary_adoptions': self.primary_adoptions,
+                'lock_dir': self.lock_dir,
+                'refresher_running': bool(self._refresher and self._refresher.is_alive()),
+            }
+        with self._sync_cond:
+            result['backends'] = {
+                'primary': self.primary.name,
+                'secondary': [backend.name for backend in self.secondary],
+                'sync_pending': sorted(self._sync_pending),
+                'sync_writes': self.sync_writes,
+                'sync_failures': self.sync_failures,
+            }
+        return result